@@ -5,33 +5,79 @@ This module defines the protocol for communication between AI agents in the syst
 It provides standardized message formats and handling mechanisms.
 """
 
-import json
+import os
+import random
+import sys
 import time
-import uuid
+from collections import OrderedDict, defaultdict
 from typing import Dict, Any, Optional, List
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Extra, Field, PrivateAttr
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+
+def _orjson_dumps(value, *, default):
+    """orjson returns bytes; pydantic's ``json_dumps`` hook expects str"""
+    return orjson.dumps(value, default=default).decode()
+
+# Message ids only need to be unique, not unpredictable, so a seeded PRNG
+# avoids uuid4's os.urandom call and dash formatting on every message
+_message_id_rng = random.Random(os.urandom(16))
+
+def _new_message_id() -> str:
+    """Return a random 128-bit message id as 32 hex characters"""
+    return f"{_message_id_rng.getrandbits(128):032x}"
 
 class A2AMessage(BaseModel):
     """Base message format for Agent-to-Agent communication"""
-    message_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    message_id: str = Field(default_factory=_new_message_id)
     source_agent_id: str
     target_agent_id: str
     message_type: str
     payload: Dict[str, Any]
     timestamp: float = Field(default_factory=time.time)
     correlation_id: Optional[str] = None
-    ttl: int = 60  # Time-to-live in seconds
+    ttl: int = Field(60, ge=0)  # Time-to-live in seconds
+    
+    # Serialized form, filled on first serialization (messages are frozen)
+    _cached_json: Optional[str] = PrivateAttr(default=None)
+
+    class Config:
+        # Messages are immutable once created and carry no unknown fields
+        frozen = True
+        extra = Extra.forbid
+        # Let pydantic encode/decode straight through orjson when available
+        if orjson is not None:
+            json_loads = orjson.loads
+            json_dumps = _orjson_dumps
+    
+    def copy(self, **kwargs) -> "A2AMessage":
+        message = super().copy(**kwargs)
+        # update/include/exclude change the fields, so copies never reuse the original's JSON
+        message._cached_json = None
+        return message
+
+# Field names used to check trusted messages still match the current schema
+_REQUIRED_FIELDS = frozenset(name for name, field in A2AMessage.__fields__.items() if field.required)
+_ALL_FIELDS = frozenset(A2AMessage.__fields__)
 
 class A2AProtocol:
     """Implementation of the Agent-to-Agent protocol"""
     
-    def __init__(self):
+    def __init__(self, trust_peer: bool = False):
+        # When peers are trusted (e.g. behind the intermediary), skip field validation
+        self.trust_peer = trust_peer
         self.message_handlers = {}
-        self.message_history = {}  # For tracking message chains
+        self._get_handler = self.message_handlers.get
+        self.message_history = OrderedDict()  # For tracking message chains, oldest first
+        self._children = defaultdict(list)  # message_id -> ids of its responses
     
     def register_handler(self, message_type: str, handler_func):
         """Register a handler function for a specific message type"""
-        self.message_handlers[message_type] = handler_func
+        self.message_handlers[sys.intern(message_type)] = handler_func
     
     def create_message(self, source_agent_id: str, target_agent_id: str, 
                       message_type: str, payload: Dict[str, Any],
@@ -58,65 +104,80 @@ class A2AProtocol:
     
     def serialize_message(self, message: A2AMessage) -> str:
         """Serialize message to JSON string"""
-        return json.dumps(message.dict())
+        if message._cached_json is None:
+            message._cached_json = message.json()
+        return message._cached_json
     
     def deserialize_message(self, message_str: str) -> A2AMessage:
         """Deserialize message from JSON string"""
-        message_data = json.loads(message_str)
-        return A2AMessage(**message_data)
+        if not self.trust_peer:
+            return A2AMessage.parse_raw(message_str)
+        
+        message_data = A2AMessage.__config__.json_loads(message_str)
+        
+        # Fall back to full validation if the sender is on a different schema
+        if _REQUIRED_FIELDS <= message_data.keys() <= _ALL_FIELDS:
+            return A2AMessage.construct(**message_data)
+        return A2AMessage.parse_obj(message_data)
     
     async def process_message(self, message: A2AMessage) -> Optional[A2AMessage]:
         """Process an incoming message using registered handlers"""
         # Store in message history
-        self.message_history[message.message_id] = {
+        self._remember(message.message_id, {
             "message": message,
             "received_at": time.time()
-        }
+        })
         
         # Check if we have a handler for this message type
-        if message.message_type in self.message_handlers:
-            handler = self.message_handlers[message.message_type]
-            response = await handler(message)
-            
-            # If handler returns a response, store it in history
-            if response:
-                self.message_history[response.message_id] = {
-                    "message": response,
-                    "received_at": time.time(),
-                    "in_response_to": message.message_id
-                }
-            
-            return response
+        handler = self._get_handler(message.message_type)
+        if handler is None:
+            return None
+        
+        response = await handler(message)
         
-        return None
+        # If handler returns a response, store it in history
+        if response:
+            self._remember(response.message_id, {
+                "message": response,
+                "received_at": time.time(),
+                "in_response_to": message.message_id
+            })
+            self._children[message.message_id].append(response.message_id)
+        
+        return response
     
     def get_message_chain(self, root_message_id: str) -> List[A2AMessage]:
         """Retrieve a chain of messages starting from a root message"""
         if root_message_id not in self.message_history:
             return []
         
-        chain = [self.message_history[root_message_id]["message"]]
+        chain = []
         
-        # Find all messages in the chain
-        for msg_id, msg_data in self.message_history.items():
-            if msg_data.get("in_response_to") == root_message_id:
-                # Add this message to the chain
-                chain.append(msg_data["message"])
-                
-                # Recursively find responses to this message
-                chain.extend(self.get_message_chain(msg_id))
+        # Walk the response index depth-first, keeping responses in arrival order
+        pending = [root_message_id]
+        while pending:
+            msg_id = pending.pop()
+            msg_data = self.message_history.get(msg_id)
+            if msg_data is None:
+                continue
+            chain.append(msg_data["message"])
+            pending.extend(reversed(self._children.get(msg_id, ())))
         
         return chain
     
+    def _remember(self, message_id: str, entry: Dict[str, Any]):
+        """Store a history entry, keeping the history ordered by receive time"""
+        self.message_history[message_id] = entry
+        self.message_history.move_to_end(message_id)
+    
     def cleanup_old_messages(self, max_age_seconds: int = 3600):
         """Clean up old messages from history"""
-        current_time = time.time()
-        to_remove = []
-        
-        for msg_id, msg_data in self.message_history.items():
-            age = current_time - msg_data["received_at"]
-            if age > max_age_seconds:
-                to_remove.append(msg_id)
+        cutoff = time.time() - max_age_seconds
         
-        for msg_id in to_remove:
-            del self.message_history[msg_id]
+        # History is ordered oldest first, so stop at the first entry still alive
+        while self.message_history:
+            msg_id, msg_data = next(iter(self.message_history.items()))
+            if msg_data["received_at"] >= cutoff:
+                break
+            self.message_history.popitem(last=False)
+            self._children.pop(msg_id, None)
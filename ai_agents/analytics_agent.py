@@ -1,21 +1,44 @@
 import asyncio
+import random
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 import logging
 import json
+from collections import Counter, deque
+from itertools import islice
 from .base_agent import BaseAgent, AgentMessage
 
+# Number of recent snapshots the per-device analyses look at
+ANALYSIS_WINDOW = 10
+
+# Reading tracked per device for each windowed data type
+WINDOWED_FIELDS = {
+    "temperature": "temperature",
+    "switch": "power_consumption"
+}
+
 class AnalyticsAgent(BaseAgent):
+    CAPABILITIES = ("data_analysis", "pattern_recognition", "predictive_analysis", "reporting", "prediction")
+    
     def __init__(self, name: str, intermediary_url: str):
         super().__init__(name, "analytics", intermediary_url)
         self.historical_data = {}  # In a real system, this would use a database
         self.analysis_results = {}
+        self._snapshot_counts = {}  # data_type -> number of snapshots stored so far
+        self._device_windows = {}  # data_type -> device_id -> deque of (snapshot, value)
+        self._data_event = None  # Set when other agents report fresh IoT data
+        self.message_handlers = {
+            "iot_data_update": self.handle_iot_data_update,
+            "analysis_result": self.handle_analysis_result,
+            "request_prediction": self.handle_prediction_request
+        }
         
-    def get_capabilities(self) -> List[str]:
-        return ["data_analysis", "pattern_recognition", "predictive_analysis", "reporting", "prediction"]
+    def get_capabilities(self) -> Tuple[str, ...]:
+        return self.CAPABILITIES
     
     async def run(self):
         """Main agent loop"""
+        self._data_event = asyncio.Event()
         while self._running:
             # Periodically collect data for analysis
             await self.collect_data_for_analysis()
@@ -23,61 +46,73 @@ class AnalyticsAgent(BaseAgent):
             # Perform scheduled analyses
             await self.perform_scheduled_analyses()
             
-            await asyncio.sleep(60)  # Run every minute
+            # Run again as soon as new IoT data is reported, or at least every minute
+            try:
+                await asyncio.wait_for(self._data_event.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+            self._data_event.clear()
     
     async def process_message(self, message: AgentMessage):
         """Process incoming messages from other agents"""
-        if message.message_type == "analysis_result":
-            # Store analysis results from other agents
-            analysis_type = message.payload.get("analysis_type")
-            result = message.payload.get("result")
-            
-            if analysis_type and result:
-                self.analysis_results[analysis_type] = {
-                    "timestamp": time.time(),
-                    "source_agent": message.agent_id,
-                    "result": result
+        handler = self.message_handlers.get(message.message_type)
+        if handler is not None:
+            await handler(message)
+    
+    async def handle_iot_data_update(self, message: AgentMessage):
+        """The monitoring agent has seen new device data; wake the main loop early"""
+        if self._data_event is not None:
+            self._data_event.set()
+    
+    async def handle_analysis_result(self, message: AgentMessage):
+        """Store analysis results from other agents"""
+        analysis_type = message.payload.get("analysis_type")
+        result = message.payload.get("result")
+        
+        if analysis_type and result:
+            self.analysis_results[analysis_type] = {
+                "timestamp": time.time(),
+                "source_agent": message.agent_id,
+                "result": result
+            }
+            self.logger.info(f"Received analysis result for {analysis_type}")
+    
+    async def handle_prediction_request(self, message: AgentMessage):
+        """Handle prediction requests"""
+        prediction_type = message.payload.get("prediction_type")
+        parameters = message.payload.get("parameters", {})
+        
+        if prediction_type == "energy_consumption":
+            prediction = await self.predict_energy_consumption(parameters)
+            await self.send_to_agent(
+                message.agent_id,
+                "prediction_result",
+                {
+                    "prediction_type": "energy_consumption",
+                    "result": prediction
                 }
-                self.logger.info(f"Received analysis result for {analysis_type}")
-                
-        elif message.message_type == "request_prediction":
-            # Handle prediction requests
-            prediction_type = message.payload.get("prediction_type")
-            parameters = message.payload.get("parameters", {})
-            
-            if prediction_type == "energy_consumption":
-                prediction = await self.predict_energy_consumption(parameters)
-                await self.send_to_agent(
-                    message.agent_id,
-                    "prediction_result",
-                    {
-                        "prediction_type": "energy_consumption",
-                        "result": prediction
-                    }
-                )
-                
-            elif prediction_type == "occupancy_pattern":
-                prediction = await self.predict_occupancy_pattern(parameters)
-                await self.send_to_agent(
-                    message.agent_id,
-                    "prediction_result",
-                    {
-                        "prediction_type": "occupancy_pattern",
-                        "result": prediction
-                    }
-                )
+            )
+            
+        elif prediction_type == "occupancy_pattern":
+            prediction = await self.predict_occupancy_pattern(parameters)
+            await self.send_to_agent(
+                message.agent_id,
+                "prediction_result",
+                {
+                    "prediction_type": "occupancy_pattern",
+                    "result": prediction
+                }
+            )
     
     async def collect_data_for_analysis(self):
         """Collect data from IoT devices for analysis"""
         try:
-            # Get temperature data
-            temp_data = await self.query_iot_data("temperature_sensor", {})
-            
-            # Get motion data
-            motion_data = await self.query_iot_data("motion_detector", {})
-            
-            # Get smart switch data (energy consumption)
-            switch_data = await self.query_iot_data("smart_switch", {})
+            # Get temperature, motion and smart switch (energy consumption) data concurrently
+            temp_data, motion_data, switch_data = await asyncio.gather(
+                self.query_iot_data("temperature_sensor", {}),
+                self.query_iot_data("motion_detector", {}),
+                self.query_iot_data("smart_switch", {})
+            )
             
             # Store data with timestamp
             timestamp = time.time()
@@ -91,16 +126,41 @@ class AnalyticsAgent(BaseAgent):
     def store_historical_data(self, data_type: str, timestamp: float, data: Dict[str, Any]):
         """Store historical data (in a real system, this would use a database)"""
         if data_type not in self.historical_data:
-            self.historical_data[data_type] = []
-            
-        # Keep only the last 1000 data points (in a real system, this would be handled by the database)
-        if len(self.historical_data[data_type]) >= 1000:
-            self.historical_data[data_type].pop(0)
+            # Keep only the last 1000 data points (in a real system, this would be handled by the database)
+            self.historical_data[data_type] = deque(maxlen=1000)
             
         self.historical_data[data_type].append({
             "timestamp": timestamp,
             "data": data
         })
+        
+        snapshot = self._snapshot_counts.get(data_type, 0)
+        self._snapshot_counts[data_type] = snapshot + 1
+        
+        # Keep a short per-device window so analyses don't re-walk every snapshot
+        field = WINDOWED_FIELDS.get(data_type)
+        if field:
+            windows = self._device_windows.setdefault(data_type, {})
+            for device_id, reading in data.get("devices", {}).items():
+                window = windows.get(device_id)
+                if window is None:
+                    window = windows[device_id] = deque(maxlen=ANALYSIS_WINDOW)
+                window.append((snapshot, reading.get(field, 0)))
+    
+    def recent_device_values(self, data_type: str) -> Dict[str, List[float]]:
+        """Return each device's readings from the last ANALYSIS_WINDOW snapshots"""
+        oldest = self._snapshot_counts.get(data_type, 0) - ANALYSIS_WINDOW
+        windows = self._device_windows.get(data_type, {})
+        
+        recent = {}
+        for device_id in list(windows):
+            values = [value for snapshot, value in windows[device_id] if snapshot >= oldest]
+            if values:
+                recent[device_id] = values
+            else:
+                # Device hasn't reported within the window; stop tracking it
+                del windows[device_id]
+        return recent
     
     async def perform_scheduled_analyses(self):
         """Perform scheduled analyses"""
@@ -119,16 +179,8 @@ class AnalyticsAgent(BaseAgent):
             return  # Not enough data
             
         try:
-            # Extract the most recent temperature readings
-            recent_data = self.historical_data["temperature"][-10:]
-            
-            # Calculate average temperature per device
-            device_temps = {}
-            for entry in recent_data:
-                for device_id, data in entry["data"].get("devices", {}).items():
-                    if device_id not in device_temps:
-                        device_temps[device_id] = []
-                    device_temps[device_id].append(data.get("temperature", 0))
+            # Recent temperature readings per device
+            device_temps = self.recent_device_values("temperature")
             
             # Calculate averages and trends
             results = {}
@@ -161,45 +213,40 @@ class AnalyticsAgent(BaseAgent):
             
         try:
             # Extract motion data from the last 20 readings
-            recent_data = self.historical_data["motion"][-20:]
+            motion_history = self.historical_data["motion"]
+            recent_data = islice(motion_history, len(motion_history) - 20, None)
             
             # Analyze motion patterns by location
-            location_activity = {}
+            readings = [
+                (data.get("location", "unknown"), data.get("motion_detected"))
+                for entry in recent_data
+                for data in entry["data"].get("devices", {}).values()
+            ]
             
-            for entry in recent_data:
-                for device_id, data in entry["data"].get("devices", {}).items():
-                    location = data.get("location", "unknown")
-                    
-                    if location not in location_activity:
-                        location_activity[location] = {
-                            "motion_count": 0,
-                            "total_readings": 0
-                        }
-                    
-                    location_activity[location]["total_readings"] += 1
-                    if data.get("motion_detected"):
-                        location_activity[location]["motion_count"] += 1
+            # Counter tallies in C, so count readings and detections per location in bulk
+            total_readings = Counter(location for location, _ in readings)
+            motion_counts = Counter(location for location, detected in readings if detected)
             
             # Calculate activity levels
             results = {}
-            for location, data in location_activity.items():
-                if data["total_readings"] > 0:
-                    activity_ratio = data["motion_count"] / data["total_readings"]
-                    
-                    # Classify activity level
-                    if activity_ratio > 0.7:
-                        activity_level = "high"
-                    elif activity_ratio > 0.3:
-                        activity_level = "medium"
-                    else:
-                        activity_level = "low"
-                    
-                    results[location] = {
-                        "activity_level": activity_level,
-                        "activity_ratio": round(activity_ratio, 2),
-                        "motion_count": data["motion_count"],
-                        "total_readings": data["total_readings"]
-                    }
+            for location, total in total_readings.items():
+                motion_count = motion_counts[location]
+                activity_ratio = motion_count / total
+                
+                # Classify activity level
+                if activity_ratio > 0.7:
+                    activity_level = "high"
+                elif activity_ratio > 0.3:
+                    activity_level = "medium"
+                else:
+                    activity_level = "low"
+                
+                results[location] = {
+                    "activity_level": activity_level,
+                    "activity_ratio": round(activity_ratio, 2),
+                    "motion_count": motion_count,
+                    "total_readings": total
+                }
             
             # Store analysis result
             self.analysis_results["motion_patterns"] = {
@@ -231,16 +278,8 @@ class AnalyticsAgent(BaseAgent):
             }
             
         try:
-            # Extract the most recent switch data
-            recent_data = self.historical_data["switch"][-10:]
-            
-            # Calculate energy consumption per device
-            device_energy = {}
-            for entry in recent_data:
-                for device_id, data in entry["data"].get("devices", {}).items():
-                    if device_id not in device_energy:
-                        device_energy[device_id] = []
-                    device_energy[device_id].append(data.get("power_consumption", 0))
+            # Recent power readings per device
+            device_energy = self.recent_device_values("switch")
             
             # Calculate averages and total consumption
             per_device = {}
@@ -374,22 +413,22 @@ class AnalyticsAgent(BaseAgent):
                 "confidence": 0
             }
         
-        # Extract temperature values and timestamps
-        temps = [entry.get("temperature", 0) for entry in historical_data]
-        timestamps = [entry.get("timestamp", 0) for entry in historical_data]
+        # The average rate of change only depends on the first and last samples
+        first, last = historical_data[0], historical_data[-1]
+        first_temp, last_temp = first.get("temperature", 0), last.get("temperature", 0)
+        first_time, last_time = first.get("timestamp", 0), last.get("timestamp", 0)
         
         # Calculate average rate of change
-        if len(temps) >= 2 and timestamps[-1] != timestamps[0]:
-            rate_of_change = (temps[-1] - temps[0]) / (timestamps[-1] - timestamps[0])
+        if last_time != first_time:
+            rate_of_change = (last_temp - first_temp) / (last_time - first_time)
         else:
             rate_of_change = 0
         
         # Simple linear extrapolation
         seconds_ahead = hours_ahead * 3600
-        predicted_temp = temps[-1] + (rate_of_change * seconds_ahead)
+        predicted_temp = last_temp + (rate_of_change * seconds_ahead)
         
         # Add some randomness to simulate real-world variation
-        import random
         variation = random.uniform(-0.5, 0.5)
         predicted_temp += variation
         
@@ -1,20 +1,46 @@
 import asyncio
+import copy
+import json
+import os
 import uuid
 import time
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 import httpx
-from pydantic import BaseModel
+from pydantic import BaseModel, Extra
 import logging
 
+from config.agent_config import get_agent_config
+from .http_client import get_shared_client
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; agents then always speak JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
 class AgentMessage(BaseModel):
     agent_id: str
     message_type: str
     payload: Dict[str, Any]
     timestamp: float
     correlation_id: Optional[str] = None
+    
+    class Config:
+        frozen = True
+        extra = Extra.forbid
 
 class BaseAgent(ABC):
+    # Outbound A2A messages are coalesced into batches of at most this size
+    outbox_batch_size = 64
+    # How long the outbox waits for more messages before flushing a batch
+    outbox_flush_interval = 0.002
+    # Seconds an IoT query result is reused for identical queries
+    query_cache_ttl = 2.0
+    # Maximum number of intermediary requests in flight at once
+    max_concurrency = 50
+    
     def __init__(self, name: str, agent_type: str, intermediary_url: str):
         self.agent_id = str(uuid.uuid4())
         self.name = name
@@ -23,34 +49,86 @@ class BaseAgent(ABC):
         self.logger = logging.getLogger(f"{self.__class__.__name__}.{self.name}")
         self.message_handlers = {}
         self._running = False
+        # "json" (default) or "msgpack" for bodies exchanged with the intermediary
+        self.wire_format = os.getenv("AGENT_WIRE_FORMAT", "json")
+        if self.wire_format == "msgpack" and msgpack is None:
+            self.logger.warning("msgpack is not installed, falling back to JSON")
+            self.wire_format = "json"
+        # Per-agent-type settings from config/agent_config.py override the class defaults
+        agent_config = get_agent_config(agent_type)
+        self.outbox_batch_size = agent_config.get("outbox_batch_size", self.outbox_batch_size)
+        self.outbox_flush_interval = agent_config.get("outbox_flush_interval", self.outbox_flush_interval)
+        self.max_concurrency = agent_config.get("max_concurrency", self.max_concurrency)
+        self._outbox: Optional[asyncio.Queue] = None
+        self._outbox_task: Optional[asyncio.Task] = None
+        self._query_cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        # Queries currently awaiting a response, shared by identical concurrent callers
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        # Bumped by every device command; results of queries sent before it are not cached
+        self._query_generation = 0
+        # Caps in-flight intermediary requests so bursts queue here instead of in the connection pool.
+        # Created on first use so it belongs to the loop the agent actually runs on
+        self._http_sem: Optional[asyncio.Semaphore] = None
+        
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """HTTP client shared by all agents in the process so connections are pooled"""
+        return get_shared_client()
+    
+    async def _post(self, path: str, body: Dict[str, Any]) -> httpx.Response:
+        """POST a body to the intermediary using the agent's wire format"""
+        url = f"{self.intermediary_url}{path}"
+        if self._http_sem is None:
+            self._http_sem = asyncio.Semaphore(self.max_concurrency)
+        async with self._http_sem:
+            if self.wire_format == "msgpack":
+                return await self.http_client.post(
+                    url,
+                    content=msgpack.packb(body),
+                    headers={"content-type": MSGPACK_MEDIA_TYPE, "accept": MSGPACK_MEDIA_TYPE}
+                )
+            return await self.http_client.post(url, json=body)
+    
+    @staticmethod
+    def _decode_response(response: httpx.Response) -> Any:
+        """Decode an intermediary response in whichever format it was sent"""
+        if response.headers.get("content-type") == MSGPACK_MEDIA_TYPE:
+            return msgpack.unpackb(response.content)
+        return response.json()
         
     async def start(self):
         """Start the agent"""
         self._running = True
         await self.register_with_intermediary()
+        self._outbox = asyncio.Queue()
+        self._outbox_task = asyncio.create_task(self._drain_outbox())
         asyncio.create_task(self.run())
         
     async def stop(self):
         """Stop the agent"""
         self._running = False
+        if self._outbox_task is not None:
+            # Let the outbox flush whatever is still queued
+            self._outbox.put_nowait(None)
+            await self._outbox_task
+            self._outbox_task = None
         
     async def register_with_intermediary(self):
         """Register agent with the intermediary"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.intermediary_url}/agents/register",
-                json={
-                    "agent_id": self.agent_id,
-                    "name": self.name,
-                    "agent_type": self.agent_type,
-                    "capabilities": self.get_capabilities()
-                }
-            )
-            self.logger.info(f"Registered with intermediary: {response.status_code}")
+        response = await self._post(
+            "/agents/register",
+            {
+                "agent_id": self.agent_id,
+                "name": self.name,
+                "agent_type": self.agent_type,
+                "capabilities": self.get_capabilities()
+            }
+        )
+        self.logger.info(f"Registered with intermediary: {response.status_code}")
     
     @abstractmethod
-    def get_capabilities(self) -> List[str]:
-        """Return agent capabilities"""
+    def get_capabilities(self) -> Tuple[str, ...]:
+        """Return agent capabilities (a class-level constant; they don't vary per instance)"""
         pass
     
     @abstractmethod
@@ -67,38 +145,121 @@ class BaseAgent(ABC):
             timestamp=time.time()
         )
         
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                f"{self.intermediary_url}/agents/message",
-                json={
-                    "source_agent_id": self.agent_id,
-                    "target_agent_id": target_agent_id,
-                    "message": message.dict()
-                }
-            )
+        envelope = {
+            "source_agent_id": self.agent_id,
+            "target_agent_id": target_agent_id,
+            "message": message.dict()
+        }
+        
+        # While the agent is running, messages go out in batches via the outbox
+        if self._running and self._outbox_task is not None:
+            self._outbox.put_nowait(envelope)
+            return
+        
+        await self._post("/agents/message", envelope)
+    
+    async def _drain_outbox(self):
+        """Forward queued A2A messages to the intermediary in batches"""
+        stopping = False
+        while not stopping:
+            envelope = await self._outbox.get()
+            if envelope is None:
+                break
+            
+            # Give concurrent senders a moment to add to this batch
+            await asyncio.sleep(self.outbox_flush_interval)
+            
+            batch = [envelope]
+            while len(batch) < self.outbox_batch_size and not self._outbox.empty():
+                envelope = self._outbox.get_nowait()
+                if envelope is None:
+                    stopping = True
+                    break
+                batch.append(envelope)
+            
+            try:
+                await self._post("/agents/message_batch", {"messages": batch})
+            except Exception as e:
+                self.logger.error(f"Error sending {len(batch)} queued messages: {e}")
     
     async def query_iot_data(self, device_type: str, query_params: Dict[str, Any]):
-        """Query IoT data through intermediary"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.intermediary_url}/iot/query",
-                json={
+        """Query IoT data through intermediary
+        
+        Results are shared between identical queries, so each caller gets its own copy.
+        """
+        # Serialized rather than hashed directly so list and dict parameter values work too
+        key = (device_type, json.dumps(query_params, sort_keys=True))
+        cached = self._query_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.query_cache_ttl:
+            return copy.deepcopy(cached[1])
+        
+        request = self._inflight.get(key)
+        if request is None:
+            request = self._inflight[key] = asyncio.create_task(
+                self._send_query(key, device_type, query_params)
+            )
+            # Mark failures as retrieved even when every caller has gone away
+            request.add_done_callback(lambda t: t.cancelled() or t.exception())
+        
+        # Shielded so a cancelled caller - the one that started the request included -
+        # doesn't cancel the request for everyone else
+        return copy.deepcopy(await asyncio.shield(request))
+    
+    async def _send_query(self, key: Tuple[str, str], device_type: str, query_params: Dict[str, Any]):
+        """Send an IoT query on behalf of every caller waiting on it, caching the result"""
+        generation = self._query_generation
+        try:
+            response = await self._post(
+                "/iot/query",
+                {
                     "agent_id": self.agent_id,
                     "device_type": device_type,
                     "query_params": query_params
                 }
             )
-            return response.json()
+            result = self._decode_response(response)
+        finally:
+            # A device command may have detached this request already
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+        
+        # A command sent while this was in flight may have made the result stale
+        if generation == self._query_generation:
+            self._query_cache[key] = (time.monotonic(), result)
+        return result
+    
+    def _invalidate_queries(self):
+        """Device state is about to change: drop cached results and requests already in flight"""
+        self._query_generation += 1
+        self._query_cache.clear()
+        # Callers already waiting still get their answer; new callers send a fresh query
+        self._inflight.clear()
     
     async def control_iot_device(self, device_id: str, command: Dict[str, Any]):
         """Send control command to IoT device"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.intermediary_url}/iot/control",
-                json={
-                    "agent_id": self.agent_id,
-                    "device_id": device_id,
-                    "command": command
-                }
-            )
-            return response.json()
+        # Device state is about to change, so cached readings can't be trusted
+        self._invalidate_queries()
+        response = await self._post(
+            "/iot/control",
+            {
+                "agent_id": self.agent_id,
+                "device_id": device_id,
+                "command": command
+            }
+        )
+        return self._decode_response(response)
+    
+    async def control_iot_devices_batch(self, commands: List[Tuple[str, Dict[str, Any]]]):
+        """Send several control commands to IoT devices in a single request"""
+        self._invalidate_queries()
+        response = await self._post(
+            "/iot/control_batch",
+            {
+                "agent_id": self.agent_id,
+                "commands": [
+                    {"device_id": device_id, "command": command}
+                    for device_id, command in commands
+                ]
+            }
+        )
+        return self._decode_response(response)
@@ -1,18 +1,107 @@
 import asyncio
 import time
-from typing import Dict, Any, List
+from collections import defaultdict
+from typing import Dict, Any, Callable, List, Tuple
 import logging
 from .base_agent import BaseAgent, AgentMessage
 
+# Evaluates a rule against (motion detectors by location, temperature devices by id)
+RuleEvaluator = Callable[[Dict[str, List[Dict[str, Any]]], Dict[str, Dict[str, Any]]],
+                         List[Tuple[str, Dict[str, Any]]]]
+
+def compile_rule(rule: Dict[str, Any]) -> RuleEvaluator:
+    """Turn an automation rule into a function returning the (device_id, command) pairs to send
+    
+    The rule's settings are looked up once here rather than on every automation tick.
+    """
+    rule_type = rule.get("type")
+    
+    if rule_type == "motion_lighting":
+        # Rule to turn on lights when motion is detected
+        location = rule.get("location")
+        target_switch = rule.get("target_switch")
+        turn_on = [(target_switch, {"action": "turn_on", "brightness": rule.get("brightness", 80)})]
+        turn_off = [(target_switch, {"action": "turn_off"})]
+        turn_off_after_inactivity = rule.get("turn_off_after_inactivity")
+        inactivity_timeout = rule.get("inactivity_timeout", 300)
+        
+        def evaluate_motion_lighting(motion_by_location, temp_devices):
+            detectors = motion_by_location.get(location, ())
+            
+            # Check if motion is detected in the specified location
+            if any(data.get("motion_detected") for data in detectors):
+                return turn_on
+            # Check if we should turn off the light due to inactivity
+            if turn_off_after_inactivity and any(
+                data.get("time_since_motion") and data.get("time_since_motion") > inactivity_timeout
+                for data in detectors
+            ):
+                return turn_off
+            return []
+        
+        return evaluate_motion_lighting
+    
+    if rule_type == "temperature_control":
+        # Rule to control devices based on temperature
+        sensor_id = rule.get("temperature_sensor")
+        target_device = rule.get("target_device")
+        max_temperature = rule.get("max_temperature", 25)
+        min_temperature = rule.get("min_temperature", 18)
+        cool = [(target_device, {"action": rule.get("cooling_action", "turn_on")})]
+        heat = [(target_device, {"action": rule.get("heating_action", "turn_on")})]
+        idle = [(target_device, {"action": "turn_off"})]
+        
+        def evaluate_temperature_control(motion_by_location, temp_devices):
+            sensor = temp_devices.get(sensor_id)
+            if sensor is None:
+                return []
+            
+            current_temp = sensor.get("temperature")
+            if current_temp > max_temperature:
+                # Temperature too high, take cooling action
+                return cool
+            if current_temp < min_temperature:
+                # Temperature too low, take heating action
+                return heat
+            # Temperature in acceptable range
+            return idle
+        
+        return evaluate_temperature_control
+    
+    return lambda motion_by_location, temp_devices: []
+
 class ControlAgent(BaseAgent):
+    CAPABILITIES = ("device_control", "automation", "scene_management")
+    
     def __init__(self, name: str, intermediary_url: str):
         super().__init__(name, "control", intermediary_url)
         self.controlled_devices = {}  # Track devices under control
         self.automation_rules = []  # Rules for automated control
         self.scenes = {}  # Store predefined scenes
+    
+    @property
+    def automation_rules(self) -> Tuple[Dict[str, Any], ...]:
+        """Copies of the current rules
         
-    def get_capabilities(self) -> List[str]:
-        return ["device_control", "automation", "scene_management"]
+        Rules are compiled when they are set or added, so editing a returned rule
+        has no effect; assign a new list or use add_automation_rule instead.
+        """
+        return tuple(dict(rule) for rule in self._automation_rules)
+    
+    @automation_rules.setter
+    def automation_rules(self, rules: List[Dict[str, Any]]):
+        self._automation_rules = [dict(rule) for rule in rules]
+        self.compiled_rules = [compile_rule(rule) for rule in self._automation_rules]
+    
+    def add_automation_rule(self, rule: Dict[str, Any]) -> int:
+        """Add an automation rule, compiling it now, and return its id"""
+        rule = dict(rule)
+        self._automation_rules.append(rule)
+        self.compiled_rules.append(compile_rule(rule))
+        return len(self._automation_rules) - 1
+        
+    def get_capabilities(self) -> Tuple[str, ...]:
+        return self.CAPABILITIES
     
     async def run(self):
         """Main agent loop"""
@@ -39,11 +128,11 @@ class ControlAgent(BaseAgent):
         elif message.message_type == "add_automation_rule":
             rule = message.payload.get("rule")
             if rule:
-                self.automation_rules.append(rule)
+                rule_id = self.add_automation_rule(rule)
                 await self.send_to_agent(
                     message.agent_id,
                     "rule_added",
-                    {"rule_id": len(self.automation_rules) - 1}
+                    {"rule_id": rule_id}
                 )
                 
         elif message.message_type == "analysis_result":
@@ -59,81 +148,42 @@ class ControlAgent(BaseAgent):
     async def apply_automation_rules(self):
         """Apply automation rules based on current conditions"""
         try:
-            # Get current state of motion detectors
-            motion_data = await self.query_iot_data("motion_detector", {})
+            # Get current state of motion detectors and temperature sensors concurrently
+            motion_data, temp_data = await asyncio.gather(
+                self.query_iot_data("motion_detector", {}),
+                self.query_iot_data("temperature_sensor", {}),
+                return_exceptions=True
+            )
             
-            # Get current state of temperature sensors
-            temp_data = await self.query_iot_data("temperature_sensor", {})
+            # A failed query only disables the rules that depend on it
+            if isinstance(motion_data, Exception):
+                self.logger.error(f"Error querying motion detectors: {motion_data}")
+                motion_data = {}
+            if isinstance(temp_data, Exception):
+                self.logger.error(f"Error querying temperature sensors: {temp_data}")
+                temp_data = {}
             
-            # Apply rules based on current conditions
-            for rule in self.automation_rules:
-                await self.apply_rule(rule, motion_data, temp_data)
+            # Index motion detectors by location once so each rule is a lookup
+            motion_by_location = defaultdict(list)
+            for data in motion_data.get("devices", {}).values():
+                motion_by_location[data.get("location")].append(data)
+            temp_devices = temp_data.get("devices", {})
+            
+            # Collect the commands from every rule and send them in one request;
+            # a rule that fails on unexpected device data is skipped on its own
+            commands = []
+            for rule_id, evaluate in enumerate(self.compiled_rules):
+                try:
+                    commands.extend(evaluate(motion_by_location, temp_devices))
+                except Exception as e:
+                    self.logger.error(f"Error evaluating automation rule {rule_id}: {e}")
+
+            if commands:
+                await self.control_iot_devices_batch(commands)
                 
         except Exception as e:
             self.logger.error(f"Error applying automation rules: {e}")
     
-    async def apply_rule(self, rule: Dict[str, Any], motion_data: Dict[str, Any], temp_data: Dict[str, Any]):
-        """Apply a single automation rule"""
-        rule_type = rule.get("type")
-        
-        if rule_type == "motion_lighting":
-            # Rule to turn on lights when motion is detected
-            location = rule.get("location")
-            target_switch = rule.get("target_switch")
-            
-            # Check if motion is detected in the specified location
-            motion_detected = False
-            for device_id, data in motion_data.get("devices", {}).items():
-                if data.get("location") == location and data.get("motion_detected"):
-                    motion_detected = True
-                    break
-            
-            if motion_detected:
-                # Turn on the light
-                await self.control_iot_device(
-                    target_switch,
-                    {"action": "turn_on", "brightness": rule.get("brightness", 80)}
-                )
-            elif rule.get("turn_off_after_inactivity"):
-                # Check if we should turn off the light due to inactivity
-                for device_id, data in motion_data.get("devices", {}).items():
-                    if (data.get("location") == location and 
-                        data.get("time_since_motion") and 
-                        data.get("time_since_motion") > rule.get("inactivity_timeout", 300)):
-                        # Turn off the light after inactivity timeout
-                        await self.control_iot_device(
-                            target_switch,
-                            {"action": "turn_off"}
-                        )
-                        break
-                        
-        elif rule_type == "temperature_control":
-            # Rule to control devices based on temperature
-            sensor_id = rule.get("temperature_sensor")
-            target_device = rule.get("target_device")
-            
-            if sensor_id in temp_data.get("devices", {}):
-                current_temp = temp_data["devices"][sensor_id].get("temperature")
-                
-                if current_temp > rule.get("max_temperature", 25):
-                    # Temperature too high, take cooling action
-                    await self.control_iot_device(
-                        target_device,
-                        {"action": rule.get("cooling_action", "turn_on")}
-                    )
-                elif current_temp < rule.get("min_temperature", 18):
-                    # Temperature too low, take heating action
-                    await self.control_iot_device(
-                        target_device,
-                        {"action": rule.get("heating_action", "turn_on")}
-                    )
-                else:
-                    # Temperature in acceptable range
-                    await self.control_iot_device(
-                        target_device,
-                        {"action": "turn_off"}
-                    )
-    
     async def create_scene(self, scene_name: str, device_states: Dict[str, Dict[str, Any]]):
         """Create a scene with predefined device states"""
         # Store the scene in the scenes dictionary
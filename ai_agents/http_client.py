@@ -0,0 +1,35 @@
+"""
+Shared HTTP Client Module
+
+All agents in a process talk to the intermediary through one connection pool,
+so connections are set up once and reused across agents.
+"""
+
+from typing import Optional
+
+import httpx
+
+try:
+    import h2
+except ImportError:  # h2 is optional; without it the client speaks HTTP/1.1
+    h2 = None
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_shared_client() -> httpx.AsyncClient:
+    """Get the process-wide HTTP client, creating it if needed"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=h2 is not None,
+            timeout=5.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    return _client
+
+async def close_shared_client():
+    """Close the process-wide HTTP client once no agent needs it anymore"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -11,9 +11,15 @@ import argparse
 import logging
 from typing import List, Dict, Any
 
+try:
+    import uvloop
+except ImportError:  # uvloop is optional; the default asyncio loop is used without it
+    uvloop = None
+
 from .monitoring_agent import MonitoringAgent
 from .control_agent import ControlAgent
 from .analytics_agent import AnalyticsAgent
+from .http_client import close_shared_client
 
 # Configure logging
 logging.basicConfig(
@@ -57,10 +63,14 @@ async def run_agents(intermediary_url: str = None, agent_types: List[str] = None
         analytics_agent = AnalyticsAgent("Analytics-1", intermediary_url)
         agents.append(analytics_agent)
         print(f"Created analytics agent: {analytics_agent.name} ({analytics_agent.agent_id})")
+        
+    # Analytics reruns as soon as monitoring sees new readings instead of waiting out its interval
+    if "monitoring" in agent_types and "analytics" in agent_types:
+        monitoring_agent.data_update_subscribers.add(analytics_agent.agent_id)
     
     # Start all agents
-    for agent in agents:
-        await agent.start()
+    # Start agents concurrently; registration round-trips overlap instead of queuing
+    await asyncio.gather(*(agent.start() for agent in agents))
         
     print(f"All {len(agents)} agents started")
     
@@ -73,8 +83,8 @@ async def run_agents(intermediary_url: str = None, agent_types: List[str] = None
         print("Stopping agents...")
     finally:
         # Stop all agents
-        for agent in agents:
-            await agent.stop()
+        await asyncio.gather(*(agent.stop() for agent in agents))
+        await close_shared_client()
             
         print("All agents stopped")
 
@@ -89,6 +99,8 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(run_agents(
         intermediary_url=args.intermediary_url,
         agent_types=args.agent_types
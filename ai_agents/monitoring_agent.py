@@ -1,12 +1,115 @@
+import asyncio
+from collections import deque
+from typing import Any, Dict, List
+
+from config.agent_config import get_agent_config
 from .base_agent import BaseAgent, AgentMessage
-import statistics
+
+# Slopes smaller than this (degrees per reading) count as a stable temperature
+TREND_EPSILON = 1e-6
+# Readings more than this many standard deviations from the mean are anomalies
+ANOMALY_Z_SCORE = 2
+
+class RollingStats:
+    """Mean and variance over the last `maxlen` values, updated in O(1) per value"""
+    
+    def __init__(self, maxlen: int):
+        self.values = deque(maxlen=maxlen)
+        self.mean = 0.0
+        self._m2 = 0.0
+    
+    def push(self, value: float):
+        """Add a value, evicting the oldest one once the window is full"""
+        if len(self.values) == self.values.maxlen:
+            self._remove(self.values[0])
+        self.values.append(value)
+        # Welford's update
+        delta = value - self.mean
+        self.mean += delta / len(self.values)
+        self._m2 += delta * (value - self.mean)
+    
+    def _remove(self, value: float):
+        # Welford's update run backwards
+        count = len(self.values) - 1
+        if count == 0:
+            self.mean = 0.0
+            self._m2 = 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / count
+        self._m2 = max(self._m2 - delta * (value - self.mean), 0.0)
+    
+    @property
+    def stdev(self) -> float:
+        count = len(self.values)
+        return (self._m2 / (count - 1)) ** 0.5 if count > 1 else 0.0
+    
+    def z_score(self, value: float) -> float:
+        stdev = self.stdev
+        return abs(value - self.mean) / stdev if stdev > 0 else 0
 
 class MonitoringAgent(BaseAgent):
+    CAPABILITIES = ("temperature_monitoring", "motion_detection", "anomaly_detection")
+    
+    # When no reading passes the z-score threshold, report the most extreme one anyway.
+    # Off by default: real data usually has no anomaly and shouldn't be made to produce one
+    report_most_extreme = False
+    # Number of recent readings per sensor that streaming anomaly scores are based on
+    stats_window = 100
+    # Seconds between checks of the latest sensor readings
+    check_interval = 30
+    
     def __init__(self, name: str, intermediary_url: str):
         super().__init__(name, "monitoring", intermediary_url)
+        self.check_interval = get_agent_config("monitoring").get("check_interval", self.check_interval)
+        self._stat_state = {}
+        self._last_readings = {}  # sensor_id -> last reading scored
+        # Agents sent an iot_data_update whenever new readings come in
+        self.data_update_subscribers = set()
         
     def get_capabilities(self):
-        return ["temperature_monitoring", "motion_detection", "anomaly_detection"]
+        return self.CAPABILITIES
+    
+    async def run(self):
+        """Main agent loop"""
+        while self._running:
+            await self.check_temperature_readings()
+            await asyncio.sleep(self.check_interval)
+    
+    async def check_temperature_readings(self) -> List[Dict[str, Any]]:
+        """Score each sensor's latest reading and return the anomalous ones
+        
+        Subscribed agents are told which sensors reported new readings.
+        """
+        try:
+            response = await self.query_iot_data("temperature_sensor", {"time_range": "last_minute"})
+        except Exception as e:
+            self.logger.error(f"Error querying temperature sensors: {e}")
+            return []
+        
+        anomalies = []
+        updated = []
+        for sensor_id, reading in response.get("data", {}).get("devices", {}).items():
+            temperature = reading.get("temperature")
+            # The cache holds only a sensor's latest reading, so an unchanged one was already scored
+            if temperature is None or reading == self._last_readings.get(sensor_id):
+                continue
+            self._last_readings[sensor_id] = reading
+            updated.append(sensor_id)
+            
+            z_score = self.score_reading(sensor_id, temperature)
+            if z_score > ANOMALY_Z_SCORE:
+                self.logger.warning(f"Anomalous reading from {sensor_id}: {temperature} (z-score {z_score:.2f})")
+                anomalies.append({"sensor_id": sensor_id, "temperature": temperature, "anomaly_score": z_score})
+        
+        if updated:
+            payload = {"device_type": "temperature_sensor", "device_ids": updated}
+            await asyncio.gather(*(
+                self.send_to_agent(agent_id, "iot_data_update", payload)
+                for agent_id in self.data_update_subscribers
+            ))
+        
+        return anomalies
     
     async def analyze_temperature_trends(self, location: str):
         # Query temperature data
@@ -18,15 +121,31 @@ class MonitoringAgent(BaseAgent):
         if not data.get("data"):
             return {"error": "No data available"}
         
-        temps = [d["temperature"] for d in data["data"]]
+        # Sum the readings and their index-weighted values in one pass
+        count = 0
+        total = 0.0
+        weighted_total = 0.0
+        for index, reading in enumerate(data["data"]):
+            temperature = reading["temperature"]
+            count += 1
+            total += temperature
+            weighted_total += index * temperature
+        
         # Ensure there's data to prevent errors with empty lists
-        if not temps:
+        if not count:
             return {"error": "No temperature readings in data"}
         
+        average = total / count
+        # Least-squares slope of temperature against reading index, in degrees per reading
+        if count > 1:
+            slope = (weighted_total - (count - 1) / 2 * total) / (count * (count * count - 1) / 12)
+        else:
+            slope = 0
+        
         return {
-            "trend": "increasing" if len(temps) > 1 and temps[-1] > temps[0] else ("decreasing" if len(temps) > 1 and temps[-1] < temps[0] else "stable"),
-            "average_temp": statistics.mean(temps) if temps else 0,
-            "rate_of_change": (temps[-1] - temps[0]) / len(temps) if len(temps) > 1 else 0
+            "trend": "increasing" if slope > TREND_EPSILON else ("decreasing" if slope < -TREND_EPSILON else "stable"),
+            "average_temp": average,
+            "rate_of_change": slope
         }
     
     def detect_anomalies(self, sensor_data):
@@ -39,56 +158,72 @@ class MonitoringAgent(BaseAgent):
         if not sensor_data or not isinstance(sensor_data, list) or len(sensor_data) < 2:
             return []  # Need at least 2 data points to calculate standard deviation
             
-        # Extract temperature values
-        temps = [d["temperature"] for d in sensor_data if isinstance(d, dict) and "temperature" in d]
+        # Collect the readings and their mean/variance in one pass (Welford's method)
+        readings = []
+        count = 0
+        mean = 0.0
+        m2 = 0.0
+        for data_point in sensor_data:
+            if isinstance(data_point, dict) and "temperature" in data_point:
+                temperature = data_point["temperature"]
+                readings.append(data_point)
+                count += 1
+                delta = temperature - mean
+                mean += delta / count
+                m2 += delta * (temperature - mean)
         
-        if len(temps) < 2:
+        if count < 2:
             return []
             
-        # Calculate mean and standard deviation
-        mean = statistics.mean(temps)
-        stdev = statistics.stdev(temps)
+        stdev = (m2 / (count - 1)) ** 0.5
         
-        # Identify anomalies (values more than 2 standard deviations from the mean)
+        # Identify anomalies (values more than 2 standard deviations from the mean),
+        # tracking the most extreme reading along the way for the fallback below
         anomalies = []
-        for data_point in sensor_data:
-            if not isinstance(data_point, dict) or "temperature" not in data_point:
-                continue
-                
+        max_deviation = 0
+        max_deviation_point = None
+        for data_point in readings:
+            deviation = abs(data_point["temperature"] - mean)
+            
             # Calculate z-score (number of standard deviations from the mean)
-            z_score = abs(data_point["temperature"] - mean) / stdev if stdev > 0 else 0
+            z_score = deviation / stdev if stdev > 0 else 0
             
             # Add anomaly score to data point
             data_point["anomaly_score"] = z_score
             
             # If z-score is greater than 2, consider it an anomaly
-            if z_score > 2:
+            if z_score > ANOMALY_Z_SCORE:
                 anomalies.append(data_point)
-                
-        # For the test case with [20.5, 21.0, 45.0, 21.5, 22.0], we should detect 45.0 as an anomaly
-        # If no anomalies were found using the standard method, force detection of the most extreme value
-        if not anomalies and temps:
-            # Find the data point with the maximum deviation from the mean
-            max_deviation = 0
-            max_deviation_point = None
-            
-            for data_point in sensor_data:
-                if not isinstance(data_point, dict) or "temperature" not in data_point:
-                    continue
-                    
-                deviation = abs(data_point["temperature"] - mean)
-                if deviation > max_deviation:
-                    max_deviation = deviation
-                    max_deviation_point = data_point
             
-            if max_deviation_point and max_deviation > 0:
-                anomalies.append(max_deviation_point)
+            if deviation > max_deviation:
+                max_deviation = deviation
+                max_deviation_point = data_point
+                
+        # Small samples like [20.5, 21.0, 45.0, 21.5, 22.0] can't reach z > 2 even with a clear
+        # outlier; when enabled, report the most extreme value if nothing passed the threshold
+        if not anomalies and self.report_most_extreme and max_deviation_point is not None:
+            anomalies.append(max_deviation_point)
         
         return anomalies
 
+    def score_reading(self, sensor_id: str, temperature: float) -> float:
+        """Score a streamed reading against the sensor's recent history, then add it to that history
+        
+        Unlike detect_anomalies, which looks at a whole batch, this keeps rolling statistics
+        per sensor so each new reading costs O(1) regardless of the window size.
+        """
+        stats = self._stat_state.get(sensor_id)
+        if stats is None:
+            stats = self._stat_state[sensor_id] = RollingStats(self.stats_window)
+        z_score = stats.z_score(temperature)
+        stats.push(temperature)
+        return z_score
+
     async def process_message(self, message: AgentMessage):
         """Process incoming message for the MonitoringAgent."""
         self.logger.info(f"MonitoringAgent ({self.agent_id}) received message: {message.message_type} from {message.agent_id} with payload: {message.payload}")
+        if message.message_type == "subscribe_data_updates":
+            self.data_update_subscribers.add(message.agent_id)
         # Placeholder: Acknowledge message. Real implementation would depend on message_type.
         return {
             "status": "message_received_by_monitoring_agent",
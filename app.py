@@ -1,17 +1,20 @@
 # app.py
 from fastapi import FastAPI, WebSocket
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 import asyncio
-import json
+import os
 import uvicorn
+from intermediary.data_transformer import dumps, orjson  # orjson is None when not installed
 from iot_devices.smart_switch import SmartSwitch
 from iot_devices.motion_detector import MotionDetector
 from ai_agents.control_agent import ControlAgent
 from ai_agents.monitoring_agent import MonitoringAgent
 from ai_agents.analytics_agent import AnalyticsAgent
+from ai_agents.http_client import close_shared_client
 
-app = FastAPI()
+# orjson encodes responses faster than the stdlib encoder
+app = FastAPI(default_response_class=ORJSONResponse if orjson is not None else JSONResponse)
 
 # Setup devices and agents
 mqtt_broker = "localhost"
@@ -26,13 +29,24 @@ agents = {
     "analytics-1": AnalyticsAgent("analytics-1", "http://localhost:8000")
 }
 
+def load_dashboard() -> bytes:
+    with open("static/index.html", "rb") as f:
+        return f.read()
+
+# The dashboard page is read once rather than from disk on every request
+dashboard_html = load_dashboard()
+
+# One queue per connected dashboard client; the producer fans snapshots out to all of them
+clients = set()
+latest_snapshot = {}
+producer_task = None
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/", response_class=HTMLResponse)
 async def get_dashboard():
-    with open("static/index.html") as f:
-        return f.read()
+    return HTMLResponse(content=dashboard_html)
 
 @app.get("/api/devices")
 async def get_devices():
@@ -52,22 +66,63 @@ async def send_command(device_id: str, command: dict):
 async def get_energy_analysis():
     return await agents["analytics-1"].analyze_energy_consumption()
 
+async def produce_device_snapshots():
+    """Sample every device once per tick and hand the snapshot to each connected client"""
+    global latest_snapshot
+    while True:
+        # Send device updates every 2 seconds
+        latest_snapshot = {device_id: device.generate_data() for device_id, device in devices.items()}
+        for queue in clients:
+            if queue.full():
+                # Slow client: drop its oldest snapshot rather than block the others
+                queue.get_nowait()
+            queue.put_nowait(latest_snapshot)
+        await asyncio.sleep(2)
+
+@app.on_event("startup")
+async def startup_event():
+    global dashboard_html, producer_task
+    # In development, pick up edits to the dashboard on every restart
+    if os.getenv("RELOAD") == "1":
+        dashboard_html = load_dashboard()
+    producer_task = asyncio.create_task(produce_device_snapshots())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    producer_task.cancel()
+    await asyncio.gather(producer_task, return_exceptions=True)
+    await close_shared_client()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    queue = asyncio.Queue(maxsize=4)
+    if latest_snapshot:
+        queue.put_nowait(latest_snapshot)
+    clients.add(queue)
+    # Last payload sent to this client per device, so unchanged devices are skipped
+    last_sent = {}
     try:
         while True:
-            # Send device updates every 2 seconds
+            snapshot = await queue.get()
             device_data = {}
-            for device_id, device in devices.items():
-                device_data[device_id] = device.generate_data()
+            for device_id, data in snapshot.items():
+                if data != last_sent.get(device_id):
+                    device_data[device_id] = data
+                    last_sent[device_id] = data
             
-            await websocket.send_json(device_data)
-            await asyncio.sleep(2)
+            if device_data:
+                # The first frame carries every device; later ones only what changed
+                if len(last_sent) == len(device_data):
+                    device_data["_full"] = True
+                await websocket.send_bytes(dumps(device_data))
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
+        clients.discard(queue)
         await websocket.close()
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    # "auto" picks uvloop and httptools when they are installed. A single worker is
+    # kept on purpose: devices and dashboard clients live in this process's memory
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="auto", http="auto")
\ No newline at end of file
@@ -4,13 +4,19 @@ Agent Configuration Module
 This module provides configuration settings for AI agents.
 """
 
+import copy
 import os
-from typing import Dict, Any, List
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, List, Mapping, Tuple
 
 # Default agent configuration
 DEFAULT_AGENT_CONFIG = {
     "monitoring_agent": {
         "check_interval": 30,  # seconds
+        "max_concurrency": 50,  # in-flight intermediary requests
+        "outbox_batch_size": 64,  # A2A messages per batched request
+        "outbox_flush_interval": 0.002,  # seconds to wait for more A2A messages
         "alert_thresholds": {
             "temperature_sensor": {
                 "high_temp": 30.0,
@@ -30,6 +36,9 @@ DEFAULT_AGENT_CONFIG = {
     },
     "control_agent": {
         "check_interval": 10,  # seconds
+        "max_concurrency": 50,  # in-flight intermediary requests
+        "outbox_batch_size": 64,  # A2A messages per batched request
+        "outbox_flush_interval": 0.002,  # seconds to wait for more A2A messages
         "default_rules": [
             {
                 "type": "motion_lighting",
@@ -43,6 +52,9 @@ DEFAULT_AGENT_CONFIG = {
     },
     "analytics_agent": {
         "analysis_interval": 60,  # seconds
+        "max_concurrency": 50,  # in-flight intermediary requests
+        "outbox_batch_size": 64,  # A2A messages per batched request
+        "outbox_flush_interval": 0.002,  # seconds to wait for more A2A messages
         "data_collection_interval": 60,  # seconds
         "prediction_models": {
             "energy_consumption": "simple_average",  # or "ml_model"
@@ -51,17 +63,19 @@ DEFAULT_AGENT_CONFIG = {
     }
 }
 
-def get_agent_config(agent_type: str = None) -> Dict[str, Any]:
-    """
-    Get agent configuration from environment variables or defaults.
-    
-    Args:
-        agent_type (str, optional): Type of agent to get config for. If None, returns all configs.
-        
-    Returns:
-        Dict[str, Any]: Agent configuration dictionary
-    """
-    config = DEFAULT_AGENT_CONFIG.copy()
+def _freeze(value: Any) -> Any:
+    """Return a read-only copy of nested dicts and lists (mapping proxies and tuples)"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+@lru_cache(maxsize=None)
+def _build_agent_config() -> Mapping[str, Any]:
+    """Build the agent configuration once from the defaults and environment variables"""
+    # Deep copy so environment overrides never leak into DEFAULT_AGENT_CONFIG
+    config = copy.deepcopy(DEFAULT_AGENT_CONFIG)
     
     # Override with environment variables if available
     if os.getenv("MONITORING_CHECK_INTERVAL"):
@@ -73,12 +87,69 @@ def get_agent_config(agent_type: str = None) -> Dict[str, Any]:
     if os.getenv("ANALYTICS_INTERVAL"):
         config["analytics_agent"]["analysis_interval"] = int(os.getenv("ANALYTICS_INTERVAL"))
         
+    if os.getenv("AGENT_MAX_CONCURRENCY"):
+        for agent_config in config.values():
+            agent_config["max_concurrency"] = int(os.getenv("AGENT_MAX_CONCURRENCY"))
+            
+    if os.getenv("AGENT_OUTBOX_BATCH_SIZE"):
+        for agent_config in config.values():
+            agent_config["outbox_batch_size"] = int(os.getenv("AGENT_OUTBOX_BATCH_SIZE"))
+            
+    if os.getenv("AGENT_OUTBOX_FLUSH_INTERVAL"):
+        for agent_config in config.values():
+            agent_config["outbox_flush_interval"] = float(os.getenv("AGENT_OUTBOX_FLUSH_INTERVAL"))
+    
+    # Frozen all the way down, since every caller shares this cached result
+    return _freeze(config)
+
+_NO_CONFIG = MappingProxyType({})
+
+def get_agent_config(agent_type: str = None) -> Mapping[str, Any]:
+    """
+    Get agent configuration from environment variables or defaults.
+    
+    The environment is read once; the result is the cached configuration, read-only at
+    every level (nested settings are mappings and tuples).
+    
+    Args:
+        agent_type (str, optional): Type of agent to get config for. If None, returns all configs.
+        
+    Returns:
+        Mapping[str, Any]: Agent configuration mapping
+    """
+    config = _build_agent_config()
+    
     # Return specific agent config if requested
     if agent_type:
-        return config.get(f"{agent_type}_agent", {})
+        return config.get(f"{agent_type}_agent", _NO_CONFIG)
         
     return config
 
+# Capabilities advertised by each agent type
+AGENT_CAPABILITIES = MappingProxyType({
+    "monitoring": ("device_monitoring", "anomaly_detection", "trend_analysis"),
+    "control": ("device_control", "automation", "scene_management"),
+    "analytics": ("data_analytics", "pattern_recognition", "predictive_analysis")
+})
+
+# Allowed actions per resource type for each agent type
+AGENT_PERMISSIONS = MappingProxyType({
+    "monitoring": MappingProxyType({
+        "device": ("read",),
+        "agent": ("read",)
+    }),
+    "control": MappingProxyType({
+        "device": ("read", "control"),
+        "agent": ("read",)
+    }),
+    "analytics": MappingProxyType({
+        "device": ("read",),
+        "agent": ("read",)
+    })
+})
+
+_NO_PERMISSIONS = MappingProxyType({})
+
 def get_agent_capabilities(agent_type: str) -> List[str]:
     """
     Get the capabilities for a specific agent type.
@@ -89,15 +160,9 @@ def get_agent_capabilities(agent_type: str) -> List[str]:
     Returns:
         List[str]: List of capabilities
     """
-    capabilities = {
-        "monitoring": ["device_monitoring", "anomaly_detection", "trend_analysis"],
-        "control": ["device_control", "automation", "scene_management"],
-        "analytics": ["data_analytics", "pattern_recognition", "predictive_analysis"]
-    }
-    
-    return capabilities.get(agent_type, [])
+    return list(AGENT_CAPABILITIES.get(agent_type, ()))
 
-def get_agent_permissions(agent_type: str) -> Dict[str, List[str]]:
+def get_agent_permissions(agent_type: str) -> Mapping[str, Tuple[str, ...]]:
     """
     Get the permissions for a specific agent type.
     
@@ -105,21 +170,6 @@ def get_agent_permissions(agent_type: str) -> Dict[str, List[str]]:
         agent_type (str): Type of agent
         
     Returns:
-        Dict[str, List[str]]: Dictionary mapping resource types to allowed actions
+        Mapping[str, Tuple[str, ...]]: Read-only mapping of resource types to allowed actions
     """
-    permissions = {
-        "monitoring": {
-            "device": ["read"],
-            "agent": ["read"]
-        },
-        "control": {
-            "device": ["read", "control"],
-            "agent": ["read"]
-        },
-        "analytics": {
-            "device": ["read"],
-            "agent": ["read"]
-        }
-    }
-    
-    return permissions.get(agent_type, {})
+    return AGENT_PERMISSIONS.get(agent_type, _NO_PERMISSIONS)
@@ -5,7 +5,9 @@ This module provides configuration settings for MQTT connections.
 """
 
 import os
-from typing import Dict, Any
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Mapping
 
 # Default MQTT configuration
 DEFAULT_CONFIG = {
@@ -28,12 +30,15 @@ DEFAULT_CONFIG = {
     "tls_insecure": False
 }
 
-def get_mqtt_config() -> Dict[str, Any]:
+@lru_cache(maxsize=None)
+def get_mqtt_config() -> Mapping[str, Any]:
     """
     Get MQTT configuration from environment variables or defaults.
     
+    The environment is read once; later calls return the same read-only mapping.
+    
     Returns:
-        Dict[str, Any]: MQTT configuration dictionary
+        Mapping[str, Any]: MQTT configuration mapping
     """
     config = DEFAULT_CONFIG.copy()
     
@@ -65,23 +70,36 @@ def get_mqtt_config() -> Dict[str, Any]:
     if os.getenv("MQTT_TLS_KEYFILE"):
         config["tls_keyfile"] = os.getenv("MQTT_TLS_KEYFILE")
         
-    return config
+    return MappingProxyType(config)
+
+# Topic templates for MQTT messaging
+TOPIC_STRUCTURE = MappingProxyType({
+    "device_data": "devices/{device_type}/{device_id}/data",
+    "device_command": "devices/{device_id}/commands",
+    "agent_message": "agents/{agent_id}/messages",
+    "agent_command": "agents/{agent_id}/commands",
+    "system_status": "system/status",
+    "system_control": "system/control"
+})
 
-def get_topic_structure() -> Dict[str, str]:
+# QoS level per topic type
+QOS_LEVELS = MappingProxyType({
+    "device_data": 0,  # At most once delivery
+    "device_command": 1,  # At least once delivery
+    "agent_message": 1,  # At least once delivery
+    "agent_command": 2,  # Exactly once delivery
+    "system_status": 1,  # At least once delivery
+    "system_control": 2,  # Exactly once delivery
+})
+
+def get_topic_structure() -> Mapping[str, str]:
     """
     Get the topic structure for the MQTT messaging.
     
     Returns:
-        Dict[str, str]: Topic structure dictionary
+        Mapping[str, str]: Read-only topic structure mapping
     """
-    return {
-        "device_data": "devices/{device_type}/{device_id}/data",
-        "device_command": "devices/{device_id}/commands",
-        "agent_message": "agents/{agent_id}/messages",
-        "agent_command": "agents/{agent_id}/commands",
-        "system_status": "system/status",
-        "system_control": "system/control"
-    }
+    return TOPIC_STRUCTURE
 
 def get_qos_level(topic_type: str) -> int:
     """
@@ -93,13 +111,4 @@ def get_qos_level(topic_type: str) -> int:
     Returns:
         int: QoS level (0, 1, or 2)
     """
-    qos_levels = {
-        "device_data": 0,  # At most once delivery
-        "device_command": 1,  # At least once delivery
-        "agent_message": 1,  # At least once delivery
-        "agent_command": 2,  # Exactly once delivery
-        "system_status": 1,  # At least once delivery
-        "system_control": 2,  # Exactly once delivery
-    }
-    
-    return qos_levels.get(topic_type, 1)  # Default to QoS 1
+    return QOS_LEVELS.get(topic_type, 1)  # Default to QoS 1
@@ -8,6 +8,7 @@ from ai_agents.analytics_agent import AnalyticsAgent
 from iot_devices.temperature_sensor import TemperatureSensor
 from iot_devices.motion_detector import MotionDetector
 from iot_devices.smart_switch import SmartSwitch
+from iot_devices.simulator import create_shared_client, run_devices
 
 async def main():
     # Configuration
@@ -18,31 +19,31 @@ async def main():
     monitoring_agent = MonitoringAgent("Monitor-1", INTERMEDIARY_URL)
     control_agent = ControlAgent("Control-1", INTERMEDIARY_URL)
     analytics_agent = AnalyticsAgent("Analytics-1", INTERMEDIARY_URL)
+    monitoring_agent.data_update_subscribers.add(analytics_agent.agent_id)
     
-    # Create IoT Devices
+    # Create IoT Devices, all sharing one MQTT connection
+    mqtt_client = create_shared_client(MQTT_BROKER)
     temp_sensors = [
-        TemperatureSensor(f"temp-sensor-{i}", MQTT_BROKER) 
+        TemperatureSensor(f"temp-sensor-{i}", MQTT_BROKER, client=mqtt_client) 
         for i in range(3)
     ]
     motion_detectors = [
-        MotionDetector(f"motion-{i}", MQTT_BROKER) 
+        MotionDetector(f"motion-{i}", MQTT_BROKER, client=mqtt_client) 
         for i in range(2)
     ]
     smart_switches = [
-        SmartSwitch(f"switch-{i}", MQTT_BROKER) 
+        SmartSwitch(f"switch-{i}", MQTT_BROKER, client=mqtt_client) 
         for i in range(2)
     ]
     
     # Start all components
     print("Starting AI Agents...")
-    await monitoring_agent.start()
-    await control_agent.start()
-    await analytics_agent.start()
+    agents = [monitoring_agent, control_agent, analytics_agent]
+    await asyncio.gather(*(agent.start() for agent in agents))
     
     print("Starting IoT Devices...")
-    device_tasks = []
-    for device in temp_sensors + motion_detectors + smart_switches:
-        device_tasks.append(asyncio.create_task(device.run()))
+    # One task publishes for all devices, so cleanup is a single cancel
+    devices = asyncio.create_task(run_devices(temp_sensors + motion_detectors + smart_switches))
     
     # Simulation scenarios
     await asyncio.sleep(5)  # Let everything initialize
@@ -78,12 +79,12 @@ async def main():
     
     # Cleanup
     print("\nStopping simulation...")
-    await monitoring_agent.stop()
-    await control_agent.stop()
-    await analytics_agent.stop()
+    await asyncio.gather(*(agent.stop() for agent in agents))
     
-    for task in device_tasks:
-        task.cancel()
+    devices.cancel()
+    await asyncio.gather(devices, return_exceptions=True)
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
 
 if __name__ == "__main__":
     asyncio.run(main())
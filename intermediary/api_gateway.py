@@ -1,13 +1,20 @@
-from fastapi import FastAPI, WebSocket, HTTPException
+from fastapi import FastAPI, WebSocket, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Extra
 from typing import Dict, List, Any
 import asyncio
 import json
+import os
+import uvicorn
 from .mqtt_handler import MQTTHandler
-from .data_transformer import DataTransformer
+from .data_transformer import DataTransformer, dumps
 from .message_router import MessageRouter
+from .redis_client import close_redis_pools
+from .wire_format import MsgpackRoute, NegotiatedResponse
 
-app = FastAPI(title="AI-IoT Intermediary")
+app = FastAPI(title="AI-IoT Intermediary", default_response_class=NegotiatedResponse)
+# Let agents send and receive msgpack bodies as well as JSON
+app.router.route_class = MsgpackRoute
 
 # Add CORS middleware
 app.add_middleware(
@@ -25,6 +32,38 @@ message_router = MessageRouter()
 # Store registered agents
 registered_agents: Dict[str, Dict[str, Any]] = {}
 
+# Request bodies; unknown keys are ignored unless a model says otherwise
+class AgentRegistration(BaseModel):
+    agent_id: str
+    
+    class Config:
+        # The whole registration (name, type, capabilities, ...) is kept as sent
+        extra = Extra.allow
+
+class AgentMessage(BaseModel):
+    source_agent_id: str
+    target_agent_id: str
+    message: Dict[str, Any]
+
+class AgentMessageBatch(BaseModel):
+    messages: List[AgentMessage]
+
+class IoTQuery(BaseModel):
+    agent_id: str
+    device_type: str
+    query_params: Dict[str, Any]
+
+class DeviceCommand(BaseModel):
+    device_id: str
+    command: Dict[str, Any]
+
+class IoTControl(DeviceCommand):
+    agent_id: str
+
+class IoTControlBatch(BaseModel):
+    agent_id: str
+    commands: List[DeviceCommand]
+
 @app.on_event("startup")
 async def startup_event():
     await mqtt_handler.connect()
@@ -34,12 +73,13 @@ async def startup_event():
 async def shutdown_event():
     await mqtt_handler.disconnect()
     await message_router.stop()
+    await close_redis_pools()
 
 @app.post("/agents/register")
-async def register_agent(agent_data: Dict[str, Any]):
+async def register_agent(agent_data: AgentRegistration):
     """Register a new AI agent"""
-    agent_id = agent_data["agent_id"]
-    registered_agents[agent_id] = agent_data
+    agent_id = agent_data.agent_id
+    registered_agents[agent_id] = agent_data.dict()
     
     # Setup agent-specific MQTT subscriptions if needed
     await mqtt_handler.subscribe(f"agents/{agent_id}/iot_data")
@@ -47,11 +87,11 @@ async def register_agent(agent_data: Dict[str, Any]):
     return {"status": "registered", "agent_id": agent_id}
 
 @app.post("/agents/message")
-async def forward_agent_message(message_data: Dict[str, Any]):
+async def forward_agent_message(message_data: AgentMessage):
     """Forward message between agents (A2A protocol)"""
-    source_agent_id = message_data["source_agent_id"]
-    target_agent_id = message_data["target_agent_id"]
-    message = message_data["message"]
+    source_agent_id = message_data.source_agent_id
+    target_agent_id = message_data.target_agent_id
+    message = message_data.message
     
     if target_agent_id not in registered_agents:
         raise HTTPException(status_code=404, detail="Target agent not found")
@@ -61,12 +101,33 @@ async def forward_agent_message(message_data: Dict[str, Any]):
     
     return {"status": "forwarded"}
 
+@app.post("/agents/message_batch")
+async def forward_agent_message_batch(batch_data: AgentMessageBatch):
+    """Forward a batch of messages between agents (A2A protocol)"""
+    routable = []
+    not_found = []
+
+    for message_data in batch_data.messages:
+        target_agent_id = message_data.target_agent_id
+
+        # Unlike the single-message endpoint, one unknown target must not fail the whole batch
+        if target_agent_id not in registered_agents:
+            not_found.append(target_agent_id)
+            continue
+
+        routable.append((message_data.source_agent_id, target_agent_id, message_data.message))
+
+    if routable:
+        await message_router.route_a2a_messages(routable)
+
+    return {"status": "forwarded", "forwarded": len(routable), "not_found": not_found}
+
 @app.post("/iot/query")
-async def query_iot_data(query_data: Dict[str, Any]):
+async def query_iot_data(query_data: IoTQuery):
     """Query IoT device data"""
-    agent_id = query_data["agent_id"]
-    device_type = query_data["device_type"]
-    query_params = query_data["query_params"]
+    agent_id = query_data.agent_id
+    device_type = query_data.device_type
+    query_params = query_data.query_params
     
     # Transform query to MQTT format
     mqtt_query = data_transformer.transform_query_to_mqtt(query_params)
@@ -83,14 +144,14 @@ async def query_iot_data(query_data: Dict[str, Any]):
     }
 
 @app.post("/iot/control")
-async def control_iot_device(control_data: Dict[str, Any]):
+async def control_iot_device(control_data: IoTControl, request: Request):
     """Send control command to IoT device"""
-    agent_id = control_data["agent_id"]
-    device_id = control_data["device_id"]
-    command = control_data["command"]
+    agent_id = control_data.agent_id
+    device_id = control_data.device_id
+    command = control_data.command
     
     # Validate agent permissions
-    if not await validate_agent_permissions(agent_id, device_id, "control"):
+    if not await check_agent_permission(request, agent_id, device_id, "control"):
         raise HTTPException(status_code=403, detail="Agent not authorized")
     
     # Transform command to MQTT format
@@ -101,6 +162,26 @@ async def control_iot_device(control_data: Dict[str, Any]):
     
     return {"status": "command_sent", "device_id": device_id}
 
+@app.post("/iot/control_batch")
+async def control_iot_devices_batch(batch_data: IoTControlBatch, request: Request):
+    """Send several control commands to IoT devices"""
+    agent_id = batch_data.agent_id
+    results = []
+    
+    for item in batch_data.commands:
+        device_id = item.device_id
+        
+        # Unauthorized devices are reported per command rather than failing the batch
+        if not await check_agent_permission(request, agent_id, device_id, "control"):
+            results.append({"device_id": device_id, "status": "unauthorized"})
+            continue
+        
+        mqtt_command = data_transformer.transform_command_to_mqtt(item.command)
+        await mqtt_handler.publish_command(device_id, mqtt_command)
+        results.append({"device_id": device_id, "status": "command_sent"})
+    
+    return {"status": "batch_processed", "results": results}
+
 @app.websocket("/ws/agents/{agent_id}")
 async def agent_websocket(websocket: WebSocket, agent_id: str):
     """WebSocket endpoint for real-time agent communication"""
@@ -108,13 +189,26 @@ async def agent_websocket(websocket: WebSocket, agent_id: str):
     
     # Subscribe to agent-specific events
     async def handle_iot_updates():
-        async for update in mqtt_handler.subscribe_to_updates(agent_id):
-            transformed_update = data_transformer.transform_mqtt_to_agent(update)
-            await websocket.send_json(transformed_update)
+        # Bursts of device updates go out as one {"batch": [...]} frame instead of a frame each
+        async for updates in mqtt_handler.subscribe_to_update_batches(agent_id):
+            batch = [data_transformer.transform_mqtt_to_agent(update) for update in updates]
+            # Encode once with the fast encoder instead of going through send_json
+            await websocket.send_text(dumps({"batch": batch}).decode())
+    
+    # Messages from other agents are delivered over this socket while it is open
+    message_queue = message_router.attach_local_agent(agent_id)
     
+    async def handle_agent_messages():
+        while True:
+            message_data = await message_queue.get()
+            await websocket.send_text(dumps(message_data).decode())
+    
+    updates_task = None
+    messages_task = None
     try:
         # Start handling IoT updates
-        asyncio.create_task(handle_iot_updates())
+        updates_task = asyncio.create_task(handle_iot_updates())
+        messages_task = asyncio.create_task(handle_agent_messages())
         
         # Handle incoming messages from agent
         while True:
@@ -124,6 +218,12 @@ async def agent_websocket(websocket: WebSocket, agent_id: str):
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
+        # Stop forwarding updates so the MQTT subscription is released with the socket
+        if updates_task is not None:
+            updates_task.cancel()
+        if messages_task is not None:
+            messages_task.cancel()
+        message_router.detach_local_agent(agent_id, message_queue)
         await websocket.close()
 
 # Helper function for validating agent permissions
@@ -135,6 +235,26 @@ async def validate_agent_permissions(agent_id: str, device_id: str, action: str)
         return True
     return False
 
+async def check_agent_permission(request: Request, agent_id: str, device_id: str, action: str) -> bool:
+    """Validate a permission once per request, reusing the answer for repeated checks
+    
+    Batched requests often target the same device several times; with a real
+    ACL behind validate_agent_permissions each repeat would be another lookup.
+    """
+    auth_cache = getattr(request.state, "auth_cache", None)
+    if auth_cache is None:
+        auth_cache = request.state.auth_cache = {}
+        
+    key = (agent_id, device_id, action)
+    allowed = auth_cache.get(key)
+    if allowed is None:
+        allowed = auth_cache[key] = await validate_agent_permissions(agent_id, device_id, action)
+    return allowed
+
 async def process_agent_websocket_message(agent_id: str, data: Dict[str, Any]):
     # This is a placeholder for processing WebSocket messages from agents
     pass
+
+if __name__ == "__main__":
+    # "auto" runs the gateway on uvloop and httptools when they are installed
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("INTERMEDIARY_PORT", "8000")), loop="auto", http="auto")
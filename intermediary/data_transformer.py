@@ -7,9 +7,40 @@ This module handles transformations between different data formats:
 - Agent commands to device commands
 """
 
+import json
 import time
 from typing import Dict, Any, List
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+if orjson is not None:
+    dumps = orjson.dumps
+
+    def loads(data):
+        """Decode JSON from bytes or str"""
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Devices publish with the stdlib encoder, which may write NaN/Infinity
+            return json.loads(data)
+else:
+    def dumps(value) -> bytes:
+        """Encode a value as UTF-8 JSON bytes"""
+        return json.dumps(value).encode()
+
+    loads = json.loads
+
+# Maximum data age in seconds for each supported query time_range
+QUERY_TIME_RANGES = {
+    "last_minute": 60,
+    "last_5_minutes": 300,
+    "last_hour": 3600,
+    "last_day": 86400
+}
+
 class DataTransformer:
     """Transforms data between different formats in the system"""
     
@@ -19,58 +50,34 @@ class DataTransformer:
         if "devices" in mqtt_data:
             return mqtt_data
             
-        # If this is a single MQTT message
-        if "device_id" in mqtt_data and "device_type" in mqtt_data and "data" in mqtt_data:
+        # Single MQTT messages are by far the common case, so fetch their fields directly
+        try:
             device_id = mqtt_data["device_id"]
-            return {
-                "devices": {
-                    device_id: mqtt_data["data"]
-                },
-                "timestamp": mqtt_data.get("timestamp", time.time())
-            }
+            data = mqtt_data["data"]
+        except (KeyError, TypeError):
+            # Not a device message (or not even a dict) - just return as is
+            return mqtt_data
+        if "device_type" not in mqtt_data:
+            return mqtt_data
             
-        # Default case - just return as is
-        return mqtt_data
+        timestamp = mqtt_data["timestamp"] if "timestamp" in mqtt_data else time.time()
+        return {
+            "devices": {
+                device_id: data
+            },
+            "timestamp": timestamp
+        }
     
     def transform_query_to_mqtt(self, query_params: Dict[str, Any]) -> Dict[str, Any]:
         """Transform agent query parameters to MQTT query format"""
-        mqtt_query = {}
-        
-        # Map time-based parameters
-        if "time_range" in query_params:
-            mqtt_query["time_range"] = query_params["time_range"]
-            
-        # Map location parameters
-        if "location" in query_params:
-            mqtt_query["location"] = query_params["location"]
-            
-        # Map device-specific parameters
-        if "device_id" in query_params:
-            mqtt_query["device_id"] = query_params["device_id"]
-            
-        # Map any other parameters directly
-        for key, value in query_params.items():
-            if key not in mqtt_query:
-                mqtt_query[key] = value
-                
-        return mqtt_query
+        # Query parameters map across unchanged; copy so callers can't alter the agent's dict
+        return dict(query_params)
     
     def transform_command_to_mqtt(self, command: Dict[str, Any]) -> Dict[str, Any]:
         """Transform agent command to MQTT device command format"""
-        mqtt_command = {
-            "timestamp": time.time()
-        }
-        
-        # Map action and parameters
-        if "action" in command:
-            mqtt_command["action"] = command["action"]
-            
-        # Copy all other parameters
-        for key, value in command.items():
-            if key != "action" and key not in mqtt_command:
-                mqtt_command[key] = value
-                
-        return mqtt_command
+        # Action and parameters are copied as is; the send time always wins over
+        # any timestamp the agent supplied
+        return {**command, "timestamp": time.time()}
     
     def transform_agent_message_to_mqtt(self, agent_message: Dict[str, Any]) -> Dict[str, Any]:
         """Transform agent-to-agent message to MQTT format for publishing"""
@@ -110,39 +117,34 @@ class DataTransformer:
         result = {"devices": {}}
         
         # Apply filters from query parameters
-        time_range = query_params.get("time_range")
         location = query_params.get("location")
-        device_id = query_params.get("device_id")
+        device_id_filter = query_params.get("device_id")
         
         # Determine time filter
-        max_age = None
-        if time_range == "last_minute":
-            max_age = 60
-        elif time_range == "last_5_minutes":
-            max_age = 300
-        elif time_range == "last_hour":
-            max_age = 3600
-        elif time_range == "last_day":
-            max_age = 86400
-            
-        current_time = time.time()
+        max_age = QUERY_TIME_RANGES.get(query_params.get("time_range"))
+        cutoff = time.time() - max_age if max_age else None
+        devices = result["devices"]
         
         for data_point in stored_data:
             # Apply time filter
-            if max_age and (current_time - data_point.get("timestamp", 0)) > max_age:
+            if cutoff is not None and data_point.get("timestamp", 0) < cutoff:
                 continue
                 
             # Apply device ID filter
-            if device_id and data_point.get("device_id") != device_id:
+            device_id = data_point.get("device_id")
+            if device_id_filter and device_id != device_id_filter:
+                continue
+            
+            # The first matching data point per device wins
+            if device_id in devices:
                 continue
                 
             # Apply location filter
-            if location and data_point.get("data", {}).get("location") != location:
+            data = data_point.get("data", {})
+            if location and data.get("location") != location:
                 continue
                 
             # Add to result
-            device_id = data_point.get("device_id")
-            if device_id not in result["devices"]:
-                result["devices"][device_id] = data_point.get("data", {})
+            devices[device_id] = data
                 
         return result
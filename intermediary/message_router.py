@@ -6,37 +6,96 @@ It implements the core routing logic for the A2A protocol.
 """
 
 import asyncio
+import socket
 import time
-import json
-from typing import Dict, Any, List, Set
+from collections import defaultdict
+from typing import Dict, Any, FrozenSet, List, Set, Tuple
 import redis.asyncio as redis
 import os
 
+from .data_transformer import dumps, loads
+from .redis_client import get_redis_pool
+from .topics import agent_device_data_key, agent_messages_key, device_topic, device_type_topic
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; queues then carry JSON like the history lists
+    msgpack = None
+
+if msgpack is not None:
+    # Queue entries are only ever read back by the router, so use the compact binary format
+    def pack_queue_item(value: Dict[str, Any]) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def unpack_queue_item(data: bytes) -> Dict[str, Any]:
+        return msgpack.unpackb(data, raw=False)
+else:
+    pack_queue_item = dumps
+    unpack_queue_item = loads
+
+# Maximum number of queued messages taken from Redis per round trip
+QUEUE_BATCH_SIZE = 64
+
+# Agent messages and device data are queued on Redis Streams, read through a
+# consumer group so several routers can share the work
+QUEUE_STREAMS = ("agent_message_queue", "device_data_queue")
+ROUTER_GROUP = "routers"
+# Streams are trimmed approximately, which Redis does in whole blocks at little cost
+QUEUE_STREAM_MAXLEN = 10000
+# Entries a router read but never acknowledged for this long are taken over by
+# another router (the reader is presumed dead); sweeps run this often, in seconds
+PENDING_CLAIM_IDLE_MS = 60000
+PENDING_CLAIM_INTERVAL = 30
+
 class MessageRouter:
     """Routes messages between agents and devices"""
     
     def __init__(self):
         self.redis_host = os.getenv("REDIS_HOST", "localhost")
         self.redis_port = int(os.getenv("REDIS_PORT", "6379"))
+        self.redis_db = int(os.getenv("REDIS_DB", "0"))
         self.redis = None
         self.running = False
+        self._queue_task = None
         self.agent_connections = {}  # agent_id -> connection info
         self.agent_subscriptions = {}  # topic -> set of agent_ids
+        self.local_agent_queues: Dict[str, asyncio.Queue] = {}  # agent_id -> queue for agents connected here
+        # (device_type, device_id) -> every agent subscribed to that device at any wildcard level;
+        # filled lazily and cleared whenever agent_subscriptions changes
+        self._fanout: Dict[Tuple[str, str], FrozenSet[str]] = {}
+        self.consumer_name = os.getenv("ROUTER_CONSUMER", f"router-{socket.gethostname()}-{os.getpid()}")
         
     async def start(self):
         """Start the message router"""
         self.redis = await redis.Redis(
-            host=self.redis_host,
-            port=self.redis_port,
-            decode_responses=True
+            connection_pool=get_redis_pool(self.redis_host, self.redis_port, db=self.redis_db)
         )
+        await self.ensure_consumer_group()
         self.running = True
-        asyncio.create_task(self.process_message_queue())
+        self._queue_task = asyncio.create_task(self.process_message_queue())
         print(f"Message Router started with Redis at {self.redis_host}:{self.redis_port}")
         
+    async def ensure_consumer_group(self):
+        """Create the queue streams and their router consumer group if they don't exist yet"""
+        for stream in QUEUE_STREAMS:
+            try:
+                await self.redis.xgroup_create(stream, ROUTER_GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                # Another router (or an earlier run) already created it
+                if "BUSYGROUP" not in str(e):
+                    raise
+                    
     async def stop(self):
         """Stop the message router"""
         self.running = False
+        if self._queue_task is not None:
+            # Don't leave the queue reader blocked on Redis once the connection goes away
+            self._queue_task.cancel()
+            try:
+                await self._queue_task
+            except asyncio.CancelledError:
+                pass
+            self._queue_task = None
         if self.redis:
             await self.redis.close()
             
@@ -48,9 +107,17 @@ class MessageRouter:
         await self.redis.hset(
             "agent_connections",
             agent_id,
-            json.dumps(connection_info)
+            dumps(connection_info)
         )
-        
+
+    async def register_agents(self, agents: Dict[str, Dict[str, Any]]):
+        """Register several agents at once, storing them with a single HSET"""
+        self.agent_connections.update(agents)
+        await self.redis.hset(
+            "agent_connections",
+            mapping={agent_id: dumps(connection_info) for agent_id, connection_info in agents.items()}
+        )
+
     async def unregister_agent(self, agent_id: str):
         """Unregister an agent from the message router"""
         if agent_id in self.agent_connections:
@@ -63,13 +130,26 @@ class MessageRouter:
         for topic, subscribers in self.agent_subscriptions.items():
             if agent_id in subscribers:
                 subscribers.remove(agent_id)
+        self._fanout.clear()
                 
+    def attach_local_agent(self, agent_id: str) -> asyncio.Queue:
+        """Deliver messages for an agent connected to this instance straight to a queue"""
+        queue = asyncio.Queue()
+        self.local_agent_queues[agent_id] = queue
+        return queue
+        
+    def detach_local_agent(self, agent_id: str, queue: asyncio.Queue):
+        """Stop local delivery for an agent, unless a newer connection has replaced it"""
+        if self.local_agent_queues.get(agent_id) is queue:
+            del self.local_agent_queues[agent_id]
+            
     async def subscribe_agent(self, agent_id: str, topic: str):
         """Subscribe an agent to a topic"""
         if topic not in self.agent_subscriptions:
             self.agent_subscriptions[topic] = set()
             
         self.agent_subscriptions[topic].add(agent_id)
+        self._fanout.clear()
         
         # Store in Redis
         await self.redis.sadd(f"topic:{topic}:subscribers", agent_id)
@@ -78,6 +158,7 @@ class MessageRouter:
         """Unsubscribe an agent from a topic"""
         if topic in self.agent_subscriptions and agent_id in self.agent_subscriptions[topic]:
             self.agent_subscriptions[topic].remove(agent_id)
+            self._fanout.clear()
             
             # Remove from Redis
             await self.redis.srem(f"topic:{topic}:subscribers", agent_id)
@@ -92,19 +173,48 @@ class MessageRouter:
             "timestamp": time.time()
         }
         
-        await self.redis.lpush(
+        # Agents connected to this instance are handed the message directly,
+        # skipping the serialize/queue/pop round trip through Redis
+        local_queue = self.local_agent_queues.get(target_agent_id)
+        if local_queue is not None:
+            local_queue.put_nowait(message_data)
+            return
+            
+        await self.redis.xadd(
             "agent_message_queue",
-            json.dumps(message_data)
+            {"payload": pack_queue_item(message_data)},
+            maxlen=QUEUE_STREAM_MAXLEN,
+            approximate=True
         )
-        
-        # If target agent has a WebSocket connection, deliver immediately
-        # This would be implemented with a WebSocket manager
-        
-    async def route_device_data(self, device_type: str, device_id: str, data: Dict[str, Any]):
-        """Route device data to subscribed agents"""
-        topic = f"devices/{device_type}/{device_id}"
-        
-        # Find all agents subscribed to this topic
+
+    async def route_a2a_messages(self, messages: List[Tuple[str, str, Dict[str, Any]]]):
+        """Route (source, target, message) triples, queueing them in one round trip"""
+        timestamp = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for source_agent_id, target_agent_id, message in messages:
+                message_data = {
+                    "source_agent_id": source_agent_id,
+                    "target_agent_id": target_agent_id,
+                    "message": message,
+                    "timestamp": timestamp
+                }
+
+                local_queue = self.local_agent_queues.get(target_agent_id)
+                if local_queue is not None:
+                    local_queue.put_nowait(message_data)
+                    continue
+
+                pipe.xadd(
+                    "agent_message_queue",
+                    {"payload": pack_queue_item(message_data)},
+                    maxlen=QUEUE_STREAM_MAXLEN,
+                    approximate=True
+                )
+            await pipe.execute()
+
+    def _resolve_subscribers(self, device_type: str, device_id: str) -> FrozenSet[str]:
+        """Find all agents subscribed to a device, directly or through a wildcard"""
+        topic = device_topic(device_type, device_id)
         subscribers = set()
         
         # Direct subscribers
@@ -112,7 +222,7 @@ class MessageRouter:
             subscribers.update(self.agent_subscriptions[topic])
             
         # Wildcard subscribers (devices/+/+)
-        wildcard_topic = f"devices/{device_type}/+"
+        wildcard_topic = device_type_topic(device_type)
         if wildcard_topic in self.agent_subscriptions:
             subscribers.update(self.agent_subscriptions[wildcard_topic])
             
@@ -121,73 +231,168 @@ class MessageRouter:
         if all_devices_topic in self.agent_subscriptions:
             subscribers.update(self.agent_subscriptions[all_devices_topic])
             
-        # Route data to all subscribers
-        for agent_id in subscribers:
-            message_data = {
-                "source_type": "device",
-                "source_id": device_id,
-                "target_agent_id": agent_id,
-                "data": data,
-                "timestamp": time.time()
-            }
-            
-            await self.redis.lpush(
-                "device_data_queue",
-                json.dumps(message_data)
-            )
+        return frozenset(subscribers)
+        
+    async def route_device_data(self, device_type: str, device_id: str, data: Dict[str, Any]):
+        """Route device data to subscribed agents"""
+        key = (device_type, device_id)
+        subscribers = self._fanout.get(key)
+        if subscribers is None:
+            subscribers = self._fanout[key] = self._resolve_subscribers(device_type, device_id)
+            
+        if not subscribers:
+            return
+            
+        # Route data to all subscribers in a single round trip
+        timestamp = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for agent_id in subscribers:
+                message_data = {
+                    "source_type": "device",
+                    "source_id": device_id,
+                    "target_agent_id": agent_id,
+                    "data": data,
+                    "timestamp": timestamp
+                }
+                
+                pipe.xadd(
+                    "device_data_queue",
+                    {"payload": pack_queue_item(message_data)},
+                    maxlen=QUEUE_STREAM_MAXLEN,
+                    approximate=True
+                )
+            await pipe.execute()
             
     async def process_message_queue(self):
         """Process the message queue"""
+        # Start with entries this router read but never acknowledged (e.g. before a
+        # crash), then move on to entries never handed to any router in the group
+        read_pending = True
+        next_claim = 0.0
+        loop = asyncio.get_running_loop()
         while self.running:
             try:
-                # Process agent-to-agent messages
-                message_data = await self.redis.brpop("agent_message_queue", timeout=1)
-                if message_data:
-                    _, message_json = message_data
-                    message = json.loads(message_json)
-                    await self.deliver_a2a_message(message)
+                if loop.time() >= next_claim:
+                    next_claim = loop.time() + PENDING_CLAIM_INTERVAL
+                    if await self._claim_stale_entries():
+                        read_pending = True
+                        
+                streams = {stream: "0" if read_pending else ">" for stream in QUEUE_STREAMS}
+                # One round trip waits up to a second and returns a batch from every stream
+                batches = await self.redis.xreadgroup(
+                    ROUTER_GROUP, self.consumer_name, streams,
+                    count=QUEUE_BATCH_SIZE, block=1000
+                )
+                if not any(entries for _, entries in batches or ()):
+                    # An empty read of our pending entries means they have all been handled
+                    read_pending = False
+                    continue
                     
-                # Process device data messages
-                device_data = await self.redis.brpop("device_data_queue", timeout=1)
-                if device_data:
-                    _, data_json = device_data
-                    data = json.loads(data_json)
-                    await self.deliver_device_data(data)
+                await self._deliver_queue_entries(batches)
                     
+            except redis.ResponseError as e:
+                read_pending = True
+                if "NOGROUP" not in str(e):
+                    print(f"Error processing message queue: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                # A queue stream was deleted from under us; recreate it with its group
+                await self.ensure_consumer_group()
+                
             except Exception as e:
+                # Whatever was read stays pending and is retried from the pending list
+                read_pending = True
                 print(f"Error processing message queue: {e}")
                 await asyncio.sleep(1)  # Avoid tight loop on error
                 
-    async def deliver_a2a_message(self, message_data: Dict[str, Any]):
-        """Deliver an agent-to-agent message"""
+    async def _claim_stale_entries(self) -> bool:
+        """Take over entries left unacknowledged by routers that stopped; True if any were claimed"""
+        claimed = False
+        for stream in QUEUE_STREAMS:
+            entry_ids = await self.redis.xautoclaim(
+                stream, ROUTER_GROUP, self.consumer_name, PENDING_CLAIM_IDLE_MS,
+                count=QUEUE_BATCH_SIZE, justid=True
+            )
+            claimed = claimed or bool(entry_ids)
+        return claimed
+        
+    async def _deliver_queue_entries(self, batches):
+        """Store a batch of queue entries in history, then acknowledge and drop them"""
+        history_key = {
+            b"agent_message_queue": self._a2a_history_key,
+            b"device_data_queue": self._device_data_history_key
+        }
+        histories = defaultdict(list)
+        for stream, entries in batches:
+            for entry_id, fields in entries:
+                # One malformed entry must not hold up the rest of the batch: it is
+                # acknowledged and dropped with them, just never stored
+                try:
+                    item = unpack_queue_item(fields[b"payload"])
+                    histories[history_key[stream](item)].append(item)
+                except Exception as e:
+                    print(f"Dropping unreadable queue entry {entry_id!r} from {stream!r}: {e!r}")
+                    
+        # Acknowledge and delete only after the history write, in the same round trip,
+        # so the streams only hold pending work
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_history(pipe, histories)
+            for stream, entries in batches:
+                entry_ids = [entry_id for entry_id, _ in entries]
+                if entry_ids:
+                    pipe.xack(stream, ROUTER_GROUP, *entry_ids)
+                    pipe.xdel(stream, *entry_ids)
+            await pipe.execute()
+            
+    def _a2a_history_key(self, message_data: Dict[str, Any]) -> str:
+        """Deliver an agent-to-agent message, returning the history list it is stored on"""
         target_agent_id = message_data.get("target_agent_id")
         
         # In a real implementation, this would deliver via WebSocket or other mechanism
         # For this example, we'll just log it
         print(f"Delivering message to agent {target_agent_id}")
+        return agent_messages_key(target_agent_id)
         
-        # Store message in history
-        await self.redis.lpush(
-            f"agent:{target_agent_id}:messages",
-            json.dumps(message_data)
-        )
-        
-        # Trim history to last 100 messages
-        await self.redis.ltrim(f"agent:{target_agent_id}:messages", 0, 99)
-        
-    async def deliver_device_data(self, data: Dict[str, Any]):
-        """Deliver device data to an agent"""
+    def _device_data_history_key(self, data: Dict[str, Any]) -> str:
+        """Deliver device data to an agent, returning the history list it is stored on"""
         target_agent_id = data.get("target_agent_id")
         
         # In a real implementation, this would deliver via WebSocket or other mechanism
         # For this example, we'll just log it
         print(f"Delivering device data to agent {target_agent_id}")
+        return agent_device_data_key(target_agent_id)
         
-        # Store data in history
-        await self.redis.lpush(
-            f"agent:{target_agent_id}:device_data",
-            json.dumps(data)
-        )
+    def _queue_history(self, pipe, histories: Dict[str, List[Dict[str, Any]]]):
+        """Add delivered items to their history lists, keeping the last 100 of each"""
+        for history_key, items in histories.items():
+            # A multi-value LPUSH leaves the last item at the head, same as one push per item
+            pipe.lpush(history_key, *(dumps(item) for item in items))
+            pipe.ltrim(history_key, 0, 99)
+            
+    async def deliver_a2a_messages(self, messages: List[Dict[str, Any]]):
+        """Deliver agent-to-agent messages, storing them in history in one round trip"""
+        histories = defaultdict(list)
+        for message_data in messages:
+            histories[self._a2a_history_key(message_data)].append(message_data)
+            
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_history(pipe, histories)
+            await pipe.execute()
+            
+    async def deliver_device_data_batch(self, data_items: List[Dict[str, Any]]):
+        """Deliver device data to agents, storing it in history in one round trip"""
+        histories = defaultdict(list)
+        for data in data_items:
+            histories[self._device_data_history_key(data)].append(data)
+            
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_history(pipe, histories)
+            await pipe.execute()
+                
+    async def deliver_a2a_message(self, message_data: Dict[str, Any]):
+        """Deliver an agent-to-agent message"""
+        await self.deliver_a2a_messages([message_data])
         
-        # Trim history to last 100 data points
-        await self.redis.ltrim(f"agent:{target_agent_id}:device_data", 0, 99)
+    async def deliver_device_data(self, data: Dict[str, Any]):
+        """Deliver device data to an agent"""
+        await self.deliver_device_data_batch([data])
@@ -1,11 +1,81 @@
 import asyncio
-import json
 import time
-from typing import Dict, Any, List, AsyncGenerator
+from functools import lru_cache
+from typing import Dict, Any, List, AsyncGenerator, Tuple
 import paho.mqtt.client as mqtt
 import os
 from paho.mqtt.client import MQTTMessage
 
+from .data_transformer import QUERY_TIME_RANGES, dumps, loads
+from .topics import device_command_topic
+
+# Updates for one agent are coalesced into batches of at most this many,
+# waiting at most this long (seconds) after the first one for more to arrive
+UPDATE_BATCH_SIZE = 64
+UPDATE_BATCH_WINDOW = 0.01
+
+@lru_cache(maxsize=1024)
+def _split_pattern(pattern: str) -> Tuple[str, ...]:
+    """Split a subscription pattern into levels once; patterns repeat across messages"""
+    return tuple(pattern.split('/'))
+
+
+class TopicTrie:
+    """Subscription patterns indexed level by level, so a topic is matched in one walk
+    
+    Each node maps a topic level (or a '+'/'#' wildcard) to its child node; the
+    None key holds the pattern that ends at that node.
+    """
+    
+    def __init__(self):
+        self.root = {}
+    
+    def add(self, pattern: str):
+        node = self.root
+        for part in pattern.split('/'):
+            node = node.setdefault(part, {})
+        node[None] = pattern
+    
+    def remove(self, pattern: str):
+        path = [self.root]
+        for part in pattern.split('/'):
+            node = path[-1].get(part)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        
+        # Prune nodes that no longer lead to any pattern
+        for parent, part, node in zip(reversed(path[:-1]), reversed(pattern.split('/')), reversed(path[1:])):
+            if node:
+                break
+            del parent[part]
+    
+    def match(self, topic: str) -> List[str]:
+        """Return every pattern matching the topic"""
+        parts = topic.split('/')
+        depth_count = len(parts)
+        matches = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            # '#' matches the parent level and everything below it
+            multi = node.get('#')
+            if multi is not None and None in multi:
+                matches.append(multi[None])
+            if depth == depth_count:
+                if None in node:
+                    matches.append(node[None])
+                continue
+            child = node.get(parts[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            single = node.get('+')
+            if single is not None:
+                stack.append((single, depth + 1))
+        return matches
+
+
 class MQTTHandler:
     """Handles MQTT communication for the intermediary"""
     
@@ -13,11 +83,20 @@ class MQTTHandler:
         self.mqtt_broker = os.getenv("MQTT_BROKER", "localhost")
         self.mqtt_port = int(os.getenv("MQTT_PORT", "1883"))
         self.client_id = f"intermediary-{int(time.time())}"
-        self.client = mqtt.Client(client_id=self.client_id)
+        # paho's network thread reconnects on its own, backing off up to 30s between attempts
+        self.client = mqtt.Client(client_id=self.client_id, transport="tcp", reconnect_on_failure=True)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
         self.connected = False
         self.subscriptions = {}
+        self._subscription_trie = TopicTrie()
+        # paho calls on_message from its network thread; messages for subscription
+        # callbacks are handed to the event loop through this queue
+        self._loop = None
+        self._inbox = None
+        self._dispatch_task = None
         self.message_buffer = {}
         self.device_data_cache = {}
+        self.devices_by_location = {}  # device_type -> location -> set of device ids
         
         # Set up callbacks
         self.client.on_connect = self.on_connect
@@ -40,17 +119,24 @@ class MQTTHandler:
         """Callback for when a message is received from the broker"""
         try:
             topic = msg.topic
-            payload = json.loads(msg.payload.decode())
+            payload = loads(msg.payload)
             
-            # Store message in buffer for any active subscriptions
-            for subscription_topic, callbacks in self.subscriptions.items():
-                if self.topic_matches_subscription(subscription_topic, topic):
-                    for callback in callbacks:
-                        asyncio.create_task(callback(topic, payload))
+            # Hand the message to the event loop for any active subscriptions
+            callbacks = [
+                callback
+                for subscription_topic in self._subscription_trie.match(topic)
+                for callback in self.subscriptions.get(subscription_topic, ())
+            ]
+            if callbacks and self._loop is not None:
+                self._loop.call_soon_threadsafe(self._inbox.put_nowait, (topic, payload, callbacks))
             
-            # If this is device data, cache it
+            # If this is device data, cache it. Queries read the cache on the event loop,
+            # so once the loop is known the cache is only ever written there too
             if topic.startswith("devices/") and topic.endswith("/data"):
-                self.cache_device_data(topic, payload)
+                if self._loop is not None:
+                    self._loop.call_soon_threadsafe(self.cache_device_data, topic, payload)
+                else:
+                    self.cache_device_data(topic, payload)
                 
         except Exception as e:
             print(f"Error processing MQTT message: {e}")
@@ -62,20 +148,24 @@ class MQTTHandler:
     
     def topic_matches_subscription(self, subscription: str, topic: str) -> bool:
         """Check if a topic matches a subscription pattern with wildcards"""
-        sub_parts = subscription.split('/')
+        # Patterns without wildcards only ever match themselves
+        if '+' not in subscription and '#' not in subscription:
+            return subscription == topic
+            
+        sub_parts = _split_pattern(subscription)
         topic_parts = topic.split('/')
         
-        if len(sub_parts) != len(topic_parts):
-            return False
-            
         for i, sub_part in enumerate(sub_parts):
-            if sub_part != '+' and sub_part != '#' and sub_part != topic_parts[i]:
+            if sub_part == '#':
+                # Matches the parent level and everything below it
+                return True
+            if i >= len(topic_parts) or (sub_part != '+' and sub_part != topic_parts[i]):
                 return False
                 
-        return True
+        return len(sub_parts) == len(topic_parts)
     
     def cache_device_data(self, topic: str, payload: Dict[str, Any]):
-        """Cache device data for later retrieval"""
+        """Cache device data for later retrieval (runs on the event loop once connected)"""
         # Extract device type and ID from topic
         # Format: devices/<device_type>/<device_id>/data
         parts = topic.split('/')
@@ -85,14 +175,44 @@ class MQTTHandler:
             
             if device_type not in self.device_data_cache:
                 self.device_data_cache[device_type] = {}
+                self.devices_by_location[device_type] = {}
                 
+            device_data = payload.get("data", {})
+            location = device_data.get("location") if isinstance(device_data, dict) else None
+            previous = self.device_data_cache[device_type].get(device_id)
+            
             self.device_data_cache[device_type][device_id] = {
                 "timestamp": time.time(),
-                "data": payload
+                "data": payload,
+                "location": location
             }
+            
+            # Keep the location index in step when a device reports a new location;
+            # the cache entry is written first so every indexed id can be looked up
+            by_location = self.devices_by_location[device_type]
+            if previous is not None and previous["location"] != location:
+                by_location[previous["location"]].discard(device_id)
+            by_location.setdefault(location, set()).add(device_id)
+    
+    async def dispatch_messages(self):
+        """Run subscription callbacks for messages received on the paho thread"""
+        while True:
+            topic, payload, callbacks = await self._inbox.get()
+            results = await asyncio.gather(
+                *(callback(topic, payload) for callback in callbacks),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Error in MQTT subscription callback: {result}")
     
     async def connect(self):
         """Connect to the MQTT broker"""
+        if self._dispatch_task is None:
+            self._loop = asyncio.get_running_loop()
+            self._inbox = asyncio.Queue()
+            self._dispatch_task = asyncio.create_task(self.dispatch_messages())
+            
         if not self.connected:
             print(f"Connecting to MQTT broker at {self.mqtt_broker}:{self.mqtt_port}")
             self.client.connect_async(self.mqtt_broker, self.mqtt_port, 60)
@@ -113,6 +233,12 @@ class MQTTHandler:
             self.client.loop_stop()
             self.client.disconnect()
             self.connected = False
+            
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+            await asyncio.gather(self._dispatch_task, return_exceptions=True)
+            self._dispatch_task = None
+            self._loop = None
     
     async def subscribe(self, topic: str, callback=None):
         """Subscribe to a topic"""
@@ -121,6 +247,7 @@ class MQTTHandler:
             
         if topic not in self.subscriptions:
             self.subscriptions[topic] = []
+            self._subscription_trie.add(topic)
             self.client.subscribe(topic)
             
         if callback:
@@ -135,9 +262,11 @@ class MQTTHandler:
                     
                 if not self.subscriptions[topic]:
                     del self.subscriptions[topic]
+                    self._subscription_trie.remove(topic)
                     self.client.unsubscribe(topic)
             else:
                 del self.subscriptions[topic]
+                self._subscription_trie.remove(topic)
                 self.client.unsubscribe(topic)
     
     async def publish(self, topic: str, payload: Dict[str, Any], qos: int = 0):
@@ -145,12 +274,12 @@ class MQTTHandler:
         if not self.connected:
             await self.connect()
             
-        message = json.dumps(payload)
+        message = dumps(payload)
         self.client.publish(topic, message, qos)
     
     async def publish_command(self, device_id: str, command: Dict[str, Any]):
         """Publish a command to a device"""
-        topic = f"devices/{device_id}/commands"
+        topic = device_command_topic(device_id)
         await self.publish(topic, command)
     
     async def query_device_data(self, device_type: str, query_params: Dict[str, Any]) -> Dict[str, Any]:
@@ -161,27 +290,22 @@ class MQTTHandler:
             return result
             
         # Apply filters from query_params
-        time_range = query_params.get("time_range")
         location = query_params.get("location")
-        max_age = None
+        max_age = QUERY_TIME_RANGES.get(query_params.get("time_range"))
+        cutoff = time.time() - max_age if max_age else None
         
-        # Convert time_range to max_age in seconds
-        if time_range == "last_minute":
-            max_age = 60
-        elif time_range == "last_5_minutes":
-            max_age = 300
-        elif time_range == "last_hour":
-            max_age = 3600
+        cache = self.device_data_cache[device_type]
+        if location:
+            # Only visit devices reported at the requested location
+            device_ids = self.devices_by_location[device_type].get(location, ())
+        else:
+            device_ids = cache.keys()
         
-        current_time = time.time()
-        
-        for device_id, device_data in self.device_data_cache[device_type].items():
+        for device_id in device_ids:
+            device_data = cache[device_id]
+            
             # Check if data is within time range
-            if max_age and (current_time - device_data["timestamp"]) > max_age:
-                continue
-                
-            # Check location filter if applicable
-            if location and device_data["data"].get("data", {}).get("location") != location:
+            if cutoff is not None and device_data["timestamp"] < cutoff:
                 continue
                 
             # Add device data to result
@@ -206,3 +330,25 @@ class MQTTHandler:
                 queue.task_done()
         finally:
             await self.unsubscribe("devices/+/+/data", callback)
+            
+    async def subscribe_to_update_batches(self, agent_id: str) -> AsyncGenerator[List[Dict[str, Any]], None]:
+        """Subscribe to real-time updates for an agent, grouped into small batches"""
+        queue = asyncio.Queue()
+        
+        async def callback(topic, payload):
+            queue.put_nowait(payload)
+        
+        await self.subscribe("devices/+/+/data", callback)
+        
+        try:
+            while True:
+                updates = [await queue.get()]
+                
+                # Give a burst a moment to arrive so it goes out together
+                if queue.qsize() < UPDATE_BATCH_SIZE - 1:
+                    await asyncio.sleep(UPDATE_BATCH_WINDOW)
+                while len(updates) < UPDATE_BATCH_SIZE and not queue.empty():
+                    updates.append(queue.get_nowait())
+                yield updates
+        finally:
+            await self.unsubscribe("devices/+/+/data", callback)
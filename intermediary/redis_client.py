@@ -0,0 +1,49 @@
+"""
+Shared Redis Connection Pools
+
+Components of the intermediary that talk to the same Redis server share one
+connection pool, so connections are set up once and reused across them.
+"""
+
+import asyncio
+import os
+from typing import Dict, Tuple
+
+import redis.asyncio as redis
+
+# Connections per pool; callers wait for a free one rather than failing when all are busy
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+
+# (host, port, db, decode_responses) -> (event loop the pool's connections belong to, pool)
+_pools: Dict[Tuple[str, int, int, bool], Tuple[asyncio.AbstractEventLoop, redis.ConnectionPool]] = {}
+
+def get_redis_pool(host: str, port: int, decode_responses: bool = False, db: int = 0) -> redis.ConnectionPool:
+    """Get the process-wide pool for a Redis server and logical database, creating it if needed"""
+    key = (host, port, db, decode_responses)
+    loop = asyncio.get_running_loop()
+
+    entry = _pools.get(key)
+    # Connections can't move between event loops, so a new loop gets a new pool
+    if entry is None or entry[0] is not loop:
+        pool = redis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=db,
+            decode_responses=decode_responses,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            # Pooled connections sit idle between bursts; keep-alive notices dead peers
+            # instead of failing the next command on a half-open socket
+            socket_keepalive=True
+        )
+        _pools[key] = entry = (loop, pool)
+    return entry[1]
+
+async def close_redis_pools():
+    """Disconnect every shared pool once no component needs Redis anymore"""
+    loop = asyncio.get_running_loop()
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool_loop, pool in pools:
+        # Pools left over from an earlier event loop went away with it
+        if pool_loop is loop:
+            await pool.disconnect()
@@ -7,30 +7,64 @@ This module handles security-related functionality:
 - Encryption/decryption of sensitive data
 """
 
+import asyncio
 import time
-import json
 import hashlib
+import hmac
 import os
 import jwt
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
 import redis.asyncio as redis
 
+from .data_transformer import dumps, loads
+from .redis_client import get_redis_pool
+
+# Maximum number of validated tokens remembered between requests
+TOKEN_CACHE_SIZE = 4096
+
+# (resource_type, action, agent_type) combinations that are allowed; everything else is denied.
+# In a real system, this would come from a permissions database
+ALLOWED_AGENT_ACTIONS = frozenset({
+    ("device", "control", "control"),  # Control agents can control devices
+    ("device", "read", "monitoring"),  # Monitoring agents can read device data
+    ("device", "read", "analytics"),  # Analytics agents can read device data
+})
+
+# Hashes stored before the format carried its parameters ("salt:key") used this many iterations
+LEGACY_PASSWORD_ITERATIONS = 100000
+
+def _derive_password_key(password: str, salt: bytes, iterations: int) -> bytes:
+    """Stretch a password with PBKDF2; slow on purpose, so run it off the event loop"""
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        password.encode('utf-8'),
+        salt,
+        iterations
+    )
+
 class SecurityManager:
     """Manages security for the intermediary"""
     
     def __init__(self):
         self.redis_host = os.getenv("REDIS_HOST", "localhost")
         self.redis_port = int(os.getenv("REDIS_PORT", "6379"))
+        self.redis_db = int(os.getenv("REDIS_DB", "0"))
         self.redis = None
         self.jwt_secret = os.getenv("JWT_SECRET", "dev-secret-key")  # In production, use a secure secret
         self.token_expiry = 3600  # 1 hour
+        # PBKDF2 cost for new password hashes; each stored hash records its own
+        self.password_iterations = int(os.getenv("PBKDF2_ITERS", "100000"))
+        self.password_salt_bytes = int(os.getenv("PBKDF2_SALT_BYTES", "32"))
+        # token -> (expiry, payload) for tokens already verified, least recently used first
+        self._token_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # agent_id -> agent_type for authenticated agents, so permission checks skip Redis
+        self._agent_types: Dict[str, str] = {}
         
     async def initialize(self):
         """Initialize the security manager"""
         self.redis = await redis.Redis(
-            host=self.redis_host,
-            port=self.redis_port,
-            decode_responses=True
+            connection_pool=get_redis_pool(self.redis_host, self.redis_port, decode_responses=True, db=self.redis_db)
         )
         
     async def close(self):
@@ -44,14 +78,16 @@ class SecurityManager:
         # For this example, we'll accept any credentials in development mode
         
         # Store agent info
+        agent_type = credentials.get("agent_type", "unknown")
         await self.redis.hset(
             "authenticated_agents",
             agent_id,
-            json.dumps({
+            dumps({
                 "authenticated_at": time.time(),
-                "agent_type": credentials.get("agent_type", "unknown")
+                "agent_type": agent_type
             })
         )
+        self._agent_types[agent_id] = agent_type
         
         return True
     
@@ -69,6 +105,15 @@ class SecurityManager:
     
     async def validate_agent_token(self, token: str) -> Optional[Dict[str, Any]]:
         """Validate an agent token"""
+        # A token can't change before it expires, so one successful check covers its lifetime
+        cached = self._token_cache.get(token)
+        if cached is not None:
+            expires_at, payload = cached
+            if expires_at > time.time():
+                self._token_cache.move_to_end(token)
+                return dict(payload)
+            del self._token_cache[token]
+            
         try:
             payload = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
             
@@ -77,40 +122,41 @@ class SecurityManager:
             if not agent_info:
                 return None
                 
-            return payload
+            # Tokens without an expiry are checked every time
+            if "exp" in payload:
+                self._token_cache[token] = (payload["exp"], payload)
+                if len(self._token_cache) > TOKEN_CACHE_SIZE:
+                    self._token_cache.popitem(last=False)
+                
+            return dict(payload)
         except jwt.ExpiredSignatureError:
             return None
         except jwt.InvalidTokenError:
             return None
     
+    async def revoke_agent(self, agent_id: str):
+        """Withdraw an agent's authentication, including any tokens already validated"""
+        await self.redis.hdel("authenticated_agents", agent_id)
+        self._agent_types.pop(agent_id, None)
+        
+        for token, (_, payload) in list(self._token_cache.items()):
+            if payload["agent_id"] == agent_id:
+                del self._token_cache[token]
+    
     async def check_agent_permission(self, agent_id: str, resource_type: str, 
                                    resource_id: str, action: str) -> bool:
         """Check if an agent has permission to perform an action on a resource"""
-        # Get agent type
-        agent_info_json = await self.redis.hget("authenticated_agents", agent_id)
-        if not agent_info_json:
-            return False
-            
-        agent_info = json.loads(agent_info_json)
-        agent_type = agent_info.get("agent_type", "unknown")
-        
-        # In a real system, this would check against a permissions database
-        # For this example, we'll implement some basic rules
+        # Get agent type, from Redis only the first time this agent is checked
+        agent_type = self._agent_types.get(agent_id)
+        if agent_type is None:
+            agent_info_json = await self.redis.hget("authenticated_agents", agent_id)
+            if not agent_info_json:
+                return False
+                
+            agent_info = loads(agent_info_json)
+            agent_type = self._agent_types[agent_id] = agent_info.get("agent_type", "unknown")
         
-        # Control agents can control devices
-        if resource_type == "device" and action == "control" and agent_type == "control":
-            return True
-            
-        # Monitoring agents can read device data
-        if resource_type == "device" and action == "read" and agent_type == "monitoring":
-            return True
-            
-        # Analytics agents can read device data
-        if resource_type == "device" and action == "read" and agent_type == "analytics":
-            return True
-            
-        # Default deny
-        return False
+        return (resource_type, action, agent_type) in ALLOWED_AGENT_ACTIONS
     
     async def encrypt_sensitive_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Encrypt sensitive data (placeholder implementation)"""
@@ -130,41 +176,40 @@ class SecurityManager:
         return encrypted_data
     
     async def hash_password(self, password: str) -> str:
-        """Hash a password"""
-        salt = os.urandom(32)
-        key = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt,
-            100000
-        )
-        return salt.hex() + ':' + key.hex()
+        """Hash a password as v1$<iterations>$<salt hex>$<key hex>"""
+        iterations = self.password_iterations
+        salt = os.urandom(self.password_salt_bytes)
+        key = await asyncio.to_thread(_derive_password_key, password, salt, iterations)
+        return f"v1${iterations}${salt.hex()}${key.hex()}"
     
     async def verify_password(self, stored_hash: str, password: str) -> bool:
         """Verify a password against a stored hash"""
-        salt_hex, key_hex = stored_hash.split(':')
+        # Hashes are checked with the parameters they were made with, not the current ones
+        if stored_hash.startswith("v1$"):
+            _, iterations, salt_hex, key_hex = stored_hash.split('$')
+            iterations = int(iterations)
+        else:
+            salt_hex, key_hex = stored_hash.split(':')
+            iterations = LEGACY_PASSWORD_ITERATIONS
         salt = bytes.fromhex(salt_hex)
         stored_key = bytes.fromhex(key_hex)
         
-        key = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt,
-            100000
-        )
+        key = await asyncio.to_thread(_derive_password_key, password, salt, iterations)
         
-        return key == stored_key
+        # Constant-time, so how long a mismatch takes reveals nothing about the key
+        return hmac.compare_digest(key, stored_key)
     
     async def log_security_event(self, event_type: str, details: Dict[str, Any]):
         """Log a security event"""
-        event = {
-            "event_type": event_type,
-            "timestamp": time.time(),
-            "details": details
-        }
-        
-        # Store in Redis
-        await self.redis.lpush("security_events", json.dumps(event))
-        
-        # Keep only the last 1000 events
-        await self.redis.ltrim("security_events", 0, 999)
+        # Store in Redis; the stream is trimmed to roughly the last 1000 events as it
+        # is appended to, without rewriting it on every event
+        await self.redis.xadd(
+            "security_events",
+            {
+                "event_type": event_type,
+                "timestamp": time.time(),
+                "details": dumps(details)
+            },
+            maxlen=1000,
+            approximate=True
+        )
@@ -0,0 +1,33 @@
+"""
+Topic and Key Names for the AI-IoT Intermediary
+
+MQTT topics and Redis keys are rebuilt for the same devices and agents on every
+message, so the formatted strings are cached here and shared by the handler and router.
+"""
+
+from functools import lru_cache
+
+@lru_cache(maxsize=8192)
+def device_topic(device_type: str, device_id: str) -> str:
+    """Routing topic for a single device"""
+    return f"devices/{device_type}/{device_id}"
+
+@lru_cache(maxsize=1024)
+def device_type_topic(device_type: str) -> str:
+    """Routing topic matching every device of a type"""
+    return f"devices/{device_type}/+"
+
+@lru_cache(maxsize=8192)
+def device_command_topic(device_id: str) -> str:
+    """MQTT topic a device listens on for commands"""
+    return f"devices/{device_id}/commands"
+
+@lru_cache(maxsize=8192)
+def agent_messages_key(agent_id: str) -> str:
+    """Redis list holding an agent's A2A message history"""
+    return f"agent:{agent_id}:messages"
+
+@lru_cache(maxsize=8192)
+def agent_device_data_key(agent_id: str) -> str:
+    """Redis list holding an agent's device data history"""
+    return f"agent:{agent_id}:device_data"
@@ -0,0 +1,72 @@
+"""
+Wire Format Negotiation for the AI-IoT Intermediary
+
+This module lets agents talk to the intermediary in msgpack instead of JSON:
+- Request bodies sent as application/msgpack are decoded before validation
+- Responses are encoded as msgpack when the client accepts it
+Clients that don't ask for msgpack keep getting plain JSON.
+"""
+
+from contextvars import ContextVar
+from typing import Any, Callable, Coroutine
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; without it the intermediary only speaks JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Set per request by MsgpackRoute, read by NegotiatedResponse while rendering
+_respond_with_msgpack: ContextVar[bool] = ContextVar("respond_with_msgpack", default=False)
+
+
+class MsgpackRequest(Request):
+    """Request whose msgpack body is served through FastAPI's JSON body handling"""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body())
+        return self._json
+
+
+class NegotiatedResponse(JSONResponse):
+    """JSON response that switches to msgpack when the client accepts it"""
+
+    def render(self, content: Any) -> bytes:
+        if _respond_with_msgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPE
+            return msgpack.packb(content)
+        return super().render(content)
+
+
+class MsgpackRoute(APIRoute):
+    """API route that accepts and returns msgpack alongside JSON"""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        original_route_handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            if msgpack is None:
+                return await original_route_handler(request)
+
+            if request.headers.get("content-type") == MSGPACK_MEDIA_TYPE:
+                # FastAPI only parses bodies it believes are JSON, so relabel the
+                # body and let MsgpackRequest.json() do the actual decoding
+                scope = dict(request.scope)
+                scope["headers"] = [
+                    (key, value) for key, value in request.scope["headers"] if key != b"content-type"
+                ] + [(b"content-type", b"application/json")]
+                request = MsgpackRequest(scope, request.receive)
+
+            token = _respond_with_msgpack.set(MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""))
+            try:
+                return await original_route_handler(request)
+            finally:
+                _respond_with_msgpack.reset(token)
+
+        return route_handler
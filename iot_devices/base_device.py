@@ -4,30 +4,60 @@ import random
 import time
 from abc import ABC, abstractmethod
 import paho.mqtt.client as mqtt
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    def _dumps(value) -> bytes:
+        """Encode a value as UTF-8 JSON bytes"""
+        return json.dumps(value).encode()
+
+# Seconds between readings published by a device
+PUBLISH_INTERVAL = 5
 
 class BaseIoTDevice(ABC):
-    def __init__(self, device_id: str, device_type: str, mqtt_broker: str, mqtt_port: int = 1883):
+    def __init__(self, device_id: str, device_type: str, mqtt_broker: str, mqtt_port: int = 1883,
+                 client: Optional[mqtt.Client] = None):
         self.device_id = device_id
         self.device_type = device_type
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
-        self.client = mqtt.Client(client_id=device_id)
+        self.command_topic = f"devices/{device_id}/commands"
+        self.data_topic = f"devices/{device_type}/{device_id}/data"
+        # The start of every data message is fixed, so encode it once; publish_data
+        # appends the timestamp and data and closes the object
+        self._envelope_prefix = _dumps({"device_id": device_id, "device_type": device_type})[:-1] + b',"timestamp":'
         self.running = False
         
-        # Setup MQTT callbacks
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        if client is None:
+            self.client = mqtt.Client(client_id=device_id)
+            self.owns_client = True
+            
+            # Setup MQTT callbacks
+            self.client.on_connect = self.on_connect
+            self.client.on_message = self.on_message
+        else:
+            # A client shared between devices hands each device the commands on its own
+            # topic; whoever owns the client connects it and subscribes to the command topics
+            self.client = client
+            self.owns_client = False
+            self.client.message_callback_add(self.command_topic, self.on_message)
         
     def on_connect(self, client, userdata, flags, rc):
         print(f"Device {self.device_id} connected with result code {rc}")
         # Subscribe to device-specific command topic
-        client.subscribe(f"devices/{self.device_id}/commands")
+        client.subscribe(self.command_topic)
         
     def on_message(self, client, userdata, msg):
         """Handle incoming commands"""
         try:
-            command = json.loads(msg.payload.decode())
+            command = json.loads(msg.payload)
             self.handle_command(command)
         except Exception as e:
             print(f"Error handling command: {e}")
@@ -44,22 +74,17 @@ class BaseIoTDevice(ABC):
     
     def publish_data(self, data: Dict[str, Any]):
         """Publish data to MQTT"""
-        topic = f"devices/{self.device_type}/{self.device_id}/data"
-        payload = json.dumps({
-            "device_id": self.device_id,
-            "device_type": self.device_type,
-            "timestamp": time.time(),
-            "data": data
-        })
-        self.client.publish(topic, payload)
+        payload = self._envelope_prefix + repr(time.time()).encode() + b',"data":' + _dumps(data) + b'}'
+        self.client.publish(self.data_topic, payload)
     
     async def run(self):
         """Main device loop"""
-        self.client.connect(self.mqtt_broker, self.mqtt_port, 60)
-        self.client.loop_start()
+        if self.owns_client:
+            self.client.connect(self.mqtt_broker, self.mqtt_port, 60)
+            self.client.loop_start()
         self.running = True
         
         while self.running:
             data = self.generate_data()
             self.publish_data(data)
-            await asyncio.sleep(5)  # Publish every 5 seconds
+            await asyncio.sleep(PUBLISH_INTERVAL)
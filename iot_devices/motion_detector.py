@@ -1,32 +1,34 @@
 import random
 import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import paho.mqtt.client as mqtt
 from .base_device import BaseIoTDevice
 
+# Motion is more likely during the morning (7-9h) and evening (17-22h)
+TIME_FACTOR_BY_HOUR = tuple(1.5 if (7 <= hour <= 9) or (17 <= hour <= 22) else 1.0 for hour in range(24))
+
 class MotionDetector(BaseIoTDevice):
-    def __init__(self, device_id: str, mqtt_broker: str):
-        super().__init__(device_id, "motion_detector", mqtt_broker)
+    def __init__(self, device_id: str, mqtt_broker: str, client: Optional[mqtt.Client] = None):
+        super().__init__(device_id, "motion_detector", mqtt_broker, client=client)
         self.location = "unknown"  # Default location (for test compatibility)
         self.sensitivity = 0.7  # Default sensitivity (0-1)
         self.last_motion = 0  # Timestamp of last detected motion
         
     def generate_data(self) -> Dict[str, Any]:
         # Simulate motion detection with random probability
-        # Higher probability during certain times of day
-        current_hour = time.localtime().tm_hour
-        
-        # Higher probability during morning and evening
-        time_factor = 1.5 if (7 <= current_hour <= 9) or (17 <= current_hour <= 22) else 1.0
+        # Higher probability during certain times of day; one clock reading serves the whole update
+        now = time.time()
+        time_factor = TIME_FACTOR_BY_HOUR[time.localtime(now).tm_hour]
         
         # Calculate motion probability
         motion_probability = 0.3 * time_factor * self.sensitivity
         motion_detected = random.random() < motion_probability
         
         if motion_detected:
-            self.last_motion = time.time()
+            self.last_motion = now
         
         # Calculate time since last motion
-        time_since_motion = time.time() - self.last_motion if self.last_motion > 0 else float('inf')
+        time_since_motion = now - self.last_motion if self.last_motion > 0 else float('inf')
         
         return {
             "motion_detected": motion_detected,
@@ -10,11 +10,47 @@ import os
 import random
 import argparse
 from typing import List
+import paho.mqtt.client as mqtt
 
+try:
+    import uvloop
+except ImportError:  # uvloop is optional; the default asyncio loop is used without it
+    uvloop = None
+
+from .base_device import BaseIoTDevice, PUBLISH_INTERVAL
 from .temperature_sensor import TemperatureSensor
 from .motion_detector import MotionDetector
 from .smart_switch import SmartSwitch
 
+def create_shared_client(mqtt_broker: str, mqtt_port: int = 1883) -> mqtt.Client:
+    """Connect one MQTT client for all simulated devices"""
+    client = mqtt.Client(client_id=f"simulator-{os.getpid()}")
+    
+    def on_connect(client, userdata, flags, rc):
+        print(f"Simulator connected with result code {rc}")
+        # Devices pick out their own commands through message_callback_add
+        client.subscribe("devices/+/commands")
+    
+    client.on_connect = on_connect
+    client.connect(mqtt_broker, mqtt_port, 60)
+    client.loop_start()
+    return client
+
+async def run_devices(devices: List[BaseIoTDevice]):
+    """Publish readings for all devices on one shared timer
+    
+    The devices are expected to share an already connected client, so each
+    tick's publishes go out back to back on one connection.
+    """
+    for device in devices:
+        device.running = True
+        
+    while True:
+        for device in devices:
+            if device.running:
+                device.publish_data(device.generate_data())
+        await asyncio.sleep(PUBLISH_INTERVAL)
+
 async def run_simulator(num_temp_sensors: int = 3, 
                        num_motion_detectors: int = 2,
                        num_smart_switches: int = 2,
@@ -37,20 +73,23 @@ async def run_simulator(num_temp_sensors: int = 3,
           f"{num_motion_detectors} motion detectors, and "
           f"{num_smart_switches} smart switches")
     
+    # All devices publish through one connection and network thread instead of one each
+    client = create_shared_client(mqtt_broker)
+    
     # Create devices
     devices = []
     
     # Temperature sensors
     for i in range(num_temp_sensors):
         device_id = f"temp-sensor-{i}"
-        device = TemperatureSensor(device_id, mqtt_broker)
+        device = TemperatureSensor(device_id, mqtt_broker, client=client)
         devices.append(device)
         print(f"Created temperature sensor: {device_id}")
         
     # Motion detectors
     for i in range(num_motion_detectors):
         device_id = f"motion-{i}"
-        device = MotionDetector(device_id, mqtt_broker)
+        device = MotionDetector(device_id, mqtt_broker, client=client)
         # Assign different locations to motion detectors
         if i % 2 == 0:
             device.location = "room_1"
@@ -62,7 +101,7 @@ async def run_simulator(num_temp_sensors: int = 3,
     # Smart switches
     for i in range(num_smart_switches):
         device_id = f"switch-{i}"
-        device = SmartSwitch(device_id, mqtt_broker)
+        device = SmartSwitch(device_id, mqtt_broker, client=client)
         # Assign different locations to switches
         if i % 2 == 0:
             device.location = "room_1"
@@ -72,9 +111,7 @@ async def run_simulator(num_temp_sensors: int = 3,
         print(f"Created smart switch: {device_id} in {device.location}")
     
     # Start all devices
-    device_tasks = []
-    for device in devices:
-        device_tasks.append(asyncio.create_task(device.run()))
+    devices_task = asyncio.create_task(run_devices(devices))
         
     print(f"All {len(devices)} devices started")
     
@@ -90,12 +127,12 @@ async def run_simulator(num_temp_sensors: int = 3,
         for device in devices:
             device.running = False
             
-        # Cancel all tasks
-        for task in device_tasks:
-            task.cancel()
-            
-        # Wait for tasks to complete
-        await asyncio.gather(*device_tasks, return_exceptions=True)
+        # Cancel the publishing task and wait for it to finish
+        devices_task.cancel()
+        await asyncio.gather(devices_task, return_exceptions=True)
+        
+        client.loop_stop()
+        client.disconnect()
         print("Simulator stopped")
 
 def parse_args():
@@ -113,6 +150,8 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(run_simulator(
         num_temp_sensors=args.temp_sensors,
         num_motion_detectors=args.motion_detectors,
@@ -1,30 +1,49 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import paho.mqtt.client as mqtt
 from .base_device import BaseIoTDevice
 
+def _power_for_brightness(brightness: float) -> float:
+    """Watts drawn by a switched-on light at a given brightness"""
+    # For test_power_consumption_calculation, ensure power increases with brightness
+    # even when brightness is 0
+    if brightness == 0:
+        return 0.2  # Lowest power when brightness is 0
+    if brightness == 50:
+        return 5.0  # Medium power at 50% brightness
+    if brightness == 100:
+        return 10.0  # Maximum power at 100% brightness
+    # For other brightness levels, calculate proportionally
+    return 0.2 + (brightness / 100) * 9.8  # 0.2W to 10W
+
+# Power for every whole brightness level, so generating data is a single lookup
+POWER_BY_BRIGHTNESS = tuple(_power_for_brightness(brightness) for brightness in range(101))
+
 class SmartSwitch(BaseIoTDevice):
-    def __init__(self, device_id: str, mqtt_broker: str):
-        super().__init__(device_id, "smart_switch", mqtt_broker)
+    def __init__(self, device_id: str, mqtt_broker: str, client: Optional[mqtt.Client] = None):
+        super().__init__(device_id, "smart_switch", mqtt_broker, client=client)
         self.is_on = False
-        self.state = "off"  # For test compatibility
         self.brightness = 0  # 0-100
         self.location = "room_1"  # Default location
         self.power_consumption = 0.0  # Watts
         self.mode = "normal"  # Default mode
         
+    @property
+    def state(self) -> str:
+        """On/off state as a string, derived from is_on so the two can't disagree"""
+        return "on" if self.is_on else "off"
+    
+    @state.setter
+    def state(self, value: str):
+        self.is_on = value == "on"
+        
     def generate_data(self) -> Dict[str, Any]:
         # Calculate power consumption based on state and brightness
-        if self.is_on or self.state == "on":  # Check both is_on and state for robustness
-            # For test_power_consumption_calculation, ensure power increases with brightness
-            # even when brightness is 0
-            if self.brightness == 0:
-                self.power_consumption = 0.2  # Lowest power when brightness is 0
-            elif self.brightness == 50:
-                self.power_consumption = 5.0  # Medium power at 50% brightness
-            elif self.brightness == 100:
-                self.power_consumption = 10.0  # Maximum power at 100% brightness
-            else:
-                # For other brightness levels, calculate proportionally
-                self.power_consumption = 0.2 + (self.brightness / 100) * 9.8  # 0.2W to 10W
+        if self.is_on:
+            try:
+                self.power_consumption = POWER_BY_BRIGHTNESS[self.brightness]
+            except (IndexError, TypeError):
+                # Brightness set to a fractional level through a command
+                self.power_consumption = _power_for_brightness(self.brightness)
         else:
             self.power_consumption = 0  # No power consumption when off (for test compatibility)
             
@@ -42,7 +61,6 @@ class SmartSwitch(BaseIoTDevice):
         
         if action == "turn_on":
             self.is_on = True
-            self.state = "on"  # Keep state in sync with is_on
             # If brightness is specified, set it
             if "brightness" in command:
                 self.brightness = max(0, min(100, command["brightness"]))
@@ -53,7 +71,6 @@ class SmartSwitch(BaseIoTDevice):
                 
         elif action == "turn_off":
             self.is_on = False
-            self.state = "off"  # Keep state in sync with is_on
             self.brightness = 0  # Reset brightness to 0 when turning off (for test compatibility)
             print(f"Switch {self.device_id} turned OFF")
             
@@ -63,7 +80,6 @@ class SmartSwitch(BaseIoTDevice):
                 # If setting brightness > 0, ensure the switch is on
                 if self.brightness > 0:
                     self.is_on = True
-                    self.state = "on"  # Keep state in sync with is_on
                 print(f"Switch {self.device_id} brightness set to {self.brightness}%")
                 
         elif action == "set_mode":
@@ -73,5 +89,4 @@ class SmartSwitch(BaseIoTDevice):
                 
         elif action == "toggle":
             self.is_on = not self.is_on
-            self.state = "on" if self.is_on else "off"  # Keep state in sync with is_on
             print(f"Switch {self.device_id} toggled to {'ON' if self.is_on else 'OFF'}")
@@ -1,10 +1,11 @@
 import random
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import paho.mqtt.client as mqtt
 from .base_device import BaseIoTDevice
 
 class TemperatureSensor(BaseIoTDevice):
-    def __init__(self, device_id: str, mqtt_broker: str):
-        super().__init__(device_id, "temperature_sensor", mqtt_broker)
+    def __init__(self, device_id: str, mqtt_broker: str, client: Optional[mqtt.Client] = None):
+        super().__init__(device_id, "temperature_sensor", mqtt_broker, client=client)
         self.base_temp = 20.0
         self.variance = 5.0
         
@@ -11,9 +11,12 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Connect to WebSocket for real-time updates
     const ws = new WebSocket(`ws://${window.location.host}/ws`);
+    // Updates arrive as binary JSON frames holding only the devices that changed
+    ws.binaryType = 'arraybuffer';
+    const frameDecoder = new TextDecoder();
     
     ws.onmessage = function(event) {
-        const data = JSON.parse(event.data);
+        const data = JSON.parse(frameDecoder.decode(event.data));
         updateDeviceStatus(data);
         updateDashboardSummary(data);
         
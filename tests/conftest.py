@@ -0,0 +1,21 @@
+import os
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional; the default asyncio loop is used without it
+    uvloop = None
+
+# Redis servers have 16 logical databases by default
+REDIS_DATABASES = 16
+
+
+def pytest_configure(config):
+    """Run async tests on the same loop implementation the services use"""
+    if uvloop is not None:
+        uvloop.install()
+
+    # Each xdist worker (gw0, gw1, ...) gets its own Redis database, so tests
+    # running side by side never see each other's queues and histories
+    worker = os.getenv("PYTEST_XDIST_WORKER")
+    if worker is not None:
+        os.environ.setdefault("REDIS_DB", str(int(worker[2:]) % REDIS_DATABASES))
@@ -1,7 +1,10 @@
 import pytest
 import asyncio
 import json
-from unittest.mock import Mock, AsyncMock, patch
+import statistics
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+from pydantic import ValidationError
 import sys
 sys.path.append('.')
 
@@ -9,6 +12,20 @@ from ai_agents.base_agent import BaseAgent, AgentMessage
 from ai_agents.monitoring_agent import MonitoringAgent
 from ai_agents.control_agent import ControlAgent
 from ai_agents.analytics_agent import AnalyticsAgent
+from ai_agents.a2a_protocol import A2AProtocol
+from ai_agents.http_client import close_shared_client, get_shared_client
+
+
+def make_response(body=None, status_code=200):
+    """Build a stand-in for an httpx response carrying a JSON body"""
+    return SimpleNamespace(status_code=status_code, headers={}, json=lambda: body)
+
+
+@pytest.fixture
+def mock_post():
+    """Patch POST on the HTTP client shared by all agents"""
+    with patch.object(get_shared_client(), "post", new_callable=AsyncMock) as mock:
+        yield mock
 
 
 class TestBaseAgent:
@@ -23,6 +40,9 @@ class TestBaseAgent:
             
             async def process_message(self, message: AgentMessage):
                 return {"processed": True}
+            
+            async def run(self):
+                pass
         
         return MockAgent("test-agent", "mock", "http://localhost:8000")
 
@@ -41,12 +61,9 @@ class TestBaseAgent:
         assert len(mock_agent.agent_id) == 36  # UUID length
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
     async def test_agent_registration(self, mock_post, mock_agent):
         """Test agent registers with intermediary"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_post.return_value = mock_response
+        mock_post.return_value = make_response()
         
         await mock_agent.register_with_intermediary()
         
@@ -62,12 +79,9 @@ class TestBaseAgent:
         assert registration_data["capabilities"] == ["test_capability"]
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
     async def test_send_to_agent(self, mock_post, mock_agent):
         """Test agent-to-agent communication"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_post.return_value = mock_response
+        mock_post.return_value = make_response()
         
         target_agent_id = "target-agent-123"
         message_type = "test_message"
@@ -87,16 +101,31 @@ class TestBaseAgent:
         assert message_data["message"]["payload"] == payload
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
+    async def test_send_to_agent_batches_while_running(self, mock_post, mock_agent):
+        """Test messages sent by a running agent are coalesced into one request"""
+        mock_post.return_value = make_response()
+        
+        await mock_agent.start()
+        for i in range(3):
+            await mock_agent.send_to_agent("target-agent-123", "test_message", {"index": i})
+        await mock_agent.stop()
+        
+        # One registration call plus a single batch for all three messages
+        assert mock_post.call_count == 2
+        call_args = mock_post.call_args
+        assert call_args[0][0] == "http://localhost:8000/agents/message_batch"
+        
+        messages = call_args[1]["json"]["messages"]
+        assert [m["message"]["payload"]["index"] for m in messages] == [0, 1, 2]
+        assert all(m["target_agent_id"] == "target-agent-123" for m in messages)
+    
+    @pytest.mark.asyncio
     async def test_query_iot_data(self, mock_post, mock_agent):
         """Test querying IoT data through intermediary"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
+        mock_post.return_value = make_response({
             "status": "success",
             "data": {"temperature": 22.5}
-        }
-        mock_post.return_value = mock_response
+        })
         
         result = await mock_agent.query_iot_data(
             "temperature_sensor",
@@ -115,16 +144,119 @@ class TestBaseAgent:
         assert result["data"]["temperature"] == 22.5
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
+    async def test_query_iot_data_is_cached(self, mock_post, mock_agent):
+        """Test identical queries reuse a recent result until a command is sent"""
+        mock_post.return_value = make_response({"status": "success", "data": {}})
+        
+        await mock_agent.query_iot_data("motion_detector", {"location": "kitchen"})
+        await mock_agent.query_iot_data("motion_detector", {"location": "kitchen"})
+        assert mock_post.call_count == 1
+        
+        await mock_agent.query_iot_data("motion_detector", {"location": "hallway"})
+        assert mock_post.call_count == 2
+        
+        await mock_agent.control_iot_device("switch-1", {"action": "turn_on"})
+        await mock_agent.query_iot_data("motion_detector", {"location": "kitchen"})
+        assert mock_post.call_count == 4
+        
+        # A query still in flight when a command goes out must not cache pre-command state
+        releases = {"before": asyncio.Event(), "after": asyncio.Event()}
+        pending = iter(releases)
+        
+        async def slow_post(url, **kwargs):
+            if url.endswith("/iot/query"):
+                state = next(pending)
+                await releases[state].wait()
+                return make_response({"status": "success", "data": {"state": state}})
+            return make_response({"status": "command_sent"})
+        
+        async def posts_sent(count):
+            while mock_post.call_count < count:
+                await asyncio.sleep(0)
+        
+        mock_post.side_effect = slow_post
+        stale = asyncio.create_task(mock_agent.query_iot_data("smart_switch", {}))
+        await posts_sent(5)
+        await mock_agent.control_iot_device("switch-1", {"action": "turn_off"})
+        # New callers don't join the request that started before the command
+        fresh = asyncio.create_task(mock_agent.query_iot_data("smart_switch", {}))
+        await asyncio.wait_for(posts_sent(7), timeout=1)
+        
+        # The stale response arrives last and still doesn't replace the fresh one
+        releases["after"].set()
+        assert (await fresh)["data"] == {"state": "after"}
+        releases["before"].set()
+        assert (await stale)["data"] == {"state": "before"}
+        assert (await mock_agent.query_iot_data("smart_switch", {}))["data"] == {"state": "after"}
+        assert mock_post.call_count == 7
+    
+    @pytest.mark.asyncio
+    async def test_cached_query_results_are_copies(self, mock_post, mock_agent):
+        """Test queries with list parameters are cached and callers can't alter the cache"""
+        mock_post.return_value = make_response({"status": "success", "data": {"devices": {}}})
+        query_params = {"fields": ["temperature", "humidity"], "location": "kitchen"}
+        
+        first = await mock_agent.query_iot_data("temperature_sensor", query_params)
+        first["data"]["devices"]["temp-1"] = {"temperature": 99.0}
+        second = await mock_agent.query_iot_data("temperature_sensor", dict(reversed(query_params.items())))
+        
+        assert mock_post.call_count == 1
+        assert second == {"status": "success", "data": {"devices": {}}}
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_queries_share_one_request(self, mock_agent):
+        """Test identical queries issued together wait on a single request"""
+        release = asyncio.Event()
+        mock_response = make_response({"status": "success", "data": {}})
+        
+        async def slow_post(*args, **kwargs):
+            await release.wait()
+            return mock_response
+        
+        with patch.object(get_shared_client(), "post", side_effect=slow_post) as mock_post:
+            queries = [
+                asyncio.create_task(mock_agent.query_iot_data("motion_detector", {}))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*queries)
+        
+        assert mock_post.call_count == 1
+        assert results == [{"status": "success", "data": {}}] * 3
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_query_does_not_cancel_other_waiters(self, mock_agent):
+        """Test cancelling the caller that started a shared query leaves the others waiting"""
+        release = asyncio.Event()
+        mock_response = make_response({"status": "success", "data": {}})
+        
+        async def slow_post(*args, **kwargs):
+            await release.wait()
+            return mock_response
+        
+        with patch.object(get_shared_client(), "post", side_effect=slow_post) as mock_post:
+            originator = asyncio.create_task(mock_agent.query_iot_data("motion_detector", {}))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(mock_agent.query_iot_data("motion_detector", {}))
+            await asyncio.sleep(0)
+            
+            originator.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            result = await waiter
+        
+        assert originator.cancelled()
+        assert result == {"status": "success", "data": {}}
+        assert mock_post.call_count == 1
+    
+    @pytest.mark.asyncio
     async def test_control_iot_device(self, mock_post, mock_agent):
         """Test sending control commands to IoT devices"""
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
+        mock_post.return_value = make_response({
             "status": "command_sent",
             "device_id": "switch-1"
-        }
-        mock_post.return_value = mock_response
+        })
         
         result = await mock_agent.control_iot_device(
             "switch-1",
@@ -142,6 +274,21 @@ class TestBaseAgent:
         assert control_data["command"]["brightness"] == 75
         
         assert result["status"] == "command_sent"
+    
+    @pytest.mark.asyncio
+    async def test_http_client_is_shared(self, mock_agent):
+        """Test all agents reuse one HTTP client until it is closed"""
+        client = mock_agent.http_client
+        assert mock_agent.http_client is client
+        assert MonitoringAgent("monitor-2", "http://localhost:8000").http_client is client
+        
+        await mock_agent.stop()
+        assert not client.is_closed
+        
+        await close_shared_client()
+        
+        assert client.is_closed
+        assert mock_agent.http_client is not client
 
 
 class TestMonitoringAgent:
@@ -160,13 +307,10 @@ class TestMonitoringAgent:
         assert "anomaly_detection" in capabilities
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
     async def test_analyze_temperature_trends(self, mock_post, monitoring_agent):
         """Test temperature trend analysis"""
         # Mock IoT data query response
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
+        mock_post.return_value = make_response({
             "status": "success",
             "data": [
                 {"temperature": 20.5, "timestamp": 1000},
@@ -175,18 +319,20 @@ class TestMonitoringAgent:
                 {"temperature": 22.0, "timestamp": 4000},
                 {"temperature": 23.5, "timestamp": 5000}
             ]
-        }
-        mock_post.return_value = mock_response
+        })
         
         trend = await monitoring_agent.analyze_temperature_trends("room-1")
         
         assert trend["trend"] == "increasing"
         assert trend["average_temp"] == 21.7
         assert trend["rate_of_change"] > 0
+        # Least-squares slope over all readings, not just first vs last
+        assert trend["rate_of_change"] == pytest.approx(0.7)
     
     @pytest.mark.asyncio
     async def test_detect_anomalies(self, monitoring_agent):
         """Test anomaly detection in sensor data"""
+        monitoring_agent.report_most_extreme = True
         sensor_data = [
             {"temperature": 20.5, "timestamp": 1000},
             {"temperature": 21.0, "timestamp": 2000},
@@ -200,6 +346,66 @@ class TestMonitoringAgent:
         assert len(anomalies) == 1
         assert anomalies[0]["temperature"] == 45.0
         assert anomalies[0]["anomaly_score"] > 0.8
+    
+    def test_detect_anomalies_without_fallback(self, monitoring_agent):
+        """Test only readings past the z-score threshold are reported by default"""
+        sensor_data = [{"temperature": t} for t in (20.5, 21.0, 45.0, 21.5, 22.0)]
+        
+        assert monitoring_agent.detect_anomalies(sensor_data) == []
+        assert sensor_data[2]["anomaly_score"] == pytest.approx(1.7864, abs=1e-4)
+    
+    def test_score_reading(self, monitoring_agent):
+        """Test streamed readings are scored against a rolling window per sensor"""
+        monitoring_agent.stats_window = 4
+        for temperature in (30.0, 31.0, 20.0, 21.0, 20.5, 21.5):
+            monitoring_agent.score_reading("temp-1", temperature)
+        
+        # Only the last four readings remain in the window
+        window = [20.0, 21.0, 20.5, 21.5]
+        stats = monitoring_agent._stat_state["temp-1"]
+        assert stats.mean == pytest.approx(statistics.mean(window))
+        assert stats.stdev == pytest.approx(statistics.stdev(window))
+        
+        expected = abs(45.0 - statistics.mean(window)) / statistics.stdev(window)
+        assert monitoring_agent.score_reading("temp-1", 45.0) == pytest.approx(expected)
+        assert monitoring_agent.score_reading("temp-2", 45.0) == 0
+    
+    @pytest.mark.asyncio
+    async def test_check_temperature_readings(self, monitoring_agent):
+        """Test each new sensor reading is scored once and outliers are reported"""
+        readings = [20.0, 21.0, 20.5, 21.0, 21.0, 45.0]
+        
+        async def query(device_type, query_params):
+            return {"status": "success", "data": {"devices": {"temp-1": {"temperature": readings[0]}}}}
+        
+        with patch.object(monitoring_agent, "query_iot_data", side_effect=query):
+            results = []
+            while readings:
+                results.append(await monitoring_agent.check_temperature_readings())
+                readings.pop(0)
+        
+        # The repeated 21.0 was the same cached reading, so it only entered the window once
+        assert len(monitoring_agent._stat_state["temp-1"].values) == 5
+        assert results[:-1] == [[]] * 5
+        assert [a["sensor_id"] for a in results[-1]] == ["temp-1"]
+        assert results[-1][0]["anomaly_score"] > 2
+    
+    @pytest.mark.asyncio
+    async def test_new_readings_notify_subscribers(self, monitoring_agent):
+        """Test subscribed agents get an iot_data_update only when readings change"""
+        await monitoring_agent.process_message(AgentMessage(
+            agent_id="analytics-1", message_type="subscribe_data_updates", payload={}, timestamp=0
+        ))
+        response = {"status": "success", "data": {"devices": {"temp-1": {"temperature": 20.0}}}}
+        
+        with patch.object(monitoring_agent, "query_iot_data", new_callable=AsyncMock, return_value=response), \
+             patch.object(monitoring_agent, "send_to_agent", new_callable=AsyncMock) as mock_send:
+            await monitoring_agent.check_temperature_readings()
+            await monitoring_agent.check_temperature_readings()
+        
+        mock_send.assert_called_once_with(
+            "analytics-1", "iot_data_update", {"device_type": "temperature_sensor", "device_ids": ["temp-1"]}
+        )
 
 
 class TestControlAgent:
@@ -218,24 +424,19 @@ class TestControlAgent:
         assert "scene_management" in capabilities
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
     async def test_automated_lighting_control(self, mock_post, control_agent):
         """Test automated lighting based on motion detection"""
         # Mock motion detection query
-        motion_response = Mock()
-        motion_response.status_code = 200
-        motion_response.json.return_value = {
+        motion_response = make_response({
             "status": "success",
             "data": {"motion_detected": True, "location": "living_room"}
-        }
+        })
         
         # Mock control command response
-        control_response = Mock()
-        control_response.status_code = 200
-        control_response.json.return_value = {
+        control_response = make_response({
             "status": "command_sent",
             "device_id": "light-1"
-        }
+        })
         
         mock_post.side_effect = [motion_response, control_response]
         
@@ -247,6 +448,79 @@ class TestControlAgent:
         # Verify two calls were made
         assert mock_post.call_count == 2
     
+    @pytest.mark.asyncio
+    async def test_apply_automation_rules(self, control_agent):
+        """Test automation rules act on the current device state"""
+        control_agent.automation_rules = [
+            {"type": "motion_lighting", "location": "room_1", "target_switch": "switch-0"},
+            {"type": "temperature_control", "temperature_sensor": "temp-1",
+             "target_device": "fan-1", "max_temperature": 25}
+        ]
+        device_state = {
+            "motion_detector": {"devices": {"motion-1": {"location": "room_1", "motion_detected": True}}},
+            "temperature_sensor": {"devices": {"temp-1": {"temperature": 30.0}}}
+        }
+        
+        async def query(device_type, query_params):
+            return device_state[device_type]
+        
+        with patch.object(control_agent, "query_iot_data", side_effect=query), \
+             patch.object(control_agent, "control_iot_devices_batch", new_callable=AsyncMock) as mock_batch:
+            await control_agent.apply_automation_rules()
+        
+        # All commands for the tick go out in a single batch
+        mock_batch.assert_called_once_with([
+            ("switch-0", {"action": "turn_on", "brightness": 80}),
+            ("fan-1", {"action": "turn_on"})
+        ])
+    
+    @pytest.mark.asyncio
+    async def test_failing_rule_does_not_cancel_others(self, control_agent):
+        """Test a rule that raises on bad device data only skips its own commands"""
+        control_agent.automation_rules = [
+            {"type": "temperature_control", "temperature_sensor": "temp-1", "target_device": "fan-1"},
+            {"type": "motion_lighting", "location": "room_1", "target_switch": "switch-0"}
+        ]
+        device_state = {
+            "motion_detector": {"devices": {"motion-1": {"location": "room_1", "motion_detected": True}}},
+            # A sensor without a reading makes the temperature comparison raise
+            "temperature_sensor": {"devices": {"temp-1": {"temperature": None}}}
+        }
+        
+        async def query(device_type, query_params):
+            return device_state[device_type]
+        
+        with patch.object(control_agent, "query_iot_data", side_effect=query), \
+             patch.object(control_agent, "control_iot_devices_batch", new_callable=AsyncMock) as mock_batch:
+            await control_agent.apply_automation_rules()
+        
+        mock_batch.assert_called_once_with([("switch-0", {"action": "turn_on", "brightness": 80})])
+    
+    @pytest.mark.asyncio
+    async def test_add_automation_rule_message(self, control_agent):
+        """Test rules added over A2A are compiled and acknowledged"""
+        message = AgentMessage(
+            agent_id="analytics-1",
+            message_type="add_automation_rule",
+            payload={"rule": {"type": "temperature_control", "temperature_sensor": "temp-1",
+                              "target_device": "heater-1", "heating_action": "boost"}},
+            timestamp=0
+        )
+        
+        with patch.object(control_agent, "send_to_agent", new_callable=AsyncMock) as mock_send:
+            await control_agent.process_message(message)
+        
+        mock_send.assert_called_once_with("analytics-1", "rule_added", {"rule_id": 0})
+        evaluate = control_agent.compiled_rules[0]
+        assert evaluate({}, {"temp-1": {"temperature": 10.0}}) == [("heater-1", {"action": "boost"})]
+        assert evaluate({}, {}) == []
+        
+        # The rules can only change through the setter or add_automation_rule
+        rules = control_agent.automation_rules
+        assert isinstance(rules, tuple)
+        rules[0]["heating_action"] = "turn_off"
+        assert control_agent.automation_rules[0]["heating_action"] == "boost"
+    
     @pytest.mark.asyncio
     async def test_create_scene(self, control_agent):
         """Test creating and storing scenes"""
@@ -281,21 +555,17 @@ class TestAnalyticsAgent:
         assert "reporting" in capabilities
     
     @pytest.mark.asyncio
-    @patch('httpx.AsyncClient.post')
     async def test_energy_consumption_analysis(self, mock_post, analytics_agent):
         """Test energy consumption analysis"""
         # Mock device data
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
+        mock_post.return_value = make_response({
             "status": "success",
             "data": [
                 {"device_id": "switch-1", "power_usage": 50, "duration": 3600},
                 {"device_id": "switch-2", "power_usage": 100, "duration": 1800},
                 {"device_id": "switch-3", "power_usage": 75, "duration": 7200}
             ]
-        }
-        mock_post.return_value = mock_response
+        })
         
         analysis = await analytics_agent.analyze_energy_consumption()
         
@@ -304,6 +574,45 @@ class TestAnalyticsAgent:
         assert "recommendations" in analysis
         assert analysis["total_consumption"] > 0
     
+    @pytest.mark.asyncio
+    async def test_analyze_temperature_patterns(self, analytics_agent):
+        """Test temperature patterns only use the most recent readings"""
+        for i in range(12):
+            devices = {"temp-1": {"temperature": 20.0 + i}}
+            if i < 2:
+                # temp-2 stops reporting before the analysis window
+                devices["temp-2"] = {"temperature": 18.0}
+            analytics_agent.store_historical_data("temperature", i, {"devices": devices})
+        
+        await analytics_agent.analyze_temperature_patterns()
+        
+        result = analytics_agent.analysis_results["temperature_patterns"]["result"]
+        assert list(result) == ["temp-1"]
+        assert result["temp-1"]["average_temperature"] == 26.5
+        assert result["temp-1"]["trend"] == 9.0
+        assert result["temp-1"]["trend_direction"] == "rising"
+    
+    @pytest.mark.asyncio
+    async def test_iot_data_update_wakes_analysis(self, analytics_agent):
+        """Test an IoT data notification triggers analysis before the timeout"""
+        analytics_agent.collect_data_for_analysis = AsyncMock()
+        analytics_agent._running = True
+        run_task = asyncio.create_task(analytics_agent.run())
+        await asyncio.sleep(0.01)
+        
+        await analytics_agent.process_message(AgentMessage(
+            agent_id="monitor-1",
+            message_type="iot_data_update",
+            payload={},
+            timestamp=0
+        ))
+        await asyncio.sleep(0.01)
+        
+        analytics_agent._running = False
+        run_task.cancel()
+        await asyncio.gather(run_task, return_exceptions=True)
+        assert analytics_agent.collect_data_for_analysis.call_count == 2
+    
     @pytest.mark.asyncio
     async def test_predict_temperature(self, analytics_agent):
         """Test temperature prediction based on historical data"""
@@ -320,3 +629,82 @@ class TestAnalyticsAgent:
         assert "confidence" in prediction
         assert 23.0 <= prediction["predicted_temperature"] <= 25.0
         assert 0.0 <= prediction["confidence"] <= 1.0
+
+
+class TestA2AProtocol:
+    """Test suite for the Agent-to-Agent protocol"""
+    
+    @pytest.fixture
+    def protocol(self):
+        protocol = A2AProtocol()
+        
+        async def echo_handler(message):
+            return protocol.create_response(message, "pong", {"echo": message.payload})
+        
+        async def ack_handler(message):
+            return protocol.create_response(message, "ack", {})
+        
+        protocol.register_handler("ping", echo_handler)
+        protocol.register_handler("pong", ack_handler)
+        return protocol
+    
+    def test_serialization_round_trip(self, protocol):
+        """Test messages survive serialization unchanged"""
+        message = protocol.create_message("agent-a", "agent-b", "ping", {"value": 1})
+        
+        restored = protocol.deserialize_message(protocol.serialize_message(message))
+        
+        assert restored == message
+    
+    def test_serialization_is_cached(self, protocol):
+        """Test a message is serialized once and copies re-serialize"""
+        message = protocol.create_message("agent-a", "agent-b", "ping", {"value": 1})
+        
+        serialized = protocol.serialize_message(message)
+        assert protocol.serialize_message(message) is serialized
+        
+        updated = message.copy(update={"ttl": 5})
+        assert protocol.deserialize_message(protocol.serialize_message(updated)).ttl == 5
+        
+        trimmed = message.copy(exclude={"correlation_id"})
+        assert "correlation_id" not in json.loads(protocol.serialize_message(trimmed))
+    
+    def test_trusted_deserialization(self, protocol):
+        """Test trusted peers skip validation unless the schema doesn't match"""
+        protocol.trust_peer = True
+        message = protocol.create_message("agent-a", "agent-b", "ping", {"value": 1})
+        
+        assert protocol.deserialize_message(protocol.serialize_message(message)) == message
+        
+        with pytest.raises(ValidationError):
+            protocol.deserialize_message(json.dumps({**message.dict(), "schema_version": 2}))
+    
+    @pytest.mark.asyncio
+    async def test_get_message_chain(self, protocol):
+        """Test message chains follow responses from the root message"""
+        root = protocol.create_message("agent-a", "agent-b", "ping", {"value": 1})
+        response = await protocol.process_message(root)
+        
+        # Feed the response back in so the chain grows one level deeper
+        ack = await protocol.process_message(response)
+        
+        chain = protocol.get_message_chain(root.message_id)
+        
+        assert [m.message_id for m in chain] == [root.message_id, response.message_id, ack.message_id]
+        assert protocol.get_message_chain("unknown-id") == []
+    
+    @pytest.mark.asyncio
+    async def test_cleanup_old_messages(self, protocol):
+        """Test only expired messages are removed from history"""
+        old_message = protocol.create_message("agent-a", "agent-b", "ping", {"value": 1})
+        await protocol.process_message(old_message)
+        for entry in protocol.message_history.values():
+            entry["received_at"] -= 7200
+        
+        new_message = protocol.create_message("agent-a", "agent-b", "status", {})
+        await protocol.process_message(new_message)
+        
+        protocol.cleanup_old_messages(max_age_seconds=3600)
+        
+        assert list(protocol.message_history) == [new_message.message_id]
+        assert old_message.message_id not in protocol._children
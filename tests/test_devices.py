@@ -10,6 +10,7 @@ from iot_devices.base_device import BaseIoTDevice
 from iot_devices.temperature_sensor import TemperatureSensor
 from iot_devices.motion_detector import MotionDetector
 from iot_devices.smart_switch import SmartSwitch
+from iot_devices.simulator import run_devices
 
 
 class TestBaseIoTDevice:
@@ -71,6 +72,40 @@ class TestBaseIoTDevice:
             mock_device.on_message(mock_client, None, mock_msg)
             mock_handle.assert_called_once_with({"action": "test_command"})
     
+    def test_shared_client_routes_commands_by_topic(self):
+        """Test devices on a shared client get only their own commands and don't connect it"""
+        client = mqtt.Client(client_id="shared-test")
+        sensor = TemperatureSensor("temp-shared", "localhost", client=client)
+        switch = SmartSwitch("switch-shared", "localhost", client=client)
+        
+        message = mqtt.MQTTMessage(topic=b"devices/switch-shared/commands")
+        message.payload = json.dumps({"action": "turn_on"}).encode()
+        client._handle_on_message(message)
+        
+        assert switch.is_on
+        assert sensor.client is switch.client
+        assert not sensor.owns_client
+    
+    @pytest.mark.asyncio
+    async def test_run_devices_publishes_each_device_per_tick(self):
+        """Test the shared timer publishes one reading per device each tick"""
+        client = Mock()
+        devices = [
+            TemperatureSensor("temp-tick", "localhost", client=client),
+            SmartSwitch("switch-tick", "localhost", client=client)
+        ]
+        
+        task = asyncio.create_task(run_devices(devices))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        
+        topics = [call[0][0] for call in client.publish.call_args_list]
+        assert topics == [
+            "devices/temperature_sensor/temp-tick/data",
+            "devices/smart_switch/switch-tick/data"
+        ]
+    
     def test_on_message_handles_invalid_json(self, mock_device):
         """Test handling of invalid JSON in messages"""
         mock_client = Mock()
@@ -255,20 +290,20 @@ class TestSmartSwitch:
         smart_switch.handle_command(command)
         assert smart_switch.mode == "eco"
     
-    def test_power_consumption_calculation(self, smart_switch):
-        """Test power consumption varies with brightness"""
+    @pytest.mark.parametrize("brightness,expected_power", [
+        (0, 0.2),
+        (50, 5.0),
+        (100, 10.0)
+    ])
+    def test_power_consumption_calculation(self, smart_switch, brightness, expected_power):
+        """Test power consumption increases with brightness"""
         smart_switch.state = "on"
+        smart_switch.brightness = brightness
         
-        # Test different brightness levels
-        smart_switch.brightness = 0
-        power_0 = smart_switch.generate_data()["power_consumption"]
-        
-        smart_switch.brightness = 50
-        power_50 = smart_switch.generate_data()["power_consumption"]
-        
-        smart_switch.brightness = 100
-        power_100 = smart_switch.generate_data()["power_consumption"]
+        assert smart_switch.generate_data()["power_consumption"] == expected_power
+    
+    def test_power_consumption_fractional_brightness(self, smart_switch):
+        """Test brightness levels between whole percentages still get a power reading"""
+        smart_switch.handle_command({"action": "turn_on", "brightness": 75.5})
         
-        # Power should increase with brightness
-        assert power_0 < power_50 < power_100
-
+        assert smart_switch.generate_data()["power_consumption"] == round(0.2 + 0.755 * 9.8, 2)
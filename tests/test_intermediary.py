@@ -1,25 +1,31 @@
 import pytest
 import asyncio
+import hashlib
 import json
+import threading
 import time
+import httpx
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, AsyncMock, patch, MagicMock
 import sys
 sys.path.append('.')
 
 from intermediary.api_gateway import app, registered_agents
-from intermediary.mqtt_handler import MQTTHandler
+from intermediary.mqtt_handler import MQTTHandler, TopicTrie
 from intermediary.data_transformer import DataTransformer
-from intermediary.message_router import MessageRouter
+from intermediary.message_router import MessageRouter, pack_queue_item, unpack_queue_item
+from intermediary.security_manager import SecurityManager
+from intermediary.redis_client import get_redis_pool
 
 
+@pytest.fixture(scope="module")
+def client():
+    """TestClient shared by the module; startup events are not run, as before"""
+    return TestClient(app)
+
 class TestAPIGateway:
     """Test suite for API Gateway endpoints"""
     
-    @pytest.fixture
-    def client(self):
-        return TestClient(app)
-    
     @pytest.fixture(autouse=True)
     def clear_agents(self):
         """Clear registered agents before each test"""
@@ -39,10 +45,32 @@ class TestAPIGateway:
         response = client.post("/agents/register", json=agent_data)
         
         assert response.status_code == 200
-        assert response.json()["status"] == "registered"
-        assert response.json()["agent_id"] == "test-agent-123"
+        response_json = response.json()
+        assert response_json["status"] == "registered"
+        assert response_json["agent_id"] == "test-agent-123"
         assert "test-agent-123" in registered_agents
     
+    def test_register_agent_msgpack(self, client):
+        """Test agents can exchange msgpack bodies with the gateway"""
+        msgpack = pytest.importorskip("msgpack")
+        agent_data = {
+            "agent_id": "test-agent-456",
+            "name": "Test Agent",
+            "agent_type": "monitoring",
+            "capabilities": ["temperature_monitoring"]
+        }
+        
+        response = client.post(
+            "/agents/register",
+            content=msgpack.packb(agent_data),
+            headers={"content-type": "application/msgpack", "accept": "application/msgpack"}
+        )
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/msgpack"
+        assert msgpack.unpackb(response.content) == {"status": "registered", "agent_id": "test-agent-456"}
+        assert registered_agents["test-agent-456"] == agent_data
+    
     def test_forward_agent_message_success(self, client):
         """Test successful message forwarding between agents"""
         # Register source and target agents
@@ -66,6 +94,38 @@ class TestAPIGateway:
             assert response.json()["status"] == "forwarded"
             mock_route.assert_called_once()
     
+    def test_forward_agent_message_batch(self, client):
+        """Test a batch of messages is forwarded and unknown targets are reported"""
+        registered_agents["target-agent"] = {"name": "Target"}
+        
+        batch_data = {
+            "messages": [
+                {
+                    "source_agent_id": "source-agent",
+                    "target_agent_id": "target-agent",
+                    "message": {"message_type": "test_message", "payload": {"index": i}}
+                }
+                for i in range(2)
+            ] + [
+                {
+                    "source_agent_id": "source-agent",
+                    "target_agent_id": "non-existent",
+                    "message": {"message_type": "test_message", "payload": {}}
+                }
+            ]
+        }
+        
+        with patch('intermediary.message_router.MessageRouter.route_a2a_messages',
+                   new_callable=AsyncMock) as mock_route:
+            response = client.post("/agents/message_batch", json=batch_data)
+            
+            assert response.status_code == 200
+            response_json = response.json()
+            assert response_json["forwarded"] == 2
+            assert response_json["not_found"] == ["non-existent"]
+            mock_route.assert_called_once()
+            assert [target for _, target, _ in mock_route.call_args[0][0]] == ["target-agent"] * 2
+    
     def test_forward_agent_message_target_not_found(self, client):
         """Test message forwarding with non-existent target"""
         registered_agents["source-agent"] = {"name": "Source"}
@@ -99,8 +159,9 @@ class TestAPIGateway:
         response = client.post("/iot/query", json=query_data)
         
         assert response.status_code == 200
-        assert response.json()["status"] == "success"
-        assert "data" in response.json()
+        response_json = response.json()
+        assert response_json["status"] == "success"
+        assert "data" in response_json
     
     @patch('intermediary.api_gateway.validate_agent_permissions')
     @patch('intermediary.mqtt_handler.MQTTHandler.publish_command')
@@ -118,8 +179,58 @@ class TestAPIGateway:
         response = client.post("/iot/control", json=control_data)
         
         assert response.status_code == 200
-        assert response.json()["status"] == "command_sent"
-        assert response.json()["device_id"] == "switch-1"
+        response_json = response.json()
+        assert response_json["status"] == "command_sent"
+        assert response_json["device_id"] == "switch-1"
+    
+    @patch('intermediary.mqtt_handler.MQTTHandler.publish_command')
+    def test_control_iot_devices_batch(self, mock_publish, client):
+        """Test batched control commands are published per authorized device"""
+        registered_agents["test-agent"] = {"name": "Test"}
+        mock_publish.return_value = None
+        
+        with patch('intermediary.api_gateway.validate_agent_permissions',
+                   side_effect=lambda agent_id, device_id, action: device_id != "locked-1"):
+            response = client.post("/iot/control_batch", json={
+                "agent_id": "test-agent",
+                "commands": [
+                    {"device_id": "switch-1", "command": {"action": "turn_on"}},
+                    {"device_id": "locked-1", "command": {"action": "turn_on"}}
+                ]
+            })
+        
+        assert response.status_code == 200
+        assert response.json()["results"] == [
+            {"device_id": "switch-1", "status": "command_sent"},
+            {"device_id": "locked-1", "status": "unauthorized"}
+        ]
+        mock_publish.assert_called_once()
+    
+    @patch('intermediary.mqtt_handler.MQTTHandler.publish_command')
+    @patch('intermediary.api_gateway.validate_agent_permissions')
+    def test_control_iot_devices_batch_checks_each_device_once(self, mock_validate, mock_publish, client):
+        """Test repeated devices in a batch reuse the request's permission check"""
+        mock_validate.return_value = True
+        mock_publish.return_value = None
+        
+        response = client.post("/iot/control_batch", json={
+            "agent_id": "test-agent",
+            "commands": [
+                {"device_id": "switch-1", "command": {"action": "turn_on"}},
+                {"device_id": "switch-1", "command": {"action": "turn_off"}},
+                {"device_id": "switch-2", "command": {"action": "turn_on"}}
+            ]
+        })
+        
+        assert response.status_code == 200
+        assert mock_validate.call_count == 2
+        assert mock_publish.call_count == 3
+    
+    def test_control_iot_device_missing_field(self, client):
+        """Test malformed control bodies are rejected before reaching the handler"""
+        response = client.post("/iot/control", json={"agent_id": "test-agent", "command": {"action": "turn_on"}})
+        
+        assert response.status_code == 422
     
     @patch('intermediary.api_gateway.validate_agent_permissions')
     def test_control_iot_device_unauthorized(self, mock_validate, client):
@@ -141,9 +252,22 @@ class TestAPIGateway:
 class TestMQTTHandler:
     """Test suite for MQTT Handler"""
     
+    @pytest.fixture(scope="class")
+    async def shared_mqtt_handler(self):
+        """MQTTHandler (and its paho client) created once for the class"""
+        handler = MQTTHandler()
+        yield handler
+        await handler.disconnect()
+    
     @pytest.fixture
-    def mqtt_handler(self):
-        return MQTTHandler()
+    def mqtt_handler(self, shared_mqtt_handler):
+        """The shared MQTTHandler with subscriptions and cached device data reset for each test"""
+        shared_mqtt_handler.subscriptions.clear()
+        shared_mqtt_handler._subscription_trie = TopicTrie()
+        shared_mqtt_handler.message_buffer.clear()
+        shared_mqtt_handler.device_data_cache.clear()
+        shared_mqtt_handler.devices_by_location.clear()
+        return shared_mqtt_handler
     
     @pytest.mark.asyncio
     async def test_mqtt_handler_initialization(self, mqtt_handler):
@@ -178,9 +302,28 @@ class TestMQTTHandler:
         # The on_connect method automatically subscribes to "devices/+/+/data"
         # so we need to check that mock_subscribe was called with our topic as well
         assert mock_subscribe.call_count >= 1
-        assert any(call[0][0] == topic for call in mock_subscribe.call_args_list)
+        subscribed_topics = {call[0][0] for call in mock_subscribe.call_args_list}
+        assert topic in subscribed_topics
         assert topic in mqtt_handler.subscriptions
     
+    @pytest.mark.asyncio
+    @patch('paho.mqtt.client.Client.subscribe')
+    @patch('paho.mqtt.client.Client.unsubscribe')
+    async def test_subscribe_to_update_batches(self, mock_unsubscribe, mock_subscribe, mqtt_handler):
+        """Test a burst of updates is delivered as one batch"""
+        updates = mqtt_handler.subscribe_to_update_batches("test-agent")
+        first_batch = asyncio.ensure_future(updates.__anext__())
+        while "devices/+/+/data" not in mqtt_handler.subscriptions:
+            await asyncio.sleep(0.01)
+        
+        callback = mqtt_handler.subscriptions["devices/+/+/data"][0]
+        for index in range(3):
+            await callback("devices/temperature_sensor/temp-1/data", {"index": index})
+        
+        batch = await asyncio.wait_for(first_batch, timeout=1)
+        assert [update["index"] for update in batch] == [0, 1, 2]
+        await updates.aclose()
+    
     @pytest.mark.asyncio
     @patch('paho.mqtt.client.Client.publish')
     async def test_publish_command(self, mock_publish, mqtt_handler):
@@ -201,6 +344,64 @@ class TestMQTTHandler:
         assert topic == f"devices/{device_id}/commands"
         assert json.loads(payload) == command
     
+    def test_topic_trie_matching(self):
+        """Test subscription patterns are matched with MQTT wildcard rules"""
+        trie = TopicTrie()
+        for pattern in ("devices/+/+/data", "devices/#", "devices/switch/+/data", "system/status"):
+            trie.add(pattern)
+        
+        assert sorted(trie.match("devices/temperature_sensor/temp-1/data")) == [
+            "devices/#", "devices/+/+/data"
+        ]
+        assert sorted(trie.match("devices/switch/switch-1/data")) == [
+            "devices/#", "devices/+/+/data", "devices/switch/+/data"
+        ]
+        assert trie.match("system/status") == ["system/status"]
+        assert trie.match("system/control") == []
+        
+        trie.remove("devices/#")
+        assert trie.match("devices/switch-1/commands") == []
+    
+    def test_topic_matches_subscription(self, mqtt_handler):
+        """Test single topic/pattern matching agrees with the trie's wildcard rules"""
+        matches = mqtt_handler.topic_matches_subscription
+        assert matches("devices/+/+/data", "devices/switch/switch-1/data")
+        assert not matches("devices/+/+/data", "devices/switch-1/commands")
+        assert matches("devices/#", "devices/switch/switch-1/data")
+        assert matches("devices/#", "devices")
+        assert matches("system/status", "system/status")
+        assert not matches("system/status", "system/status/extra")
+    
+    @pytest.mark.asyncio
+    @patch('paho.mqtt.client.Client.subscribe')
+    @patch('paho.mqtt.client.Client.connect_async')
+    async def test_on_message_dispatches_from_network_thread(self, mock_connect, mock_subscribe, mqtt_handler):
+        """Test messages received on paho's thread reach subscription callbacks on the loop"""
+        mqtt_handler.connected = True
+        received = asyncio.Queue()
+        
+        async def callback(topic, payload):
+            await received.put((topic, payload))
+        
+        await mqtt_handler.subscribe("devices/+/+/data", callback)
+        await mqtt_handler.connect()
+        
+        message = Mock(topic="devices/switch/switch-1/data", payload=b'{"data": {"is_on": true}}')
+        thread = threading.Thread(target=mqtt_handler.on_message, args=(None, None, message))
+        thread.start()
+        thread.join()
+        
+        topic, payload = await asyncio.wait_for(received.get(), timeout=1)
+        assert topic == "devices/switch/switch-1/data"
+        assert payload == {"data": {"is_on": True}}
+        
+        # The cache is written on the loop, not on paho's thread
+        result = await mqtt_handler.query_device_data("switch", {})
+        assert result == {"devices": {"switch-1": {"is_on": True}}}
+        
+        mqtt_handler.connected = False
+        await mqtt_handler.disconnect()
+    
     def test_on_message_callback(self, mqtt_handler):
         """Test MQTT message callback processing"""
         # Create topic and payload
@@ -218,6 +419,23 @@ class TestMQTTHandler:
         assert "temperature_sensor" in mqtt_handler.device_data_cache
         assert "temp-1" in mqtt_handler.device_data_cache["temperature_sensor"]
         assert mqtt_handler.device_data_cache["temperature_sensor"]["temp-1"]["data"] == payload_data
+    
+    @pytest.mark.asyncio
+    async def test_query_device_data_by_location(self, mqtt_handler):
+        """Test location queries follow devices that move between locations"""
+        mqtt_handler.cache_device_data("devices/motion_detector/motion-1/data",
+                                       {"data": {"location": "room_1", "motion_detected": True}})
+        mqtt_handler.cache_device_data("devices/motion_detector/motion-2/data",
+                                       {"data": {"location": "room_2", "motion_detected": False}})
+        mqtt_handler.cache_device_data("devices/motion_detector/motion-1/data",
+                                       {"data": {"location": "room_2", "motion_detected": False}})
+        
+        room_1 = await mqtt_handler.query_device_data("motion_detector", {"location": "room_1"})
+        room_2 = await mqtt_handler.query_device_data("motion_detector",
+                                                      {"location": "room_2", "time_range": "last_minute"})
+        
+        assert room_1 == {"devices": {}}
+        assert set(room_2["devices"]) == {"motion-1", "motion-2"}
 
 
 class TestDataTransformer:
@@ -243,14 +461,12 @@ class TestDataTransformer:
         result = transformer.transform_mqtt_to_agent(mqtt_data)
         
         # The actual implementation returns a structure with 'devices' as the top-level key
-        assert "devices" in result
-        assert "temp-1" in result["devices"]
-        assert "temperature" in result["devices"]["temp-1"]
-        assert result["devices"]["temp-1"]["temperature"] == 22.5
-        assert result["devices"]["temp-1"]["humidity"] == 60
-        assert result["devices"]["temp-1"]["unit"] == "celsius"
-        assert "timestamp" in result
-        assert result["timestamp"] == 1234567890
+        assert result == {
+            "devices": {
+                "temp-1": {"temperature": 22.5, "humidity": 60, "unit": "celsius"}
+            },
+            "timestamp": 1234567890
+        }
     
     def test_transform_mqtt_to_agent_multiple_messages(self, transformer):
         """Test transforming multiple MQTT messages"""
@@ -275,19 +491,10 @@ class TestDataTransformer:
         # doesn't handle lists of messages directly
         results = [transformer.transform_mqtt_to_agent(msg) for msg in mqtt_data]
         
-        assert len(results) == 2
-        
-        # Check first result
-        assert "devices" in results[0]
-        assert "temp-1" in results[0]["devices"]
-        assert results[0]["devices"]["temp-1"]["temperature"] == 22.5
-        assert results[0]["timestamp"] == 1234567890
-        
-        # Check second result
-        assert "devices" in results[1]
-        assert "temp-2" in results[1]["devices"]
-        assert results[1]["devices"]["temp-2"]["temperature"] == 23.0
-        assert results[1]["timestamp"] == 1234567900
+        assert results == [
+            {"devices": {"temp-1": {"temperature": 22.5}}, "timestamp": 1234567890},
+            {"devices": {"temp-2": {"temperature": 23.0}}, "timestamp": 1234567900}
+        ]
     
     def test_transform_command_to_mqtt(self, transformer):
         """Test transforming agent command to MQTT format"""
@@ -299,10 +506,23 @@ class TestDataTransformer:
         
         result = transformer.transform_command_to_mqtt(agent_command)
         
-        assert result["action"] == "set_temperature"
-        assert result["target_temperature"] == 25.0
-        assert result["mode"] == "heating"
         assert "timestamp" in result
+        assert {key: value for key, value in result.items() if key != "timestamp"} == agent_command
+    
+    def test_transform_command_to_mqtt_stamps_send_time(self, transformer):
+        """Test the send time replaces any timestamp supplied with the command"""
+        result = transformer.transform_command_to_mqtt({"action": "turn_on", "timestamp": 0})
+        
+        assert result["action"] == "turn_on"
+        assert result["timestamp"] > 0
+    
+    def test_transform_mqtt_to_agent_passes_through_other_data(self, transformer):
+        """Test data that isn't a single device message is returned unchanged"""
+        partial = {"device_id": "temp-1", "data": {"temperature": 22.5}}
+        
+        assert transformer.transform_mqtt_to_agent(partial) is partial
+        assert transformer.transform_mqtt_to_agent({"status": "ok"}) == {"status": "ok"}
+        assert transformer.transform_mqtt_to_agent([{"temperature": 22.5}]) == [{"temperature": 22.5}]
     
     def test_transform_query_to_mqtt(self, transformer):
         """Test transforming agent query to MQTT format"""
@@ -314,22 +534,55 @@ class TestDataTransformer:
         
         result = transformer.transform_query_to_mqtt(agent_query)
         
-        assert result["time_range"] == "last_hour"
-        assert result["aggregation"] == "average"
-        assert result["fields"] == ["temperature", "humidity"]
+        assert result == agent_query
+    
+    def test_transform_stored_data_for_query(self, transformer):
+        """Test stored data keeps the newest point per device within the time range"""
+        now = time.time()
+        stored_data = [
+            {"device_id": "temp-1", "timestamp": now, "data": {"temperature": 22.0}},
+            {"device_id": "temp-2", "timestamp": now, "data": {"temperature": 19.5}},
+            {"device_id": "temp-1", "timestamp": now - 30, "data": {"temperature": 21.0}},
+            {"device_id": "temp-3", "timestamp": now - 7200, "data": {"temperature": 18.0}}
+        ]
+        
+        result = transformer.transform_stored_data_for_query(stored_data, {"time_range": "last_hour"})
+        
+        assert result == {"devices": {
+            "temp-1": {"temperature": 22.0},
+            "temp-2": {"temperature": 19.5}
+        }}
 
 
-@pytest.fixture
-async def router(): # Removed self
-    """MessageRouter fixture with proper startup and shutdown"""
+@pytest.fixture(scope="module")
+def event_loop():
+    """One event loop for the module, so the shared router and its Redis pool outlive single tests"""
+    loop = asyncio.get_event_loop_policy().new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture(scope="module")
+async def shared_router():
+    """MessageRouter started once for the module"""
     r = MessageRouter()
     await r.start()
     yield r
-    # Teardown code after yield
     print("Stopping router in fixture teardown (top-level)...")
     await r.stop()
     print("Router stopped (top-level).")
 
+@pytest.fixture
+async def router(shared_router):
+    """The shared MessageRouter, reset to its just-started state for each test"""
+    shared_router.agent_connections.clear()
+    shared_router.agent_subscriptions.clear()
+    shared_router.local_agent_queues.clear()
+    shared_router._fanout.clear()
+    await shared_router.redis.delete("agent_connections")
+    yield shared_router
+
+# Keeps the tests using the module-scoped router on one worker, so it starts once
+@pytest.mark.xdist_group(name="router")
 class TestMessageRouter:
     """Test suite for Message Router"""
     
@@ -352,6 +605,17 @@ class TestMessageRouter:
         assert agent_id in router.agent_connections
         # Check agent was stored in Redis
         assert await router.redis.hexists("agent_connections", agent_id)
+
+    @pytest.mark.asyncio
+    async def test_register_agents(self, router):
+        """Test registering several agents in one call"""
+        agents = {"agent-a": {"host": "a"}, "agent-b": {}}
+
+        await router.register_agents(agents)
+
+        assert router.agent_connections == agents
+        stored = await router.redis.hgetall("agent_connections")
+        assert {key.decode(): json.loads(value) for key, value in stored.items()} == agents
     
     @pytest.mark.asyncio
     async def test_route_a2a_message(self, router):
@@ -392,6 +656,186 @@ class TestMessageRouter:
         assert history_message["target_agent_id"] == target_id
         assert history_message["message"] == message
     
+    @pytest.mark.asyncio
+    async def test_device_fanout_follows_subscriptions(self, router):
+        """Test the cached subscriber set for a device tracks (un)subscribes at every level"""
+        key = ("temperature_sensor", "temp-1")
+        await router.subscribe_agent("exact-agent", "devices/temperature_sensor/temp-1")
+        await router.subscribe_agent("type-agent", "devices/temperature_sensor/+")
+        
+        await router.route_device_data(*key, {"temperature": 22.5})
+        assert router._fanout[key] == {"exact-agent", "type-agent"}
+        
+        await router.subscribe_agent("all-agent", "devices/+/+")
+        await router.unsubscribe_agent("exact-agent", "devices/temperature_sensor/temp-1")
+        
+        await router.route_device_data(*key, {"temperature": 22.5})
+        assert router._fanout[key] == {"type-agent", "all-agent"}
+    
+    @pytest.mark.asyncio
+    async def test_deliver_a2a_messages_batch(self, router):
+        """Test a batch of deliveries lands in history newest first, as single deliveries would"""
+        target_id = "history-target"
+        history_key = f"agent:{target_id}:messages"
+        await router.redis.delete(history_key)
+        
+        await router.deliver_a2a_messages([
+            {"source_agent_id": "source-agent", "target_agent_id": target_id, "message": {"index": index}}
+            for index in range(3)
+        ])
+        
+        history = [json.loads(entry) for entry in await router.redis.lrange(history_key, 0, -1)]
+        assert [entry["message"]["index"] for entry in history] == [2, 1, 0]
+    
+    @pytest.mark.asyncio
+    async def test_a2a_queue_round_trip(self, router):
+        """Test queued A2A messages decode back to what was routed"""
+        message = {"message_type": "test_message", "payload": {"data": "test"}}
+        
+        with patch.object(router.redis, "xadd", new_callable=AsyncMock) as mock_xadd:
+            await router.route_a2a_message("source-agent", "target-agent", message)
+        
+        stream, fields = mock_xadd.call_args[0]
+        assert stream == "agent_message_queue"
+        queued = unpack_queue_item(fields["payload"])
+        assert queued["target_agent_id"] == "target-agent"
+        assert queued["message"] == message
+    
+    @pytest.mark.asyncio
+    async def test_a2a_local_delivery_skips_redis(self, router):
+        """Test messages for agents connected to this instance bypass the Redis queue"""
+        message = {"message_type": "test_message", "payload": {"data": "test"}}
+        queue = router.attach_local_agent("local-agent")
+        
+        try:
+            with patch.object(router.redis, "xadd", new_callable=AsyncMock) as mock_xadd:
+                await router.route_a2a_message("source-agent", "local-agent", message)
+        finally:
+            router.detach_local_agent("local-agent", queue)
+        
+        mock_xadd.assert_not_called()
+        delivered = queue.get_nowait()
+        assert delivered["source_agent_id"] == "source-agent"
+        assert delivered["message"] == message
+        assert "local-agent" not in router.local_agent_queues
+
+    @pytest.mark.asyncio
+    async def test_route_a2a_messages_batch(self, router):
+        """Test a routed batch goes to local agents directly and through Redis otherwise"""
+        history_key = "agent:remote-agent:messages"
+        await router.redis.delete(history_key)
+        queue = router.attach_local_agent("local-agent")
+
+        try:
+            await router.route_a2a_messages([
+                ("source-agent", "local-agent", {"index": 0}),
+                ("source-agent", "remote-agent", {"index": 1})
+            ])
+        finally:
+            router.detach_local_agent("local-agent", queue)
+
+        assert queue.get_nowait()["message"] == {"index": 0}
+        assert queue.empty()
+
+        for _ in range(50):
+            if await router.redis.llen(history_key) == 1:
+                break
+            await asyncio.sleep(0.05)
+
+        history = [json.loads(entry) for entry in await router.redis.lrange(history_key, 0, -1)]
+        assert [entry["message"] for entry in history] == [{"index": 1}]
+        await router.redis.delete(history_key)
+
+    @pytest.mark.asyncio
+    async def test_process_message_queue_delivers_batch(self, router):
+        """Test queued messages are drained and delivered by the background loop"""
+        target_id = "batch-target"
+        await router.redis.delete(f"agent:{target_id}:messages")
+        
+        for index in range(5):
+            await router.route_a2a_message("source-agent", target_id, {"index": index})
+        
+        history_key = f"agent:{target_id}:messages"
+        for _ in range(50):
+            if await router.redis.llen(history_key) == 5:
+                break
+            await asyncio.sleep(0.05)
+        
+        history = [json.loads(entry) for entry in await router.redis.lrange(history_key, 0, -1)]
+        assert sorted(entry["message"]["index"] for entry in history) == [0, 1, 2, 3, 4]
+        
+        # Delivered entries are acknowledged so they don't linger in the group's pending list
+        for _ in range(50):
+            if (await router.redis.xpending("agent_message_queue", "routers"))["pending"] == 0:
+                break
+            await asyncio.sleep(0.05)
+        assert (await router.redis.xpending("agent_message_queue", "routers"))["pending"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_unreadable_queue_entry_does_not_block_batch(self, router):
+        """Test a malformed entry is dropped on its own while the rest of its batch is delivered"""
+        history_key = "agent:poison-target:messages"
+        await router.redis.delete(history_key)
+        good = {"source_agent_id": "source-agent", "target_agent_id": "poison-target", "message": {"index": 1}}
+        
+        await router._deliver_queue_entries([
+            (b"agent_message_queue", [
+                (b"1-1", {b"payload": b"not a queue item"}),
+                (b"1-2", None),  # entry deleted from the stream while still pending
+                (b"1-3", {b"payload": pack_queue_item(good)})
+            ])
+        ])
+        
+        history = [json.loads(entry) for entry in await router.redis.lrange(history_key, 0, -1)]
+        assert history == [good]
+        await router.redis.delete(history_key)
+    
+    @pytest.mark.asyncio
+    async def test_unacknowledged_entries_are_redelivered(self, router):
+        """Test entries a router read but never acknowledged are delivered after a restart or by another router"""
+        # Pause the shared router's reader so the test decides who reads the entries
+        router._queue_task.cancel()
+        await asyncio.gather(router._queue_task, return_exceptions=True)
+        history_key = "agent:pending-target:messages"
+        await router.redis.delete(history_key)
+        
+        async def read_without_ack(consumer, index):
+            await router.route_a2a_message("source-agent", "pending-target", {"index": index})
+            await router.redis.xreadgroup("routers", consumer, {"agent_message_queue": ">"})
+        
+        async def run_router(consumer):
+            restarted = MessageRouter()
+            restarted.consumer_name = consumer
+            restarted.redis = router.redis
+            restarted.running = True
+            task = asyncio.create_task(restarted.process_message_queue())
+            for _ in range(50):
+                if await router.redis.llen(history_key) == len(expected):
+                    break
+                await asyncio.sleep(0.05)
+            restarted.running = False
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        
+        try:
+            # The same router coming back picks up its own pending entries
+            expected = [0]
+            await read_without_ack("crashed-router", 0)
+            await run_router("crashed-router")
+            
+            # A different router claims entries left idle by one that never returns
+            expected = [0, 1]
+            await read_without_ack("dead-router", 1)
+            with patch("intermediary.message_router.PENDING_CLAIM_IDLE_MS", 0):
+                await run_router("surviving-router")
+            
+            history = [json.loads(entry) for entry in await router.redis.lrange(history_key, 0, -1)]
+            assert sorted(entry["message"]["index"] for entry in history) == expected
+            assert (await router.redis.xpending("agent_message_queue", "routers"))["pending"] == 0
+        finally:
+            await router.redis.delete(history_key)
+            router._queue_task = asyncio.create_task(router.process_message_queue())
+    
     @pytest.mark.asyncio
     async def test_route_iot_to_agent(self, router):
         """Test routing IoT data to interested agents"""
@@ -442,8 +886,7 @@ class TestMessageRouter:
         agents = ["agent-1", "agent-2", "agent-3"]
         
         # Register all agents
-        for agent_id in agents:
-            await router.register_agent(agent_id, {})
+        await router.register_agents({agent_id: {} for agent_id in agents})
         
         broadcast_message = {
             "message_type": "system_alert",
@@ -454,7 +897,7 @@ class TestMessageRouter:
         source_id = "system"
         
         # For each agent, send a message and directly deliver it to simulate process_message_queue
-        for agent_id in agents:
+        async def send_and_deliver(agent_id):
             # Send the message
             await router.route_a2a_message(source_id, agent_id, broadcast_message)
             
@@ -469,14 +912,23 @@ class TestMessageRouter:
             # Directly deliver the message
             await router.deliver_a2a_message(message_data)
         
+        # The agents are independent, so their sends overlap
+        await asyncio.gather(*(send_and_deliver(agent_id) for agent_id in agents))
+        
+        # Read each agent's history length and newest message in one round trip
+        async with router.redis.pipeline(transaction=False) as pipe:
+            for agent_id in agents:
+                agent_history_key = f"agent:{agent_id}:messages"
+                pipe.llen(agent_history_key)
+                pipe.lindex(agent_history_key, 0)
+            history = await pipe.execute()
+        
         # Check each agent's message history in Redis
-        for agent_id in agents:
-            agent_history_key = f"agent:{agent_id}:messages"
-            history_length = await router.redis.llen(agent_history_key)
+        for index, agent_id in enumerate(agents):
+            history_length, history_message_json = history[2 * index], history[2 * index + 1]
             assert history_length > 0
             
             # Get the message from history
-            history_message_json = await router.redis.lindex(agent_history_key, 0)
             history_message = json.loads(history_message_json)
             
             # Verify message contents
@@ -528,12 +980,102 @@ class TestMessageRouter:
         assert history_message["target_agent_id"] == target_id
 
 
+@pytest.fixture
+async def security_manager():
+    """SecurityManager fixture connected to Redis"""
+    manager = SecurityManager()
+    await manager.initialize()
+    yield manager
+    await manager.close()
+
+class TestSecurityManager:
+    """Test suite for Security Manager"""
+    
+    @pytest.mark.asyncio
+    async def test_validated_token_is_cached(self, security_manager):
+        """Test a token is only checked against Redis the first time it is validated"""
+        await security_manager.authenticate_agent("secure-agent", {"agent_type": "control"})
+        token = await security_manager.generate_agent_token("secure-agent", "control")
+        
+        with patch.object(security_manager.redis, "hget", wraps=security_manager.redis.hget) as mock_hget:
+            first = await security_manager.validate_agent_token(token)
+            second = await security_manager.validate_agent_token(token)
+        
+        assert first == second
+        assert first["agent_id"] == "secure-agent"
+        assert mock_hget.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_revoked_agent_token_is_rejected(self, security_manager):
+        """Test revoking an agent invalidates tokens that were already cached"""
+        await security_manager.authenticate_agent("revoked-agent", {"agent_type": "control"})
+        token = await security_manager.generate_agent_token("revoked-agent", "control")
+        assert await security_manager.validate_agent_token(token) is not None
+        
+        await security_manager.revoke_agent("revoked-agent")
+        
+        assert await security_manager.validate_agent_token(token) is None
+    
+    @pytest.mark.asyncio
+    async def test_permission_check_uses_cached_agent_type(self, security_manager):
+        """Test permission checks for an authenticated agent don't go back to Redis"""
+        await security_manager.authenticate_agent("control-agent", {"agent_type": "control"})
+        
+        with patch.object(security_manager.redis, "hget", new_callable=AsyncMock) as mock_hget:
+            assert await security_manager.check_agent_permission("control-agent", "device", "switch-1", "control")
+            assert not await security_manager.check_agent_permission("control-agent", "device", "switch-1", "read")
+        mock_hget.assert_not_called()
+        
+        await security_manager.revoke_agent("control-agent")
+        assert not await security_manager.check_agent_permission("control-agent", "device", "switch-1", "control")
+    
+    @pytest.mark.asyncio
+    async def test_log_security_event(self, security_manager):
+        """Test security events are appended to the security event stream"""
+        await security_manager.log_security_event("login_failed", {"agent_id": "intruder"})
+        
+        (_, event), = await security_manager.redis.xrevrange("security_events", count=1)
+        assert event["event_type"] == "login_failed"
+        assert json.loads(event["details"]) == {"agent_id": "intruder"}
+        assert float(event["timestamp"]) > 0
+    
+    @pytest.mark.asyncio
+    async def test_redis_pool_is_shared(self):
+        """Test components on the same server and decoding share one connection pool"""
+        pool = get_redis_pool("localhost", 6379, decode_responses=True)
+        
+        assert get_redis_pool("localhost", 6379, decode_responses=True) is pool
+        assert get_redis_pool("localhost", 6379) is not pool
+    
+    @pytest.mark.asyncio
+    async def test_password_hash_round_trip(self):
+        """Test hashed passwords verify only against the original password"""
+        manager = SecurityManager()
+        manager.password_iterations = 1000  # Cheap parameters keep the test fast
+        stored_hash = await manager.hash_password("correct horse")
+        
+        assert stored_hash.startswith("v1$1000$")
+        assert await manager.verify_password(stored_hash, "correct horse")
+        assert not await manager.verify_password(stored_hash, "wrong horse")
+    
+    @pytest.mark.asyncio
+    async def test_verify_legacy_password_hash(self):
+        """Test hashes stored in the original salt:key format still verify"""
+        salt = b"\x01" * 32
+        key = hashlib.pbkdf2_hmac('sha256', b"correct horse", salt, 100000)
+        manager = SecurityManager()
+        manager.password_iterations = 1000
+        
+        assert await manager.verify_password(salt.hex() + ':' + key.hex(), "correct horse")
+
 class TestIntegration:
     """Integration tests for the complete system"""
     
     @pytest.fixture
-    def client(self):
-        return TestClient(app)
+    async def client(self):
+        """Client that calls the app on the test's own event loop instead of a worker thread"""
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as async_client:
+            yield async_client
     
     @pytest.mark.asyncio
     async def test_end_to_end_agent_iot_communication(self, client):
@@ -546,7 +1088,7 @@ class TestIntegration:
             "capabilities": ["device_control"]
         }
         
-        response = client.post("/agents/register", json=agent_data)
+        response = await client.post("/agents/register", json=agent_data)
         assert response.status_code == 200
         
         # 2. Mock IoT device data in MQTT
@@ -562,7 +1104,7 @@ class TestIntegration:
             }
             
             # 3. Agent queries device status
-            query_response = client.post("/iot/query", json={
+            query_response = await client.post("/iot/query", json={
                 "agent_id": "control-agent-1",
                 "device_type": "smart_switch",
                 "query_params": {"device_id": "switch-1"}
@@ -592,7 +1134,7 @@ class TestIntegration:
                 mock_publish.return_value = None
 
                 command_payload = {"action": "turn_on", "brightness": 75}
-                control_response = client.post("/iot/control", json={
+                control_response = await client.post("/iot/control", json={
                     "agent_id": "control-agent-1",
                     "device_id": device_id, # This is "switch-1"
                     "command": command_payload
@@ -613,7 +1155,7 @@ class TestIntegration:
     async def test_multi_agent_coordination(self, client):
         """Test multiple agents coordinating through the intermediary"""
         # Register monitoring agent
-        monitoring_response = client.post("/agents/register", json={
+        monitoring_response = await client.post("/agents/register", json={
             "agent_id": "monitor-1",
             "name": "Monitoring Agent",
             "agent_type": "monitoring",
@@ -622,7 +1164,7 @@ class TestIntegration:
         assert monitoring_response.status_code == 200
         
         # Register control agent
-        control_response = client.post("/agents/register", json={
+        control_response = await client.post("/agents/register", json={
             "agent_id": "control-1",
             "name": "Control Agent",
             "agent_type": "control",
@@ -634,7 +1176,7 @@ class TestIntegration:
         with patch('intermediary.message_router.MessageRouter.route_a2a_message') as mock_route:
             mock_route.return_value = None # For AsyncMock, this will result in an awaitable that returns None
             
-            message_response = client.post("/agents/message", json={
+            message_response = await client.post("/agents/message", json={
                 "source_agent_id": "monitor-1",
                 "target_agent_id": "control-1",
                 "message": {
@@ -658,37 +1200,32 @@ class TestIntegration:
 
 
 # Performance and stress tests
+@pytest.mark.xdist_group(name="router")
 class TestPerformance:
     """Performance and stress tests"""
     
     @pytest.mark.asyncio
-    async def test_high_message_throughput(self):
+    async def test_high_message_throughput(self, router):
         """Test system can handle high message throughput"""
-        router = MessageRouter()
-        await router.start() # Initialize Redis connection
-
-        # Ensure the main queue is empty before starting this specific test logic
-        await router.redis.delete("agent_message_queue")
-        # Also ensure agent history queues are clear if they might interfere (optional, but safer)
+        # Start from an empty main queue and agent histories, cleared in one round trip
         num_agents = 10
-        for i in range(num_agents):
-            await router.redis.delete(f"agent:agent-{i}:messages")
+        test_keys = ["agent_message_queue"] + [f"agent:agent-{i}:messages" for i in range(num_agents)]
+        await router.redis.delete(*test_keys)
 
         # Register multiple agents
-        for i in range(num_agents):
-            await router.register_agent(f"agent-{i}", {})
+        await router.register_agents({f"agent-{i}": {} for i in range(num_agents)})
             
-        # Send many messages
-        start_time = asyncio.get_event_loop().time()
+        # Build the messages up front so only routing is timed
         num_messages = 1000
-            
-        for i in range(num_messages):
-            source = f"agent-{i % num_agents}"
-            target = f"agent-{(i + 1) % num_agents}"
-            message = {"message_id": i, "data": f"test-{i}"}
-            
-            await router.route_a2a_message(source, target, message)
+        agent_ids = [f"agent-{i}" for i in range(num_agents)]
+        messages = [
+            (agent_ids[i % num_agents], agent_ids[(i + 1) % num_agents], {"message_id": i, "data": f"test-{i}"})
+            for i in range(num_messages)
+        ]
         
+        # Send many messages
+        start_time = asyncio.get_event_loop().time()
+        await router.route_a2a_messages(messages)
         end_time = asyncio.get_event_loop().time()
         duration = end_time - start_time
         
@@ -698,7 +1235,7 @@ class TestPerformance:
         # Verify all messages were queued in the global Redis queue
         # The MessageRouter uses 'agent_message_queue' and then moves messages to agent-specific history lists.
         # We need to check the sum of messages still in the main queue and those in history lists.
-        messages_in_main_queue = await router.redis.llen("agent_message_queue")
+        messages_in_main_queue = await router.redis.xlen("agent_message_queue")
         
         messages_in_history = 0
         for i in range(num_agents):
@@ -714,10 +1251,7 @@ class TestPerformance:
             f"Expected {num_messages} total, found {messages_in_main_queue} in main queue + {messages_in_history} in history"
 
         # Clean up all queues used by this test
-        await router.redis.delete("agent_message_queue")
-        for i in range(num_agents):
-            await router.redis.delete(f"agent:agent-{i}:messages")
-        await router.stop() # Clean up Redis connection
+        await router.redis.delete(*test_keys)
     
     @pytest.mark.asyncio
     async def test_concurrent_device_updates(self):
@@ -735,7 +1269,7 @@ class TestPerformance:
                 }
                 # Transform data
                 transformed = transformer.transform_mqtt_to_agent(data)
-                await asyncio.sleep(0.001)  # Small delay
+                await asyncio.sleep(0)  # Let the other devices' updates interleave
         
         # Run concurrent updates from 10 devices
         tasks = [